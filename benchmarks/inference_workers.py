@@ -0,0 +1,98 @@
+"""
+inference_workers.py
+
+This file benchmarks the throughput of components.main.predict_sharded
+against the number of worker processes, on a synthetic feature matrix
+scored by a random forest trained like train_model's and saved to a
+temporary directory.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.inference_workers --rows 2M --workers 1,2,4,8
+
+It checks that every worker count predicts the same probabilities as
+scoring in one process, and reports rows per second and the speedup over
+one process. Worker counts above the number of cores are skipped.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from joblib import dump
+from sklearn.ensemble import RandomForestClassifier
+
+from benchmarks.run import parse_rows
+
+NUM_FEATURES = 9
+
+
+def synthetic_features(rows, seed=0):
+    """
+    Returns a float64 matrix with the shape of the model inputs, and labels
+    that depend on some of its columns.
+    """
+    rng = np.random.default_rng(seed)
+    matrix = rng.random((rows, NUM_FEATURES))
+    labels = (matrix[:, 0] + matrix[:, 5] + 0.2 * rng.random(rows) > 1.1).astype(int)
+    return matrix, labels
+
+
+def main(argv=None):
+    from components.main import predict_sharded
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rows", default="2M")
+    parser.add_argument("--workers", default="1,2,4,8")
+    parser.add_argument("--n-estimators", type=int, default=10)
+    parser.add_argument("--max-depth", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Path of a CSV of the results")
+    args = parser.parse_args(argv)
+
+    rows = parse_rows(args.rows)[0]
+    workers = [int(n) for n in args.workers.split(",")]
+    cores = os.cpu_count()
+    matrix, labels = synthetic_features(rows)
+    train_rows = min(rows, 100_000)
+    model = RandomForestClassifier(
+        max_depth=args.max_depth, n_estimators=args.n_estimators, random_state=42
+    ).fit(matrix[:train_rows], labels[:train_rows])
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "model.joblib")
+        dump(model, path)
+        expected = model.predict_proba(matrix)[:, 1]
+        for n_jobs in workers:
+            if n_jobs > cores:
+                print(f"Skipping {n_jobs} workers on {cores} cores")
+                continue
+            seconds = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                predictions = predict_sharded(matrix, path, n_jobs)
+                seconds.append(time.perf_counter() - start)
+            np.testing.assert_array_equal(expected, predictions)
+            results.append((n_jobs, min(seconds)))
+
+    print(f"{rows:,} rows, {args.n_estimators} trees of depth {args.max_depth}, {cores} cores")
+    base = results[0][1] if results else None
+    for n_jobs, seconds in results:
+        print(
+            f"{n_jobs:>3} workers: {seconds:8.3f}s, {rows / seconds:12,.0f} rows/s, "
+            f"{base / seconds:5.2f}x"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("workers,seconds,rows_per_second\n")
+            for n_jobs, seconds in results:
+                f.write(f"{n_jobs},{seconds},{rows / seconds}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""
+load_cache.py
+
+This file benchmarks components.cache.DayCache against loading directly,
+on synthetic trip data served by a loader with a fixed per-query latency
+that stands in for the database.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.load_cache --days 14 --rows-per-day 100k --latency 0.2
+
+It times the same windows loaded directly, through a cold cache, through
+the warm cache, and through the warm cache with column projection, and
+checks that the cached results are identical to the direct ones.
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.run import parse_rows
+
+
+def synthetic_trips(start_date, days, rows_per_day, seed=0):
+    """
+    Returns synthetic trips with the raw columns used by clean_data and
+    featurize_data, sorted by pickup time.
+    """
+    rng = np.random.default_rng(seed)
+    rows = days * rows_per_day
+    pickup = pd.Timestamp(start_date) + pd.to_timedelta(
+        np.sort(rng.integers(0, days * 86400, rows)), unit="s"
+    )
+    return pd.DataFrame(
+        {
+            "tpep_pickup_datetime": pickup,
+            "tpep_dropoff_datetime": pickup
+            + pd.to_timedelta(rng.integers(60, 3600, rows), unit="s"),
+            "fare_amount": rng.random(rows) * 30,
+            "tip_amount": rng.random(rows) * 5,
+            "trip_distance": rng.random(rows) * 10,
+            "passenger_count": np.where(
+                rng.random(rows) < 0.05, np.nan, rng.integers(1, 5, rows)
+            ),
+            "congestion_surcharge": np.where(rng.random(rows) < 0.1, np.nan, 2.5),
+            "pulocationid": rng.integers(1, 265, rows),
+            "dolocationid": rng.integers(1, 265, rows),
+            "ratecodeid": rng.integers(1, 6, rows).astype(np.float64),
+            "vendorid": rng.integers(1, 3, rows),
+            "store_and_fwd_flag": rng.choice(["N", "Y"], rows),
+        }
+    )
+
+
+class SyntheticLoader:
+    """
+    Serves date ranges of a DataFrame, half-open on pickup time, after
+    sleeping `latency` seconds per query.
+    """
+
+    def __init__(self, df, latency):
+        self.df = df
+        self.latency = latency
+        self.queries = 0
+
+    def __call__(self, start_date, end_date):
+        self.queries += 1
+        time.sleep(self.latency)
+        pickup = self.df["tpep_pickup_datetime"]
+        rows = (pickup >= pd.Timestamp(start_date)) & (pickup < pd.Timestamp(end_date))
+        return self.df[rows.to_numpy()].reset_index(drop=True)
+
+
+def windows(start_date, days, window_days):
+    """
+    Returns overlapping windows of `window_days` days, one starting on each
+    day, like the sliding windows of inference.
+    """
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    return [
+        (
+            (start + timedelta(i)).strftime("%Y-%m-%d"),
+            (start + timedelta(i + window_days)).strftime("%Y-%m-%d"),
+        )
+        for i in range(days - window_days + 1)
+    ]
+
+
+def main(argv=None):
+    from components.cache import DayCache
+    from components.main import RAW_COLUMNS
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--start", default="2020-03-01")
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--window-days", type=int, default=2)
+    parser.add_argument("--rows-per-day", default="100k")
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    df = synthetic_trips(args.start, args.days, parse_rows(args.rows_per_day)[0])
+    loader = SyntheticLoader(df, args.latency)
+    ranges = windows(args.start, args.days, args.window_days)
+
+    def timed(load):
+        start = time.perf_counter()
+        frames = [load(start_date, end_date) for start_date, end_date in ranges]
+        return frames, time.perf_counter() - start
+
+    direct, direct_seconds = timed(loader)
+    results = [("direct", direct_seconds, loader.queries)]
+    with tempfile.TemporaryDirectory() as path:
+        cache = DayCache(path, loader)
+        for name, columns in (("cold", None), ("warm", None), ("warm_projected", RAW_COLUMNS)):
+            loader.queries = 0
+            frames, seconds = timed(
+                lambda start_date, end_date: cache.load(start_date, end_date, columns)
+            )
+            results.append((name, seconds, loader.queries))
+            for expected, actual in zip(direct, frames):
+                pd.testing.assert_frame_equal(
+                    expected if columns is None else expected[columns], actual
+                )
+
+    print(f"{len(ranges)} windows of {args.window_days} days, {len(df):,} rows")
+    for name, seconds, queries in results:
+        print(
+            f"{name:>15}: {seconds:8.3f}s, {seconds / len(ranges) * 1000:8.2f}ms "
+            f"per window, {queries} queries"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
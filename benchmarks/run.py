@@ -0,0 +1,269 @@
+"""
+run.py
+
+This file benchmarks BinaryClassificationMetric on synthetic predictions
+and labels: logging throughput, registry memory, /metrics render time and
+payload size, and metric read time against a stand-in query API.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.run --rows 1k,10k,100k,1M --output results.csv
+    python -m benchmarks.run --baseline results.csv
+    python -m benchmarks.run --instrument both
+
+Results are written in the shape of analysis/timing_df_*.csv, with the
+mltrace and Postgres columns left empty and extra columns appended. Each
+configuration runs in a fresh process, so registries and memory
+measurements do not carry over between runs.
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+MODES = ("keyed", "array", "aggregate")
+
+TIMING_COLUMNS = [
+    "start_date",
+    "end_date",
+    "mltrace_logging_times",
+    "mltrace_metric_computation_times",
+    "prometheus_logging_times",
+    "prometheus_metric_computation_times",
+    "postgres_metric_computation_times",
+    "num_points",
+]
+EXTRA_COLUMNS = [
+    "mode",
+    "instrumented",
+    "rows_per_second",
+    "registry_bytes",
+    "bytes_per_row",
+    "render_seconds",
+    "cached_render_seconds",
+    "payload_bytes",
+    "gzip_payload_bytes",
+]
+
+# Columns compared against a baseline, and whether higher is better
+COMPARED = {
+    "prometheus_logging_times": False,
+    "prometheus_metric_computation_times": False,
+    "registry_bytes": False,
+    "render_seconds": False,
+    "payload_bytes": False,
+}
+
+_SUFFIXES = {"k": 1_000, "M": 1_000_000}
+
+
+def parse_rows(rows):
+    """
+    Parses a comma-separated list of row counts such as "1k,10k,1M".
+    """
+    counts = []
+    for count in rows.split(","):
+        count = count.strip()
+        if count[-1] in _SUFFIXES:
+            counts.append(int(float(count[:-1]) * _SUFFIXES[count[-1]]))
+        else:
+            counts.append(int(count))
+    return counts
+
+
+def _rss():
+    """
+    Returns the resident set size of this process in bytes, or None where
+    /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def synthetic_data(rows, seed=0):
+    """
+    Returns scores, binary labels drawn with those scores as probabilities,
+    and unique string identifiers.
+    """
+    rng = np.random.default_rng(seed)
+    preds = rng.random(rows)
+    labels = (rng.random(rows) < preds).astype(np.int64)
+    keys = np.arange(rows).astype(str)
+    return preds, labels, keys
+
+
+def run_config(mode, rows, window_rows, seed=0, instrument=False):
+    """
+    Benchmarks one mode at one scale. Must run in a fresh process, since it
+    registers its metric in the default registry.
+    """
+    import prometheus_client as prom
+
+    from benchmarks.stub import PrometheusStub
+    from mext import BinaryClassificationMetric
+    from mext.exposition import ExpositionCache
+    from mext.query import QueryClient
+
+    preds, labels, keys = synthetic_data(rows, seed)
+    started = datetime.now()
+
+    gc.collect()
+    rss = _rss()
+    metric = BinaryClassificationMetric(
+        "bench",
+        "Synthetic binary classification metric",
+        ["output_id"],
+        aggregate=mode == "aggregate",
+        backend="array" if mode == "array" else "gauge",
+        instrument=instrument,
+    )
+    # Log in windows, like inference/main.py, so that feedback arrives
+    # before the aggregated join's pending buffer fills up
+    start = time.perf_counter()
+    for i in range(0, rows, window_rows):
+        window = slice(i, i + window_rows)
+        metric.logOutputs(preds[window], keys[window])
+        metric.logFeedbacks(labels[window], keys[window])
+    logging_seconds = time.perf_counter() - start
+    gc.collect()
+    registry_bytes = None if rss is None else _rss() - rss
+
+    cache = ExpositionCache(prom.REGISTRY, metrics_registry=prom.CollectorRegistry())
+    start = time.perf_counter()
+    payload, gzipped = cache.render()
+    render_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    cache.render()
+    cached_render_seconds = time.perf_counter() - start
+
+    stub = PrometheusStub(metric, prom.REGISTRY)
+    stub.scrape()
+    client = QueryClient(stub.url, cache_ttl=0)
+    start = time.perf_counter()
+    client.read(metric, end=time.time())
+    query_seconds = time.perf_counter() - start
+    client.close()
+    stub.close()
+
+    return {
+        "start_date": started.isoformat(timespec="seconds"),
+        "end_date": datetime.now().isoformat(timespec="seconds"),
+        "mltrace_logging_times": np.nan,
+        "mltrace_metric_computation_times": np.nan,
+        "prometheus_logging_times": logging_seconds,
+        "prometheus_metric_computation_times": query_seconds,
+        "postgres_metric_computation_times": np.nan,
+        "num_points": rows,
+        "mode": mode,
+        "instrumented": instrument,
+        "rows_per_second": rows / logging_seconds,
+        "registry_bytes": registry_bytes,
+        "bytes_per_row": None if registry_bytes is None else registry_bytes / rows,
+        "render_seconds": render_seconds,
+        "cached_render_seconds": cached_render_seconds,
+        "payload_bytes": len(payload),
+        "gzip_payload_bytes": len(gzipped),
+    }
+
+
+def run(modes, rows, window_rows=100_000, seed=0, instrument=(False,)):
+    """
+    Runs every mode at every scale, with and/or without self-instrumentation,
+    each in a fresh process, and returns the results as a DataFrame.
+    """
+    results = []
+    for mode in modes:
+        for count in rows:
+            for instrumented in instrument:
+                with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                    result = pool.submit(
+                        run_config, mode, count, window_rows, seed, instrumented
+                    ).result()
+                results.append(result)
+                print(
+                    f"{mode:>9}{'+i' if instrumented else '  '} {count:>10,} rows: "
+                    f"{result['rows_per_second']:>10,.0f} rows/s, "
+                    f"render {result['render_seconds']:.3f}s, "
+                    f"query {result['prometheus_metric_computation_times']:.3f}s",
+                    flush=True,
+                )
+    return pd.DataFrame(results, columns=TIMING_COLUMNS + EXTRA_COLUMNS)
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Returns the measurements in `results` that are more than `tolerance`
+    (relative) worse than the same mode and scale in `baseline`.
+    """
+    if "instrumented" not in baseline:
+        baseline = baseline.assign(instrumented=False)
+    merged = results.merge(
+        baseline,
+        on=["mode", "num_points", "instrumented"],
+        suffixes=("", "_baseline"),
+    )
+    regressions = []
+    for _, row in merged.iterrows():
+        for column, higher_is_better in COMPARED.items():
+            new, old = row[column], row[column + "_baseline"]
+            if pd.isna(new) or pd.isna(old) or old <= 0:
+                continue
+            change = (old - new) / old if higher_is_better else (new - old) / old
+            if change > tolerance:
+                regressions.append(
+                    (row["mode"], row["num_points"], column, old, new)
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rows", default="1k,10k,100k,1M")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--window-rows", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.csv")
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--instrument", choices=["off", "on", "both"], default="off"
+    )
+    args = parser.parse_args(argv)
+
+    modes = args.modes.split(",")
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"mode must be one of {MODES}")
+
+    instrument = {"off": (False,), "on": (True,), "both": (False, True)}
+    results = run(
+        modes,
+        parse_rows(args.rows),
+        args.window_rows,
+        args.seed,
+        instrument[args.instrument],
+    )
+    results.to_csv(args.output, index=False)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, pd.read_csv(args.baseline), args.tolerance)
+        for mode, rows, column, old, new in regressions:
+            print(f"Regression: {mode} {rows:,} rows {column} {old:.4g} -> {new:.4g}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
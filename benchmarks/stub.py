@@ -0,0 +1,130 @@
+"""
+stub.py
+
+This file contains a stand-in for the Prometheus query API, used to time
+metric reads in the benchmarks without a Prometheus server.
+"""
+
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import numpy as np
+import pandas as pd
+
+from mext.prometheus_ml_ext import OUTCOMES, classification_metrics
+from mext.query import QUERY_LABEL
+
+
+def _ratio(numerator, denominator):
+    return numerator / denominator if denominator else float("nan")
+
+
+class PrometheusStub:
+    """
+    Answers query_range requests for a BinaryClassificationMetric's
+    combined get_query_strings().
+
+    scrape() copies the metric's samples out of a registry, as a scrape
+    would. Queries are then evaluated on those samples the way the PromQL
+    does it: a join of prediction and label series on the keys in the
+    per-key mode, and ratios of the outcome counters in aggregate mode
+    (over everything logged, rather than a rate over a window).
+    """
+
+    def __init__(self, metric, registry):
+        self.metric = metric
+        self.registry = registry
+        self._samples = {}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def scrape(self):
+        samples = {}
+        for family in self.registry.collect():
+            for sample in family.samples:
+                samples.setdefault(sample.name, []).append(sample)
+        with self._lock:
+            self._samples = samples
+
+    def _series(self, name):
+        keys = self.metric.keys
+        samples = self._samples.get(name, [])
+        return pd.Series(
+            [s.value for s in samples],
+            index=[tuple(s.labels[k] for k in keys) for s in samples],
+            dtype=np.float64,
+        )
+
+    def evaluate(self):
+        """
+        Returns the metric's accuracy, precision and recall.
+        """
+        metric = self.metric
+        with self._lock:
+            if metric.aggregate:
+                counts = dict.fromkeys(OUTCOMES, 0.0)
+                for s in self._samples.get(metric.outcome_metric_name + "_total", []):
+                    counts[s.labels["outcome"]] += s.value
+                return classification_metrics([counts[o] for o in OUTCOMES])
+            preds = self._series(metric.pred_metric_name)
+            labels = self._series(metric.label_metric_name)
+        preds, labels = preds.align(labels, join="inner")
+        preds, labels = preds.to_numpy(), labels.to_numpy()
+        threshold = metric.threshold
+        hits = np.count_nonzero(labels * preds > threshold)
+        return {
+            "accuracy": _ratio(
+                np.count_nonzero(np.abs(labels - preds) < threshold), len(preds)
+            ),
+            "precision": _ratio(hits, np.count_nonzero(preds > threshold)),
+            "recall": _ratio(hits, np.count_nonzero(labels == 1)),
+        }
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                params = parse_qs(self.rfile.read(length).decode())
+                names = re.findall(
+                    f'"{QUERY_LABEL}", "(\\w+)"', params["query"][0]
+                )
+                values = stub.evaluate()
+                end = float(params["end"][0])
+                result = [
+                    {
+                        "metric": {QUERY_LABEL: name},
+                        "values": [[end, str(float(values[name]))]],
+                    }
+                    for name in names
+                ]
+                body = json.dumps(
+                    {
+                        "status": "success",
+                        "data": {"resultType": "matrix", "result": result},
+                    }
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                return
+
+        return Handler
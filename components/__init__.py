@@ -1,17 +1,37 @@
 from components.main import (
+    RAW_COLUMNS,
     load_data,
+    load_data_chunks,
     clean_data,
+    clean_data_chunks,
     featurize_data,
+    featurize_data_chunks,
+    stream_features,
     train_test_split,
     train_model,
     inference,
+    load_model,
+    save_model,
+    predict_sharded,
+    shutdown_scoring_pools,
+    timer,
 )
 
 __all__ = [
+    "RAW_COLUMNS",
     "load_data",
+    "load_data_chunks",
     "clean_data",
+    "clean_data_chunks",
     "featurize_data",
+    "featurize_data_chunks",
+    "stream_features",
     "train_test_split",
     "train_model",
     "inference",
+    "load_model",
+    "save_model",
+    "predict_sharded",
+    "shutdown_scoring_pools",
+    "timer",
 ]
@@ -0,0 +1,129 @@
+"""
+cache.py
+This file defines an on-disk cache of loaded trip data, partitioned by day
+in Arrow IPC files that are read memory-mapped. It needs pyarrow 14 or
+later, for concat_tables(promote_options=...); without pyarrow, DayCache
+raises ImportError.
+"""
+
+import logging
+import os
+import threading
+import typing
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+except ImportError:
+    pa = None
+
+
+def _day(date) -> datetime:
+    return pd.Timestamp(date).to_pydatetime()
+
+
+class DayCache:
+    """
+    Caches the result of a loader, fetch(start_date, end_date), one day at a
+    time under `path`.
+
+    load(start_date, end_date) reads the cached days of the range
+    memory-mapped, with only the requested columns, and fetches the others
+    one day at a time. Files are Arrow IPC, so reads map columns in place
+    instead of decoding them, and the only copy is the conversion to
+    pandas. When the files take more than `max_bytes`, the least recently
+    read days are removed.
+
+    The days concatenated must be the rows of the whole range, i.e. the
+    loader must split date ranges at their boundaries. Columns whose type
+    differs between days (e.g. integers on a day without nulls) are
+    promoted as pandas would for the whole range. Ranges that do not
+    start and end at midnight are fetched without the cache.
+    """
+
+    def __init__(self, path: str, fetch, max_bytes: int = 10 * 2**30):
+        if pa is None:
+            raise ImportError("DayCache requires pyarrow.")
+        self.path = path
+        self.fetch = fetch
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, day: datetime) -> str:
+        return os.path.join(self.path, day.strftime("%Y-%m-%d") + ".arrow")
+
+    def _read(self, day: datetime, columns) -> "pa.Table":
+        path = self._file(day)
+        with pa.memory_map(path) as source:
+            table = ipc.open_file(source).read_all()
+        # Reads count as uses for eviction
+        os.utime(path)
+        return table.select(columns) if columns is not None else table
+
+    def _write(self, day: datetime, df: pd.DataFrame) -> None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        path = self._file(day)
+        partial = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with pa.OSFile(partial, "wb") as sink:
+            with ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(partial, path)
+
+    def _evict(self) -> None:
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".arrow"):
+                stat = os.stat(os.path.join(self.path, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
+            logging.info(f"Evicted {name} from the load cache.")
+
+    def load(
+        self, start_date, end_date, columns: typing.Optional[typing.List[str]] = None
+    ) -> pd.DataFrame:
+        """
+        Returns the rows from start_date (inclusive) to end_date (exclusive),
+        with only `columns` if given.
+        """
+        start, end = _day(start_date), _day(end_date)
+        if start != _day(start.date()) or end != _day(end.date()):
+            df = self.fetch(start_date, end_date)
+            return df if columns is None else df[columns]
+
+        tables = []
+        fetched = False
+        day = start
+        while day < end:
+            next_day = day + timedelta(days=1)
+            with self._lock:
+                cached = os.path.exists(self._file(day))
+                if cached:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if not cached:
+                self._write(
+                    day,
+                    self.fetch(day.strftime("%Y-%m-%d"), next_day.strftime("%Y-%m-%d")),
+                )
+                fetched = True
+            tables.append(self._read(day, columns))
+            day = next_day
+        if fetched:
+            with self._lock:
+                self._evict()
+        if not tables:
+            return self.fetch(start_date, end_date)
+        table = pa.concat_tables(tables, promote_options="permissive")
+        return table.to_pandas(split_blocks=True)
@@ -1,12 +1,21 @@
 import os
+import itertools
 import logging
+import multiprocessing
+import tempfile
+import threading
+import numpy as np
 import pandas as pd
 from ttb import Dataset
 import typing
 
+from components.cache import DayCache
 from components.defs import *
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 from joblib import dump, load
+from mext.timing import StageTimer
+from multiprocessing import shared_memory
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import (
     f1_score,
@@ -17,19 +26,83 @@ from sklearn.metrics import (
 
 ds = Dataset("taxi_data", cutoff_date=datetime(2021, 1, 1), backend="pandas")
 
+# Times the pipeline's stages; see mext.timing.StageTimer
+timer = StageTimer("pipeline")
 
-def load_data(start_date: str, end_date: str) -> pd.DataFrame:
+# With LOAD_CACHE_DIR set, loaded days are cached on disk (up to
+# LOAD_CACHE_BYTES); see components.cache.DayCache
+cache = (
+    DayCache(
+        os.environ["LOAD_CACHE_DIR"],
+        ds.load,
+        int(os.environ.get("LOAD_CACHE_BYTES", 10 * 2**30)),
+    )
+    if os.environ.get("LOAD_CACHE_DIR")
+    else None
+)
+
+# Raw columns used by clean_data and featurize_data
+RAW_COLUMNS = [
+    "tpep_pickup_datetime",
+    "tpep_dropoff_datetime",
+    "fare_amount",
+    "tip_amount",
+    "trip_distance",
+    "passenger_count",
+    "congestion_surcharge",
+    "pulocationid",
+    "dolocationid",
+    "ratecodeid",
+    "vendorid",
+]
+
+
+@timer.timed("load_data")
+def load_data(
+    start_date: str,
+    end_date: str,
+    columns: typing.Optional[typing.List[str]] = None,
+) -> pd.DataFrame:
     """
     Format: %Y-%m-%d
     This function loads the trip data corresponding to the specified
     dates. The data must be stored in the "data" folder and can
-    be populated using the download.sh script.
+    be populated using the download.sh script. With `columns`, only those
+    columns are returned (and read from the cache, if enabled).
     """
+    if cache:
+        return cache.load(start_date, end_date, columns)
+    df = ds.load(start_date, end_date)
+    return df if columns is None else df[columns]
 
-    return ds.load(start_date, end_date)
+
+def load_data_chunks(
+    start_date: str,
+    end_date: str,
+    chunk_days: int = 1,
+    chunk_rows: typing.Optional[int] = None,
+) -> typing.Iterator[pd.DataFrame]:
+    """
+    Format: %Y-%m-%d
+    This function loads the trip data of the specified dates in chunks,
+    one load_data call per `chunk_days` days, each split further into
+    chunks of at most `chunk_rows` rows. Concatenated, the chunks are the
+    rows of load_data(start_date, end_date), as long as the dataset splits
+    date ranges at their boundaries.
+    """
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    while start < end:
+        stop = min(start + timedelta(days=chunk_days), end)
+        df = load_data(start.strftime("%Y-%m-%d"), stop.strftime("%Y-%m-%d"))
+        step = chunk_rows or max(len(df), 1)
+        for i in range(0, len(df), step):
+            yield df.iloc[i : i + step]
+        start = stop
 
 
 # @Cleaning().run(auto_log=True)
+@timer.timed("clean_data")
 def clean_data(
     df: pd.DataFrame, start_date: str = None, end_date: str = None
 ) -> pd.DataFrame:
@@ -42,73 +115,213 @@ def clean_data(
     Returns:
         pd: DataFrame representing the cleaned dataframe
     """
-    df = df[df.fare_amount > 5]  # throw out neglibible fare amounts
+    # Dropoff dates are compared as datetimes: a dropoff's date is at
+    # least start_date iff it is at or after start_date's midnight, and
+    # before end_date iff it is before end_date's midnight
+    mask = df.fare_amount.to_numpy() > 5  # throw out neglibible fare amounts
+    dropoff = df.tpep_dropoff_datetime
     if start_date:
-        df = df[df.tpep_dropoff_datetime.dt.strftime("%Y-%m-%d") >= start_date]
+        mask &= (dropoff >= pd.Timestamp(start_date)).to_numpy()
     if end_date:
-        df = df[df.tpep_dropoff_datetime.dt.strftime("%Y-%m-%d") < end_date]
+        mask &= (dropoff < pd.Timestamp(end_date)).to_numpy()
 
-    clean_df = df.reset_index(drop=True)
+    clean_df = df[mask].reset_index(drop=True)
     return clean_df
 
 
+# Compact dtypes of features that are not float model inputs. Float model
+# inputs stay float64 and integers are only narrowed when exact, so the
+# model's float64 inputs are bit-for-bit unchanged.
+FEATURE_DTYPES = {
+    "pickup_weekday": np.int8,
+    "pickup_hour": np.int8,
+    "pickup_minute": np.int8,
+    "trip_time": np.int32,
+    "trip_speed": np.float32,
+    "loc_code_diffs": np.int16,
+    "PULocationID": np.int16,
+    "DOLocationID": np.int16,
+    "VendorID": np.int8,
+    "tip_fraction": np.float32,
+}
+
+_NS_PER_SECOND = 10**9
+
+
+def _fill(values: np.ndarray, missing: np.ndarray, value: float) -> np.ndarray:
+    """
+    Returns integer values as floats with `value` where missing, like
+    fillna on a column that pandas would have made float by the NaNs.
+    """
+    if not missing.any():
+        return values
+    return np.where(missing, value, values.astype(np.float64))
+
+
+def _compact(values: np.ndarray, dtype) -> np.ndarray:
+    """
+    Casts values to dtype, unless an integer dtype cannot hold them exactly.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in "iu" and values.dtype.kind == "f":
+        info = np.iinfo(dtype)
+        if not (
+            np.all(np.mod(values, 1) == 0)
+            and values.min(initial=0) >= info.min
+            and values.max(initial=0) <= info.max
+        ):
+            return values
+    return values.astype(dtype, copy=False)
+
+
 # @Featuregen().run(input_vars={"df": "customer_label"}, auto_log=True)
+@timer.timed("featurize_data")
 def featurize_data(
-    df: pd.DataFrame, tip_fraction: float = 0.1, imputation_value: float = -1.0
+    df: pd.DataFrame,
+    tip_fraction: float = 0.1,
+    imputation_value: float = -1.0,
+    compact: bool = False,
 ) -> pd.DataFrame:
     """
-    This function constructs features from the dataframe.
+    This function constructs features from the dataframe. With compact,
+    features are stored with FEATURE_DTYPES (e.g. int8 hours) instead of
+    int64 and float64.
     """
     # Compute labels for mltrace
     # customer_label = list(("user_" + df["pulocationid"].astype(str)).unique())
 
-    # Compute pickup features
-    pickup_weekday = df.tpep_pickup_datetime.dt.weekday
-    pickup_hour = df.tpep_pickup_datetime.dt.hour
-    pickup_minute = df.tpep_pickup_datetime.dt.minute
+    # Compute pickup features on nanoseconds since the epoch
+    pickup = df.tpep_pickup_datetime.to_numpy(dtype="datetime64[ns]")
+    dropoff = df.tpep_dropoff_datetime.to_numpy(dtype="datetime64[ns]")
+    pickup_missing = np.isnat(pickup)
+    pickup_ns = pickup.view(np.int64)
+    pickup_seconds = pickup_ns // _NS_PER_SECOND
+    # 1970-01-01 was a Thursday (weekday 3)
+    # Datetime fields are int32, as pandas returns them
+    pickup_weekday = ((pickup_seconds // 86400 + 3) % 7).astype(np.int32)
+    pickup_hour = (pickup_seconds // 3600 % 24).astype(np.int32)
+    pickup_minute = (pickup_seconds // 60 % 60).astype(np.int32)
     work_hours = (
-        (pickup_weekday >= 0)
+        ~pickup_missing
         & (pickup_weekday <= 4)
         & (pickup_hour >= 8)
         & (pickup_hour <= 18)
     )
 
-    # Compute time and speed features
-    trip_time = (df.tpep_dropoff_datetime - df.tpep_pickup_datetime).dt.seconds
-    trip_speed = df.trip_distance / (trip_time + 1e7)
+    # Compute time and speed features. Timedelta.seconds is the seconds
+    # part of the duration, without its days.
+    trip_missing = pickup_missing | np.isnat(dropoff)
+    trip_time = ((dropoff.view(np.int64) - pickup_ns) // _NS_PER_SECOND % 86400).astype(np.int32)
+    trip_time = np.where(trip_missing, np.nan, trip_time) if trip_missing.any() else trip_time
+    trip_distance = df.trip_distance.to_numpy()
+    trip_speed = trip_distance / (trip_time + 1e7)
 
     # Compute label
-    tip_fraction_col = df.tip_amount / df.fare_amount
-
-    # Join all features, identifier, and label
-    features_df = pd.DataFrame(
-        {
-            "tpep_pickup_datetime": df.tpep_pickup_datetime,
-            "pickup_weekday": pickup_weekday,
-            "pickup_hour": pickup_hour,
-            "pickup_minute": pickup_minute,
-            "work_hours": work_hours,
-            "trip_time": trip_time,
-            "trip_speed": trip_speed,
-            "trip_distance": df.trip_distance,
-            "passenger_count": df.passenger_count,
-            "congestion_surcharge": df.congestion_surcharge,
-            "loc_code_diffs": (df.dolocationid - df.pulocationid).abs(),
-            "PULocationID": df.pulocationid,
-            "DOLocationID": df.dolocationid,
-            "RatecodeID": df.ratecodeid,
-            "VendorID": df.vendorid,
-            "tip_amount": df.tip_amount,
-            "fare_amount": df.fare_amount,
-            "tip_fraction": tip_fraction_col,
-            "high_tip_indicator": tip_fraction_col > tip_fraction,
-        }
-    ).fillna(imputation_value)
+    tip_fraction_col = df.tip_amount.to_numpy() / df.fare_amount.to_numpy()
+
+    pu = df.pulocationid.to_numpy()
+    do = df.dolocationid.to_numpy()
+    columns = {
+        "tpep_pickup_datetime": df.tpep_pickup_datetime,
+        "pickup_weekday": _fill(pickup_weekday, pickup_missing, imputation_value),
+        "pickup_hour": _fill(pickup_hour, pickup_missing, imputation_value),
+        "pickup_minute": _fill(pickup_minute, pickup_missing, imputation_value),
+        "work_hours": work_hours,
+        "trip_time": trip_time,
+        "trip_speed": trip_speed,
+        "trip_distance": trip_distance,
+        "passenger_count": df.passenger_count,
+        "congestion_surcharge": df.congestion_surcharge,
+        "loc_code_diffs": np.abs(do - pu),
+        "PULocationID": pu,
+        "DOLocationID": do,
+        "RatecodeID": df.ratecodeid,
+        "VendorID": df.vendorid,
+        "tip_amount": df.tip_amount,
+        "fare_amount": df.fare_amount,
+        "tip_fraction": tip_fraction_col,
+        "high_tip_indicator": tip_fraction_col > tip_fraction,
+    }
+
+    # Join all features, identifier, and label, imputing only the columns
+    # with missing values
+    for name, values in columns.items():
+        if isinstance(values, pd.Series):
+            if values.hasnans:
+                values = values.fillna(imputation_value)
+            values = values.to_numpy()
+        elif values.dtype.kind == "f" and np.isnan(values).any():
+            values = np.where(np.isnan(values), imputation_value, values)
+        if compact and name in FEATURE_DTYPES:
+            values = _compact(values, FEATURE_DTYPES[name])
+        columns[name] = values
+    features_df = pd.DataFrame(columns, index=df.index, copy=False)
 
     return features_df
 
 
+def clean_data_chunks(
+    chunks: typing.Iterable[pd.DataFrame],
+    start_date: str = None,
+    end_date: str = None,
+) -> typing.Iterator[pd.DataFrame]:
+    """
+    This function cleans a stream of chunks with clean_data. The index
+    continues from one chunk to the next, so that the concatenated chunks
+    are identical to clean_data on the whole dataframe. Chunks left empty
+    are skipped.
+    """
+    offset = 0
+    for chunk in chunks:
+        clean_chunk = clean_data(chunk, start_date, end_date)
+        if len(clean_chunk) == 0:
+            continue
+        clean_chunk.index += offset
+        offset += len(clean_chunk)
+        yield clean_chunk
+
+
+def featurize_data_chunks(
+    chunks: typing.Iterable[pd.DataFrame], **kwargs
+) -> typing.Iterator[pd.DataFrame]:
+    """
+    This function featurizes a stream of chunks with featurize_data, which
+    works row by row, so the index of each chunk is kept.
+    """
+    for chunk in chunks:
+        yield featurize_data(chunk, **kwargs)
+
+
+def stream_features(
+    start_date: str,
+    end_date: str,
+    chunk_days: int = 1,
+    chunk_rows: typing.Optional[int] = None,
+    compact: bool = False,
+) -> pd.DataFrame:
+    """
+    Format: %Y-%m-%d
+    This function loads, cleans and featurizes the specified dates chunk by
+    chunk, so that only the features and one chunk of raw data are in
+    memory at once. The result is identical to
+    featurize_data(clean_data(load_data(...), ...), compact=compact).
+    """
+    chunks = featurize_data_chunks(
+        clean_data_chunks(
+            load_data_chunks(start_date, end_date, chunk_days, chunk_rows),
+            start_date,
+            end_date,
+        ),
+        compact=compact,
+    )
+    features = list(chunks)
+    if not features:
+        raise ValueError(f"No data from {start_date} to {end_date}.")
+    return pd.concat(features)
+
+
 # @TrainTestSplit().run(auto_log=True)
+@timer.timed("train_test_split", rows=lambda dfs: sum(len(df) for df in dfs))
 def train_test_split(
     df: pd.DataFrame,
 ) -> typing.Tuple[pd.DataFrame, pd.DataFrame]:
@@ -127,37 +340,236 @@ def train_test_split(
     return train_df, test_df
 
 
-# Score model
-def score(df, model, feature_columns, label_column) -> pd.DataFrame:
-    rounded_preds = model.predict_proba(df[feature_columns].values)[
-        :, 1
-    ].round()
+MODEL_PATH = "model.joblib"
+
+# Loaded models by path, with the identity of the file they were loaded from
+_models = {}
+_models_lock = threading.Lock()
+
+
+def _file_identity(path: str):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def save_model(model, path: str = MODEL_PATH) -> None:
+    """
+    This function saves the model to `path` atomically: it is written to
+    a temporary file in the same directory, which then replaces `path`.
+    Models loaded memory-mapped from the previous file keep reading it.
+    """
+    fd, partial = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+    )
+    os.close(fd)
+    try:
+        # mkstemp creates the file with mode 0600; give it the mode a new
+        # file would get, so other users can still read the model
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(partial, 0o666 & ~umask)
+        dump(model, partial)
+        os.replace(partial, path)
+    except BaseException:
+        os.remove(partial)
+        raise
+
+
+def load_model(path: str = MODEL_PATH, mmap_mode: typing.Optional[str] = "r"):
+    """
+    This function returns the model saved at `path`, or None if there is
+    none. The model is loaded on first use and again only when the file
+    is replaced or changes. With mmap_mode="r", its arrays are
+    memory-mapped read-only, so processes loading the same file share
+    their pages.
+    """
+    identity = _file_identity(path)
+    if identity is None:
+        return None
+    with _models_lock:
+        cached = _models.get(path)
+    if cached and cached[0] == identity:
+        return cached[1]
+    model = load(path, mmap_mode=mmap_mode)
+    with _models_lock:
+        _models[path] = (identity, model)
+    return model
+
+
+def _feature_matrix(df, feature_columns) -> np.ndarray:
+    # The float64 array sklearn would convert the columns to
+    return df[feature_columns].to_numpy(dtype=np.float64)
+
+
+# Process pools for sharded scoring by model path and number of workers,
+# with the identity of the model file their workers loaded
+_scoring_pools = {}
+_scoring_pools_lock = threading.Lock()
+
+# Workers are started by a fork server rather than forked from a process
+# whose other threads may hold locks. The server preloads this module, so
+# workers start with NumPy and sklearn already imported.
+_scoring_context = multiprocessing.get_context("forkserver")
+_scoring_context.set_forkserver_preload([__name__])
+
+# The model of a scoring worker, loaded once when the worker starts
+_worker_model = None
+
+
+def _init_scoring_worker(path: str) -> None:
+    global _worker_model
+    _worker_model = load_model(path)
+    # The workers are the parallelism, so the forest's own threads would
+    # only oversubscribe the cores
+    if getattr(_worker_model, "n_jobs", None) not in (None, 1):
+        _worker_model.set_params(n_jobs=1)
+
+
+def _predict_shard(name: str, shape, dtype: str, start: int, stop: int) -> np.ndarray:
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        rows = np.ndarray(shape, dtype, buffer=block.buf)
+        probabilities = _worker_model.predict_proba(rows[start:stop])[:, 1]
+        # The block cannot be closed while an array uses its buffer
+        del rows
+        return probabilities
+    finally:
+        block.close()
+
+
+def _scoring_pool(path: str, n_jobs: int) -> ProcessPoolExecutor:
+    """
+    This function returns the pool of `n_jobs` workers scoring with the
+    model saved at `path`, starting it on first use and again when the
+    file is replaced.
+    """
+    identity = _file_identity(path)
+    with _scoring_pools_lock:
+        cached = _scoring_pools.get((path, n_jobs))
+        if cached and cached[0] == identity:
+            return cached[1]
+        if cached:
+            cached[1].shutdown()
+        pool = ProcessPoolExecutor(
+            n_jobs,
+            mp_context=_scoring_context,
+            initializer=_init_scoring_worker,
+            initargs=(path,),
+        )
+        _scoring_pools[(path, n_jobs)] = (identity, pool)
+        return pool
+
+
+def shutdown_scoring_pools() -> None:
+    """
+    This function stops the worker pools started by predict_sharded.
+    """
+    with _scoring_pools_lock:
+        pools = [pool for _, pool in _scoring_pools.values()]
+        _scoring_pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+
+def predict_sharded(
+    matrix: np.ndarray,
+    path: str = MODEL_PATH,
+    n_jobs: typing.Optional[int] = None,
+    shard_rows: typing.Optional[int] = None,
+) -> np.ndarray:
+    """
+    This function returns the probabilities of the positive class that
+    the model saved at `path` predicts for the rows of `matrix`, in order.
+    The rows are split into shards of `shard_rows` (by default, one shard
+    per worker) scored on a pool of `n_jobs` processes (by default, or
+    with -1, one per core).
+
+    The pool is kept for later calls, and each worker loads the model once,
+    when it starts. sklearn copies a tree's arrays when it is unpickled, so
+    every worker holds its own copy of the forest. The rows are copied
+    once into a shared memory block that the workers read their shards
+    from, so shards are not pickled; the copy costs one pass over the
+    matrix in memory: about 0.1s for 1M rows of 9 features, a quarter of
+    the time a 10-tree forest takes to score them.
+
+    Like any spawned worker, each worker imports the caller's __main__
+    module, so scripts calling this must keep their side effects under
+    `if __name__ == "__main__":`.
+    """
+    if load_model(path) is None:
+        raise ValueError(f"No model saved at {path}.")
+    n_jobs = os.cpu_count() if not n_jobs or n_jobs < 0 else n_jobs
+    shard_rows = shard_rows or max(1, -(-len(matrix) // n_jobs))
+    if n_jobs == 1 or len(matrix) <= shard_rows:
+        return load_model(path).predict_proba(matrix)[:, 1]
+    starts = range(0, len(matrix), shard_rows)
+    pool = _scoring_pool(path, n_jobs)
+    matrix = np.asarray(matrix)
+    block = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+    try:
+        rows = np.ndarray(matrix.shape, matrix.dtype, buffer=block.buf)
+        rows[:] = matrix
+        del rows
+        return np.concatenate(
+            list(
+                pool.map(
+                    _predict_shard,
+                    itertools.repeat(block.name),
+                    itertools.repeat(matrix.shape),
+                    itertools.repeat(matrix.dtype.str),
+                    starts,
+                    [start + shard_rows for start in starts],
+                )
+            )
+        )
+    finally:
+        block.close()
+        block.unlink()
+
+
+def score_probabilities(labels, probabilities) -> dict:
+    """
+    This function scores predicted probabilities against labels, rounding
+    them at 0.5.
+    """
+    rounded_preds = np.round(probabilities)
     return {
-        "accuracy_score": accuracy_score(
-            df[label_column].values, rounded_preds
-        ),
-        "f1_score": f1_score(df[label_column].values, rounded_preds),
-        "precision_score": precision_score(
-            df[label_column].values, rounded_preds
-        ),
-        "recall_score": recall_score(df[label_column].values, rounded_preds),
+        "accuracy_score": accuracy_score(labels, rounded_preds),
+        "f1_score": f1_score(labels, rounded_preds),
+        "precision_score": precision_score(labels, rounded_preds),
+        "recall_score": recall_score(labels, rounded_preds),
     }
 
 
+# Score model
+def score(df, model, feature_columns, label_column) -> pd.DataFrame:
+    probabilities = model.predict_proba(_feature_matrix(df, feature_columns))[:, 1]
+    return score_probabilities(df[label_column].values, probabilities)
+
+
 # @Training().run(auto_log=True)
 def train_model(
     train_df: pd.DataFrame,
     test_df: pd.DataFrame,
     feature_columns: typing.List[str],
     label_column: str,
+    n_jobs: typing.Optional[int] = None,
 ) -> None:
     """
     This function runs training on the dataframe with the given
-    feature and label columns. The model is saved locally
-    to "model.joblib".
+    feature and label columns, on `n_jobs` cores (-1 for all). The model
+    is saved locally to "model.joblib".
     """
 
-    params = {"max_depth": 4, "n_estimators": 10, "random_state": 42}
+    params = {
+        "max_depth": 4,
+        "n_estimators": 10,
+        "random_state": 42,
+        "n_jobs": n_jobs,
+    }
 
     # Create and train model
     model = RandomForestClassifier(**params)
@@ -185,28 +597,41 @@ def train_model(
     logging.info(feature_importances)
 
     # Save model
-    dump(model, "model.joblib")
+    save_model(model, MODEL_PATH)
 
 
 # @Inference().run(auto_log=True, staleness_threshold=30)
+@timer.timed("inference")
 def inference(
     features_df: pd.DataFrame,
     feature_columns: typing.List[str],
     label_column: str,
-    model=load("model.joblib") if os.path.exists("model.joblib") else None,
+    model=None,
+    n_jobs: int = 1,
 ):
     """
-    This function runs inference on the dataframe.
+    This function runs inference on the dataframe, with `model` or else
+    the model saved by training (see load_model). With n_jobs other than
+    1, the saved model scores the rows on a process pool (see
+    predict_sharded), which pays off for large batches such as backfills.
+    It returns a copy of the dataframe with a "prediction" column, and the
+    scores of the predictions.
     """
+    if n_jobs != 1 and model is not None:
+        raise ValueError("Sharded inference uses the saved model; do not pass one.")
+    model = model if model is not None else load_model()
     if not model:
         raise ValueError("Please run this pipeline in training mode first!")
 
-    # Predict
-    predictions = model.predict_proba(features_df[feature_columns].values)[
-        :, 1
-    ]
-    scores = score(features_df, model, feature_columns, label_column)
-    predictions_df = features_df
+    # Predict once, and score the same probabilities
+    matrix = _feature_matrix(features_df, feature_columns)
+    if n_jobs != 1:
+        predictions = predict_sharded(matrix, MODEL_PATH, n_jobs)
+    else:
+        predictions = model.predict_proba(matrix)[:, 1]
+    scores = score_probabilities(features_df[label_column].values, predictions)
+    # A shallow copy, so the caller's dataframe gets no new column
+    predictions_df = features_df.copy(deep=False)
     predictions_df["prediction"] = predictions
 
     return predictions_df, scores
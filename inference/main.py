@@ -1,19 +1,26 @@
 from components import (
+    RAW_COLUMNS,
     load_data,
     clean_data,
     featurize_data,
     inference,
+    timer,
 )
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
-from multiprocessing import Process
-from prometheus_client import start_http_server
 
 from mext import BinaryClassificationMetric
+from mext import multiprocess
+from mext.exposition import start_http_server
+from mext.features import FeatureDistributionMetric, FeatureReference
+from mext.query import QueryClient
 from mltrace import Task, Metric, clean_db
 
 
+import argparse
 import numpy as np
-import pandas as pd
+import os
 import random
 import requests
 import sklearn
@@ -66,156 +73,279 @@ prom_metric = BinaryClassificationMetric(
     "taxi_data",
     "Binary classification metric for tip prediction",
     ["output_id"],
+    # Windows log 10k rows per batch; workers share prometheus_client Gauges
+    backend="gauge" if multiprocess.is_multiprocess() else "array",
+    instrument=True,
 )
-accuracy_query = prom_metric.get_query_strings()["accuracy"]
+# Reads are timed, so they evaluate at the current time and skip the cache
+query_client = QueryClient("http://example-prometheus:9090", cache_ttl=0)
+# With --read-recorded, the series recorded by monitoring/rules.yml are also
+# read, and timed as prometheus_recorded_read. They lag by up to one rule
+# interval, so the timed metric computation still runs the queries.
+read_recorded = False
+feature_metric = (
+    FeatureDistributionMetric(
+        "taxi_features",
+        "Distribution of the tip prediction features",
+        FeatureReference.load("feature_reference.json"),
+    )
+    if os.path.exists("feature_reference.json")
+    else None
+)
+
+
+# Columns of analysis/timing_df_*.csv, in order
+TIMED_STAGES = [
+    "mltrace_logging",
+    "mltrace_metric_computation",
+    "prometheus_logging",
+    "prometheus_metric_computation",
+    "postgres_metric_computation",
+]
+
+# PROFILE_STAGE=auto profiles the slowest stage with cProfile, and
+# TRACE_MEMORY=1 records each stage's peak memory
+timer.profile = os.environ.get("PROFILE_STAGE")
+timer.trace_memory = os.environ.get("TRACE_MEMORY") == "1"
+
+
+FEATURE_COLUMNS = [
+    "pickup_weekday",
+    "pickup_hour",
+    "pickup_minute",
+    "work_hours",
+    "passenger_count",
+    "trip_distance",
+    "RatecodeID",
+    "congestion_surcharge",
+    "loc_code_diffs",
+]
+LABEL_COLUMN = "high_tip_indicator"
 
 
 def log_predictions_mltrace(predictions, identifiers):
-    task.logOutputs(predictions, identifiers)
+    with timer.stage("mltrace_logging", rows=len(identifiers)):
+        task.logOutputs(predictions, identifiers)
 
 
 def log_predictions_prometheus(predictions, identifiers):
-    prom_metric.logOutputs(predictions, identifiers)
+    with timer.stage("prometheus_logging", rows=len(identifiers)):
+        prom_metric.logOutputs(predictions, identifiers)
 
 
-def log_feedbacks(feedback, identifiers, start_date, end_date):
+def report_mltrace(outputs, feedbacks, identifiers, start_date, end_date):
     # TODO(shreyashankar): add some lag here and run this in the background
     # sleep_time = np.random.normal(loc=3, scale=1, size=1)[0]
     # time.sleep(sleep_time)
-    task.logFeedbacks(feedback, identifiers)
-    prom_metric.logFeedbacks(feedback, identifiers)
+    log_predictions_mltrace(outputs.to_list(), identifiers)
+    with timer.stage("mltrace_logging", rows=len(identifiers)):
+        task.logFeedbacks(feedbacks.to_list(), identifiers)
     print(
-        f"Logged feedback for {len(feedback)} points in the range {start_date} to {end_date}"
+        f"Logged predictions and feedback to mltrace for {len(outputs)} points in the range {start_date} to {end_date}"
     )
 
+    # Postgres metric computation time
+    with timer.stage("postgres_metric_computation"):
+        rolling_accuracy = task.computeMetric(accuracy_score)
+    print(f"Rolling accuracy from postgres: {rolling_accuracy}")
 
-def run_predictions():
-    start_date = datetime(2020, 3, 1)
-    end_date = datetime(2020, 5, 31)
-    mltrace_logging_times = []
-    mltrace_metric_computation_times = []
-    postgres_metric_computation_times = []
-    prometheus_logging_times = []
-    prometheus_metric_computation_times = []
-    start_dates = []
-    end_dates = []
-    num_points = []
-    processes = []
+    # Print rolling score computed by mltrace
+    with timer.stage("mltrace_metric_computation"):
+        rolling_accuracy = task.computeMetrics()
+    print(f"Rolling accuracy from mltrace: {rolling_accuracy}")
 
-    prev_dt = start_date
-    for n in range(2, int((end_date - start_date).days) + 1, 2):
-        curr_dt = start_date + timedelta(n)
 
-        df = load_data(start_date=prev_dt, end_date=curr_dt)
-        df = df.head(10000)
+def report_prometheus(outputs, feedbacks, identifiers, start_date, end_date):
+    log_predictions_prometheus(outputs, identifiers)
+    with timer.stage("prometheus_logging", rows=len(identifiers)):
+        prom_metric.logFeedbacks(feedbacks, identifiers)
+    print(
+        f"Logged predictions and feedback to Prometheus for {len(outputs)} points in the range {start_date} to {end_date}"
+    )
 
-        clean_df = clean_data(
-            df, prev_dt.strftime("%Y-%m-%d"), curr_dt.strftime("%Y-%m-%d")
-        )
-        if len(clean_df) == 0:
-            continue
-        print(
-            f"Running predictions for {len(clean_df)} points in the range {prev_dt} to {curr_dt}"
-        )
-
-        start_dates.append(prev_dt.strftime("%Y-%m-%d"))
-        end_dates.append(curr_dt.strftime("%Y-%m-%d"))
-        num_points.append(len(clean_df))
-        features_df = featurize_data(clean_df)
-
-        feature_columns = [
-            "pickup_weekday",
-            "pickup_hour",
-            "pickup_minute",
-            "work_hours",
-            "passenger_count",
-            "trip_distance",
-            "RatecodeID",
-            "congestion_surcharge",
-            "loc_code_diffs",
+    # Prometheus metric computation time
+    with timer.stage("prometheus_metric_computation"):
+        prometheus_metrics = query_client.latest(prom_metric, end=time.time())
+    print(f"Prometheus metrics: {prometheus_metrics}")
+
+    if read_recorded:
+        with timer.stage("prometheus_recorded_read"):
+            recorded_metrics = query_client.latest(
+                prom_metric, end=time.time(), recorded=True
+            )
+        print(f"Recorded Prometheus metrics: {recorded_metrics}")
+
+
+def load_window(start_date, end_date):
+    """
+    Starts a timing window and loads its data.
+    """
+    window = timer.start_window(
+        start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    )
+    df = load_data(start_date=start_date, end_date=end_date, columns=RAW_COLUMNS)
+    return window, df.head(10000)
+
+
+def predict_window(df, start_date, end_date):
+    """
+    Cleans, featurizes and predicts a window. Returns the predictions,
+    labels, identifiers and number of points, or None if no rows are left
+    after cleaning.
+    """
+    clean_df = clean_data(
+        df, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    )
+    if len(clean_df) == 0:
+        return None
+    print(
+        f"Running predictions for {len(clean_df)} points in the range {start_date} to {end_date}"
+    )
+
+    features_df = featurize_data(clean_df, compact=True)
+    if feature_metric:
+        feature_metric.logFeatures(features_df)
+    predictions, _ = inference(features_df, FEATURE_COLUMNS, LABEL_COLUMN)
+    print("Finished predictions.")
+
+    identifiers = generate_labels(len(predictions))
+    outputs = predictions["prediction"]
+    feedbacks = predictions[LABEL_COLUMN].astype("int")
+    return outputs, feedbacks, identifiers, len(clean_df)
+
+
+def _in_window(window, function, *args):
+    with timer.use_window(window):
+        return function(*args)
+
+
+def report_window(window, result, start_date, end_date, pool=None):
+    """
+    Logs a window's predictions and feedback and reads back the metrics,
+    for mltrace and Prometheus concurrently on `pool` if given, then ends
+    the window.
+    """
+    outputs, feedbacks, identifiers, num_points = result
+    args = (outputs, feedbacks, identifiers, start_date, end_date)
+    if pool:
+        reports = [
+            pool.submit(_in_window, window, report, *args)
+            for report in (report_mltrace, report_prometheus)
         ]
-        label_column = "high_tip_indicator"
-        predictions, _ = inference(features_df, feature_columns, label_column)
-        print("Finished predictions.")
-
-        # Log predictions and feedbacks
-        identifiers = generate_labels(len(predictions))
-        outputs = predictions["prediction"].to_list()
-        feedbacks = predictions["high_tip_indicator"].astype("int").to_list()
-        start = time.time()
-        log_predictions_mltrace(
-            outputs,
-            identifiers,
-        )
-        # multiply by 2 to account for log_feedbacks, which will run
-        # separately with a delay
-        mltrace_logging_times.append((time.time() - start) * 2)
-        start = time.time()
-        log_predictions_prometheus(outputs, identifiers)
-        prometheus_logging_times.append((time.time() - start) * 2)
-        print(
-            f"Logged predictions for {len(outputs)} points in the range {prev_dt} to {curr_dt}"
-        )
-
-        # Log feedback
-        # p = Process(
-        #     target=log_feedbacks,
-        #     args=(feedbacks, identifiers, prev_dt, curr_dt),
-        # )
-        # p.start()
-        # processes.append(p)
-        log_feedbacks(feedbacks, identifiers, prev_dt, curr_dt)
-
-        # TODO (shreyashankar): add prometheus metric computation time
-        start = time.time()
-        response = requests.get(
-            "http://example-prometheus:9090/api/v1/query",
-            params={"query": accuracy_query},
-        )
-        prometheus_metric_computation_times.append(time.time() - start)
-        print(f"Prometheus accuracy: {response.text}")
-
-        # Postgres metric computation time
-        start = time.time()
-        rolling_accuracy = task.computeMetric(accuracy_score)
-        postgres_metric_computation_times.append(time.time() - start)
-        print(f"Rolling accuracy from postgres: {rolling_accuracy}")
+        for report in reports:
+            report.result()
+    else:
+        _in_window(window, report_mltrace, *args)
+        _in_window(window, report_prometheus, *args)
+    timer.end_window(num_points, window)
 
-        # Print rolling score computed by mltrace
-        start = time.time()
-        rolling_accuracy = task.computeMetrics()
-        mltrace_metric_computation_times.append(time.time() - start)
-        print(f"Rolling accuracy from mltrace: {rolling_accuracy}")
 
+def window_ends(start_date, end_date):
+    return [
+        start_date + timedelta(n)
+        for n in range(2, int((end_date - start_date).days) + 1, 2)
+    ]
+
+
+def run_windows(start_date, end_date):
+    prev_dt = start_date
+    for curr_dt in window_ends(start_date, end_date):
+        window, df = load_window(prev_dt, curr_dt)
+        result = predict_window(df, prev_dt, curr_dt)
+        # An empty window is merged into the next one
+        if result is None:
+            continue
+        report_window(window, result, prev_dt, curr_dt)
         prev_dt = curr_dt
 
+
+def run_windows_pipelined(start_date, end_date, max_reports=2):
+    """
+    Runs the windows in three overlapping stages: the next window is loaded
+    on a thread while the current one is predicted, and each window is
+    reported on other threads (mltrace and Prometheus concurrently) while
+    later ones are loaded and predicted. Windows are reported in order, and
+    at most `max_reports` wait to be reported.
+    """
+    ends = window_ends(start_date, end_date)
+    if not ends:
+        return
+    loader = ThreadPoolExecutor(1, thread_name_prefix="load")
+    reporter = ThreadPoolExecutor(1, thread_name_prefix="report")
+    pool = ThreadPoolExecutor(2, thread_name_prefix="report-pool")
+    reports = deque()
+    try:
+        prev_dt = start_date
+        loading = loader.submit(load_window, prev_dt, ends[0])
+        for i, curr_dt in enumerate(ends):
+            window, df = loading.result()
+            # Prefetch the next window, assuming this one is not empty
+            if i + 1 < len(ends):
+                loading = loader.submit(load_window, curr_dt, ends[i + 1])
+            result = _in_window(window, predict_window, df, prev_dt, curr_dt)
+            if result is None:
+                # An empty window is merged into the next one, which is
+                # loaded again from this window's start
+                if i + 1 < len(ends):
+                    loading.result()
+                    loading = loader.submit(load_window, prev_dt, ends[i + 1])
+                continue
+            reports.append(
+                reporter.submit(report_window, window, result, prev_dt, curr_dt, pool)
+            )
+            while len(reports) > max_reports:
+                reports.popleft().result()
+            prev_dt = curr_dt
+        for report in reports:
+            report.result()
+    finally:
+        for executor in (loader, reporter, pool):
+            executor.shutdown(wait=True)
+
+
+def run_predictions(pipelined=False):
+    start_date = datetime(2020, 3, 1)
+    end_date = datetime(2020, 5, 31)
+    if pipelined:
+        run_windows_pipelined(start_date, end_date)
+    else:
+        run_windows(start_date, end_date)
+
     print("Exited loop of inference.")
 
-    # Wait for all threads to finish
-    # for p in processes:
-    #     p.join()
-
-    timing_df = pd.DataFrame(
-        {
-            "start_date": start_dates,
-            "end_date": end_dates,
-            "mltrace_logging_times": mltrace_logging_times,
-            "mltrace_metric_computation_times": mltrace_metric_computation_times,
-            "prometheus_logging_times": prometheus_logging_times,
-            "prometheus_metric_computation_times": prometheus_metric_computation_times,
-            "postgres_metric_computation_times": postgres_metric_computation_times,
-            "num_points": num_points,
-        }
-    )
+    # The pipeline stages (load_data, clean_data, ...) follow num_points
+    timing_df = timer.timing_frame(TIMED_STAGES)
 
     print(timing_df.head(60))
     timing_df.to_csv("timing_df.csv", index=False)
+    print(timer.summary())
+    stats = timer.profile_stats()
+    if stats:
+        stats.sort_stats("cumulative").print_stats(20)
 
 
 if __name__ == "__main__":
-    # Start http server for Prometheus
-    start_http_server(1000)
+    parser = argparse.ArgumentParser(description="Run inference.")
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="Overlap loading, prediction and logging of windows",
+    )
+    parser.add_argument(
+        "--read-recorded",
+        action="store_true",
+        help="Also read the metrics from the recording rules' series",
+    )
+    args = parser.parse_args()
+    read_recorded = args.read_recorded
+
+    # Start http server for Prometheus. With PROMETHEUS_MULTIPROC_DIR set,
+    # one exporter serves the metrics logged by every process.
+    if multiprocess.is_multiprocess():
+        multiprocess.start_http_server(1000)
+    else:
+        start_http_server(1000)
 
     print("Starting inference.")
 
-    run_predictions()
+    run_predictions(args.pipelined)
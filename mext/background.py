@@ -0,0 +1,293 @@
+"""
+background.py
+
+This file contains a front-end that takes logging off the inference
+path: records are queued and logged to an MLMetric in large batches by a
+background thread.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from itertools import chain
+
+import numpy as np
+import prometheus_client as prom
+
+from mext.prometheus_ml_ext import _key_fractions
+
+POLICIES = ("block", "drop_oldest", "sample")
+
+
+def _is_mapping(batch):
+    """
+    Returns True for batches of named columns, i.e. dicts and DataFrames.
+    """
+    return isinstance(batch, dict) or hasattr(batch, "columns")
+
+
+def _concat(parts):
+    """
+    Concatenates batches of values or keys into one batch.
+    """
+    if len(parts) == 1:
+        return parts[0]
+    if _is_mapping(parts[0]):
+        return {name: _concat([p[name] for p in parts]) for name in parts[0].keys()}
+    if all(isinstance(p, np.ndarray) or hasattr(p, "to_numpy") for p in parts):
+        arrays = [np.asarray(p) for p in parts]
+        if all(a.ndim == 1 for a in arrays):
+            return np.concatenate(arrays)
+    return list(chain.from_iterable(parts))
+
+
+def _key_strings(keys):
+    """
+    Converts a batch of keys to strings, or tuples of strings for keys of
+    several values, for _key_fractions.
+    """
+    if isinstance(keys, np.ndarray) or hasattr(keys, "to_numpy"):
+        keys = np.asarray(keys)
+        if keys.ndim == 1:
+            return keys.astype(str).tolist()
+    return [
+        tuple(str(k) for k in key)
+        if isinstance(key, (list, tuple, np.ndarray))
+        else str(key)
+        for key in keys
+    ]
+
+
+def _take(batch, index):
+    if batch is None:
+        return None
+    if _is_mapping(batch):
+        return {name: _take(batch[name], index) for name in batch.keys()}
+    if isinstance(batch, np.ndarray) or hasattr(batch, "to_numpy"):
+        return np.asarray(batch)[index]
+    return [batch[i] for i in index.tolist()]
+
+
+class BackgroundLogger:
+    """
+    Queues logOutput(s)/logFeedback(s) calls for an MLMetric and returns
+    immediately; a daemon thread drains the queue and logs consecutive
+    calls of the same kind as one concatenated batch, so outputs are
+    still logged before feedback queued after them.
+
+    At most `max_records` rows are queued or being logged. When a call
+    does not fit, `policy` decides what happens: "block" waits for the
+    thread to make room, "drop_oldest" drops the oldest queued calls (and
+    the oldest rows of a call that still does not fit), and "sample" keeps
+    the new rows whose keys hash below the fraction that fits, with the
+    same hash as MLMetric's `sample_rate`. Outputs and feedback sampled at
+    the same rate keep the same keys, and at different rates, the keys
+    kept at the lower rate are a subset of those kept at the higher one,
+    so predictions and their labels are mostly kept or dropped together.
+    The thread waits up to `flush_interval` seconds for `batch_size` rows
+    to accumulate.
+
+    Queued arrays and lists are logged as they are when the batch is
+    flushed, so callers must not modify them after logging.
+
+    Exports `<name>_queue_depth`, `<name>_flush_seconds` and
+    `<name>_queue_dropped_total{reason}`.
+    """
+
+    def __init__(
+        self,
+        metric,
+        max_records=1_000_000,
+        policy="block",
+        batch_size=100_000,
+        flush_interval=0.5,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}.")
+        self.metric = metric
+        self.max_records = max_records
+        self.policy = policy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = deque()
+        # Rows queued or being logged, and of those, rows being logged
+        self._records = 0
+        self._inflight = 0
+        self._busy = False
+        self._flushing = False
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self.depth_metric = prom.Gauge(
+            metric.name + "_queue_depth",
+            "Rows waiting in the background logging queue",
+            multiprocess_mode="livesum",
+        )
+        self.flush_metric = prom.Histogram(
+            metric.name + "_flush_seconds",
+            "Time spent logging one batch from the background queue",
+        )
+        self.dropped_metric = prom.Counter(
+            metric.name + "_queue_dropped",
+            "Rows dropped by the background logging queue, by reason",
+            labelnames=["reason"],
+        )
+        for reason in POLICIES[1:] + ("error",):
+            self.dropped_metric.labels(reason)
+
+        self._thread = threading.Thread(
+            target=self._run, name=f"mext-{metric.name}", daemon=True
+        )
+        self._thread.start()
+
+    def logOutput(self, pred, keys, **kwargs):
+        # Wrap each argument as a batch of one, like MLMetric.logOutput:
+        # slices map names to columns, while labels are one value each,
+        # even when given as a dict
+        kwargs = {
+            k: {name: [x] for name, x in v.items()} if k == "slices" else [v]
+            for k, v in kwargs.items()
+            if v is not None
+        }
+        self._put("logOutputs", [pred], [keys], **kwargs)
+
+    def logOutputs(self, preds, keys, **kwargs):
+        self._put("logOutputs", preds, keys, **kwargs)
+
+    def logFeedback(self, true, keys):
+        self._put("logFeedbacks", [true], [keys])
+
+    def logFeedbacks(self, trues, keys):
+        self._put("logFeedbacks", trues, keys)
+
+    def _sample(self, n, room, values, keys, kwargs):
+        fractions = _key_fractions(_key_strings(keys))
+        index = np.flatnonzero(fractions < room / n)
+        # The threshold keeps about `room` rows; the queue keeps at most that
+        if len(index) > room:
+            index = np.sort(index[np.argsort(fractions[index], kind="stable")[:room]])
+        kwargs = {k: _take(v, index) for k, v in kwargs.items()}
+        return _take(values, index), _take(keys, index), kwargs
+
+    def _put(self, method, values, keys, **kwargs):
+        kwargs = {k: v for k, v in kwargs.items() if v is not None}
+        n = len(values)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BackgroundLogger is closed.")
+            room = self.max_records - self._records
+            if n > room and self.policy == "block":
+                # A batch larger than the queue waits for an empty queue
+                while self._records and self._records + n > self.max_records:
+                    self._cond.wait()
+            elif n > room and self.policy == "drop_oldest":
+                while self._queue and self._records + n > self.max_records:
+                    dropped = self._queue.popleft()
+                    self._records -= dropped[3]
+                    self.dropped_metric.labels("drop_oldest").inc(dropped[3])
+                room = max(self.max_records - self._records, 0)
+                if n > room:
+                    # Rows being logged cannot be dropped, so drop the
+                    # oldest rows of this call
+                    self.dropped_metric.labels("drop_oldest").inc(n - room)
+                    if not room:
+                        return
+                    index = np.arange(n - room, n)
+                    values, keys = _take(values, index), _take(keys, index)
+                    kwargs = {k: _take(v, index) for k, v in kwargs.items()}
+                    n = room
+            elif n > room and self.policy == "sample":
+                room = max(room, 0)
+                values, keys, kwargs = self._sample(n, room, values, keys, kwargs)
+                kept = len(values)
+                self.dropped_metric.labels("sample").inc(n - kept)
+                if not kept:
+                    return
+                n = kept
+            self._queue.append((method, values, keys, n, kwargs))
+            self._records += n
+            self.depth_metric.set(self._records - self._inflight)
+            self._cond.notify_all()
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            deadline = time.monotonic() + self.flush_interval
+            while (
+                self._records < self.batch_size
+                and not self._closed
+                and not self._flushing
+            ):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            entries = list(self._queue)
+            self._queue.clear()
+            # The rows count against max_records until they are logged
+            self._inflight = sum(entry[3] for entry in entries)
+            self._busy = bool(entries)
+            self.depth_metric.set(0)
+            return entries
+
+    def _log(self, entries):
+        start = time.perf_counter()
+        # Group consecutive calls of the same kind with the same arguments
+        runs = []
+        for method, values, keys, n, kwargs in entries:
+            kind = (method, tuple(sorted(kwargs)))
+            if not runs or runs[-1][0] != kind:
+                runs.append((kind, []))
+            runs[-1][1].append((values, keys, n, kwargs))
+        for (method, names), calls in runs:
+            n = sum(call[2] for call in calls)
+            try:
+                getattr(self.metric, method)(
+                    _concat([call[0] for call in calls]),
+                    _concat([call[1] for call in calls]),
+                    **{k: _concat([call[3][k] for call in calls]) for k in names},
+                )
+            except Exception:
+                logging.exception(f"Failed to log {n} rows to {self.metric.name}")
+                self.dropped_metric.labels("error").inc(n)
+        self.flush_metric.observe(time.perf_counter() - start)
+
+    def _run(self):
+        while True:
+            entries = self._take_batch()
+            if entries:
+                self._log(entries)
+            with self._cond:
+                self._records -= self._inflight
+                self._inflight = 0
+                self._busy = False
+                self._cond.notify_all()
+                if self._closed and not self._queue:
+                    return
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything queued so far has been logged.
+
+        Returns False if the timeout expired first.
+        """
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+            try:
+                return self._cond.wait_for(
+                    lambda: not self._queue and not self._busy, timeout
+                )
+            finally:
+                self._flushing = False
+
+    def close(self, timeout=None):
+        """
+        Logs everything still queued and stops the background thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
@@ -0,0 +1,458 @@
+"""
+collector.py
+
+This file contains the gauges used for metrics with one series per
+prediction: an array-backed alternative to prometheus_client's labelled
+Gauge, and a prometheus_client Gauge that keeps its exposition text per
+series so that scrapes only re-render what changed.
+"""
+
+import re
+import threading
+
+import numpy as np
+import prometheus_client as prom
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.exposition import generate_latest
+from prometheus_client.utils import floatToGoString
+
+# Series per block of exposition text
+BLOCK_ROWS = 1024
+
+_METRIC_NAME = re.compile(r"^[a-zA-Z_:][a-zA-Z0-9_:]*$")
+_LABEL_NAME = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+
+
+def _escape(value):
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+class _Families:
+    """
+    Exposes metric families the way generate_latest expects a registry.
+    """
+
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+class SeriesText:
+    """
+    The text exposition of a gauge's series, one line per slot, joined in
+    blocks of `block_rows` slots. Only the blocks with a slot updated since
+    the last render are joined again, and a block's version changes with
+    its text, so that exposition caches can reuse its compressed form.
+    Lines match generate_latest's.
+    """
+
+    def __init__(self, name, documentation, labelnames, block_rows=BLOCK_ROWS):
+        if not _METRIC_NAME.match(name) or not all(
+            _LABEL_NAME.match(label) for label in labelnames
+        ):
+            raise ValueError("SeriesText requires legacy metric and label names.")
+        self.name = name
+        # generate_latest sorts labels by name
+        self._order = sorted(range(len(labelnames)), key=list(labelnames).__getitem__)
+        self._labelnames = [labelnames[i] for i in self._order]
+        self.header = generate_latest(
+            _Families([GaugeMetricFamily(name, documentation)])
+        )
+        self.block_rows = block_rows
+        self._lines = []
+        self._blocks = {}
+        self._versions = {}
+        self._next_version = 0
+        self._lock = threading.Lock()
+
+    def _line(self, labelvalues, value):
+        labels = ",".join(
+            f'{name}="{_escape(labelvalues[i])}"'
+            for name, i in zip(self._labelnames, self._order)
+        )
+        labels = f"{{{labels}}}" if labels else ""
+        return f"{self.name}{labels} {floatToGoString(value)}\n".encode()
+
+    def update(self, slots, labelvalues, values, removed=()):
+        """
+        Renders the lines of `slots`, given their label value tuples and
+        values, and clears the lines of the `removed` slots. Returns the
+        blocks, as (block, version, text) tuples in slot order.
+        """
+        with self._lock:
+            lines = self._lines
+            top = max(max(slots, default=-1), max(removed, default=-1)) + 1
+            if top > len(lines):
+                lines.extend([b""] * (top - len(lines)))
+            # Removed slots may be reused by updated series
+            for slot in removed:
+                lines[slot] = b""
+            for slot, lv, value in zip(slots, labelvalues, values):
+                lines[slot] = self._line(lv, value)
+            rows = self.block_rows
+            for block in {slot // rows for slot in slots} | {
+                slot // rows for slot in removed
+            }:
+                text = b"".join(lines[block * rows : (block + 1) * rows])
+                if text == self._blocks.get(block):
+                    continue
+                self._next_version += 1
+                self._blocks[block] = text
+                self._versions[block] = self._next_version
+            return [
+                (block, self._versions[block], self._blocks[block])
+                for block in sorted(self._blocks)
+                if self._blocks[block]
+            ]
+
+
+class TextFamily(GaugeMetricFamily):
+    """
+    A gauge family that carries its rendered text exposition: `header`
+    and `text_blocks`, (block, version, text) tuples from a SeriesText.
+    Its samples are only built when read, by `build`, which yields label
+    value tuples and values.
+    """
+
+    def __init__(self, name, documentation, labelnames, header, text_blocks, build):
+        super().__init__(name, documentation, labels=labelnames)
+        self.header = header
+        self.text_blocks = text_blocks
+        self._build = build
+
+    @property
+    def samples(self):
+        build = getattr(self, "_build", None)
+        if build is not None:
+            self._build = None
+            for labelvalues, value in build():
+                self.add_metric(labelvalues, value)
+        return self._samples
+
+    @samples.setter
+    def samples(self, samples):
+        self._samples = samples
+
+
+class SeriesIndex:
+    """
+    An interned index from label values to array slots, shared by the
+    ArrayGauges of one metric so that a key set stored in several of them
+    (e.g. its prediction and its label) is only held once. Keys are plain
+    strings when there is a single label name, tuples otherwise.
+    """
+
+    def __init__(self, labelnames):
+        self.labelnames = tuple(labelnames)
+        self.single = len(self.labelnames) == 1
+        self.capacity = 1024
+        self._index = {}
+        self._labelvalues = []
+        self._free = []
+        self._gauges = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _keys(self, labelvalues):
+        if self.single:
+            return [lv[0] for lv in labelvalues]
+        return labelvalues
+
+    def _new_slot(self, key):
+        if self._free:
+            slot = self._free.pop()
+            self._labelvalues[slot] = key
+        else:
+            slot = len(self._labelvalues)
+            self._labelvalues.append(key)
+        self._index[key] = slot
+        return slot
+
+    def _slots(self, labelvalues):
+        """
+        Returns the slots for a batch of label value tuples, adding the
+        missing ones. Must be called with the lock held.
+        """
+        index = self._index
+        slots = np.fromiter(
+            (
+                index[key] if key in index else self._new_slot(key)
+                for key in self._keys(labelvalues)
+            ),
+            dtype=np.intp,
+            count=len(labelvalues),
+        )
+        if len(self._labelvalues) > self.capacity:
+            self.capacity = max(2 * self.capacity, len(self._labelvalues))
+            for gauge in self._gauges:
+                gauge._grow(self.capacity)
+        return slots
+
+    def _existing_slots(self, labelvalues):
+        index = self._index
+        return np.fromiter(
+            (index[key] for key in self._keys(labelvalues) if key in index),
+            dtype=np.intp,
+        )
+
+    def _release(self, slots):
+        """
+        Frees the slots that no gauge holds a series in any more. Must be
+        called with the lock held.
+        """
+        for gauge in self._gauges:
+            slots = slots[~gauge._live[slots]]
+        for slot in slots.tolist():
+            del self._index[self._labelvalues[slot]]
+            self._labelvalues[slot] = None
+            self._free.append(slot)
+
+
+class _ArrayGaugeChild:
+    """
+    The series of an ArrayGauge for one set of label values, so that
+    ArrayGauge.labels(...).set(value) works like it does on a prom.Gauge.
+    """
+
+    def __init__(self, gauge, labelvalues):
+        self._gauge = gauge
+        self._labelvalues = labelvalues
+
+    def set(self, value):
+        self._gauge.set_many([value], [self._labelvalues])
+
+
+class ArrayGauge:
+    """
+    A labelled gauge registered as a custom collector.
+
+    A prom.Gauge child is a full Python object with its own lock and value
+    wrapper. Here each series is a slot in a contiguous float64 array, with
+    label values interned in a SeriesIndex. Metric families are only built
+    from the arrays at scrape time, after copying them under the lock, and
+    only the text of the series updated since the last scrape is rendered
+    again (see SeriesText).
+    """
+
+    def __init__(
+        self, name, documentation, labelnames, registry=prom.REGISTRY, index=None
+    ):
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._index = SeriesIndex(labelnames) if index is None else index
+        if self._index.labelnames != self._labelnames:
+            raise ValueError("index labelnames do not match.")
+        self._values = np.empty(self._index.capacity, dtype=np.float64)
+        self._live = np.zeros(self._index.capacity, dtype=bool)
+        self._stale = np.zeros(self._index.capacity, dtype=bool)
+        self._text = SeriesText(name, documentation, self._labelnames)
+        self._lock = self._index._lock
+        with self._lock:
+            self._index._gauges.append(self)
+        if registry:
+            registry.register(self)
+
+    def __len__(self):
+        return int(np.count_nonzero(self._live))
+
+    def _grow(self, size):
+        values = np.empty(size, dtype=np.float64)
+        live = np.zeros(size, dtype=bool)
+        stale = np.zeros(size, dtype=bool)
+        values[: len(self._values)] = self._values
+        live[: len(self._live)] = self._live
+        stale[: len(self._stale)] = self._stale
+        self._values, self._live, self._stale = values, live, stale
+
+    def labels(self, *labelvalues, **labelkwargs):
+        if labelkwargs:
+            labelvalues = tuple(labelkwargs[name] for name in self._labelnames)
+        if len(labelvalues) != len(self._labelnames):
+            raise ValueError("Incorrect label count")
+        return _ArrayGaugeChild(self, tuple(str(lv) for lv in labelvalues))
+
+    def set_many(self, values, labelvalues):
+        """
+        Sets the series for a batch of label value tuples.
+        """
+        with self._lock:
+            slots = self._index._slots(labelvalues)
+            self._values[slots] = values
+            self._live[slots] = True
+            self._stale[slots] = True
+
+    def remove_many(self, labelvalues):
+        """
+        Removes the series for a batch of label value tuples.
+        """
+        with self._lock:
+            slots = self._index._existing_slots(labelvalues)
+            self._live[slots] = False
+            self._stale[slots] = True
+            self._index._release(slots)
+
+    def describe(self):
+        yield GaugeMetricFamily(
+            self._name, self._documentation, labels=self._labelnames
+        )
+
+    def collect(self):
+        with self._lock:
+            used = len(self._index._labelvalues)
+            slots = np.flatnonzero(self._live[:used])
+            values = self._values[slots]
+            labelvalues = self._index._labelvalues[:used]
+            stale = np.flatnonzero(self._stale[:used])
+            self._stale[stale] = False
+            updated = stale[self._live[stale]].tolist()
+            removed = stale[~self._live[stale]].tolist()
+            updated_values = self._values[updated].tolist()
+        single = self._index.single
+        blocks = self._text.update(
+            updated,
+            [(labelvalues[slot],) if single else labelvalues[slot] for slot in updated],
+            updated_values,
+            removed,
+        )
+
+        def build():
+            for slot, value in zip(slots.tolist(), values.tolist()):
+                lv = labelvalues[slot]
+                yield (lv,) if single else lv, value
+
+        yield TextFamily(
+            self._name,
+            self._documentation,
+            self._labelnames,
+            self._text.header,
+            blocks,
+            build,
+        )
+
+
+class TextGauge(prom.Gauge):
+    """
+    A prom.Gauge that keeps the text exposition of its series in a
+    SeriesText. Its children mark their series stale when they are set or
+    incremented, removals mark the removed series, and a scrape renders
+    only the stale series again.
+    """
+
+    def __init__(self, *args, **kwargs):
+        text = kwargs.pop("_text", None)
+        super().__init__(*args, **kwargs)
+        if self._is_parent():
+            text = _GaugeText(self._name, self._documentation, self._labelnames)
+        self._text = text
+        # Children are built with the parent's kwargs, so they share its text
+        self._kwargs["_text"] = text
+
+    def set(self, value):
+        super().set(value)
+        self._text.mark(self._labelvalues)
+
+    def inc(self, amount=1):
+        super().inc(amount)
+        self._text.mark(self._labelvalues)
+
+    def dec(self, amount=1):
+        super().dec(amount)
+        self._text.mark(self._labelvalues)
+
+    def mark_removed(self, labelvalues):
+        """
+        Marks a batch of label value tuples whose children were removed.
+        """
+        self._text.mark_many(labelvalues)
+
+    def remove(self, *labelvalues):
+        super().remove(*labelvalues)
+        self._text.mark(tuple(str(lv) for lv in labelvalues))
+
+    def remove_by_labels(self, labels):
+        with self._lock:
+            before = set(self._metrics)
+        super().remove_by_labels(labels)
+        with self._lock:
+            removed = before - set(self._metrics)
+        self.mark_removed(removed)
+
+    def clear(self):
+        with self._lock:
+            before = list(self._metrics)
+        super().clear()
+        self.mark_removed(before)
+
+    def collect(self):
+        with self._lock:
+            children = dict(self._metrics)
+        blocks = self._text.render(children)
+
+        def build():
+            for lv, child in children.items():
+                yield lv, child._value.get()
+
+        return [
+            TextFamily(
+                self._name,
+                self._documentation,
+                self._labelnames,
+                self._text.header,
+                blocks,
+                build,
+            )
+        ]
+
+
+class _GaugeText:
+    """
+    The stale series and slots of a TextGauge, and their SeriesText.
+    """
+
+    def __init__(self, name, documentation, labelnames):
+        self.text = SeriesText(name, documentation, labelnames)
+        self.header = self.text.header
+        self._slots = {}
+        self._free = []
+        self._stale = set()
+        self._lock = threading.Lock()
+
+    def mark(self, labelvalues):
+        with self._lock:
+            self._stale.add(labelvalues)
+
+    def mark_many(self, labelvalues):
+        with self._lock:
+            self._stale.update(labelvalues)
+
+    def render(self, children):
+        """
+        Renders the stale series, given the gauge's children. Returns the
+        blocks of the SeriesText.
+        """
+        with self._lock:
+            stale, self._stale = self._stale, set()
+            removed = [
+                self._slots.pop(lv)
+                for lv in stale
+                if lv not in children and lv in self._slots
+            ]
+            self._free.extend(removed)
+            slots, labelvalues, values = [], [], []
+            for lv in stale:
+                child = children.get(lv)
+                if child is None:
+                    continue
+                if lv not in self._slots:
+                    self._slots[lv] = (
+                        self._free.pop() if self._free else len(self._slots)
+                    )
+                slots.append(self._slots[lv])
+                labelvalues.append(lv)
+                values.append(child._value.get())
+        return self.text.update(slots, labelvalues, values, removed)
@@ -0,0 +1,97 @@
+"""
+curves.py
+
+This file computes ranking and calibration metrics of a binary classifier
+from per-label histograms of its scores, in O(bins) regardless of how many
+predictions the histograms count.
+
+Each function takes `counts`, an array of shape (2, bins) with the number
+of scores of negative (row 0) and positive (row 1) examples per bin, where
+bin i holds scores in (edges[i], edges[i + 1]].
+"""
+
+import numpy as np
+
+
+def _divide(numerator, denominator):
+    """
+    Elementwise division that returns NaN where the denominator is zero.
+    """
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.full(np.broadcast(numerator, denominator).shape, np.nan),
+        where=denominator != 0,
+    )
+
+
+def _above(counts):
+    """
+    Returns the counts of negatives and positives in bin i or higher, for
+    each bin i, i.e. those predicted positive at threshold edges[i].
+    """
+    return np.cumsum(counts[:, ::-1], axis=1)[:, ::-1]
+
+
+def roc_auc(counts):
+    """
+    Returns the area under the ROC curve. Scores in the same bin count as
+    ties, i.e. half ranked correctly, so with 100 bins this is typically
+    within 1e-3 of sklearn's roc_auc_score.
+    """
+    negatives, positives = counts
+    positives_above = _above(counts)[1]
+    # Positives ranked above each negative, with ties in its own bin halved
+    correct = np.dot(negatives, positives_above - positives / 2)
+    return float(_divide(correct, negatives.sum() * positives.sum()))
+
+
+def threshold_sweep(counts, edges):
+    """
+    Returns accuracy, precision, recall and F1 when predicting positive for
+    scores above each threshold in edges[:-1].
+    """
+    fp, tp = _above(counts)
+    negatives, positives = counts.sum(axis=1)
+    fn = positives - tp
+    tn = negatives - fp
+    return {
+        "threshold": np.asarray(edges[:-1], dtype=np.float64),
+        "accuracy": _divide(tp + tn, negatives + positives),
+        "precision": _divide(tp, tp + fp),
+        "recall": _divide(tp, positives),
+        "f1": _divide(2 * tp, 2 * tp + fp + fn),
+    }
+
+
+def pr_auc(counts):
+    """
+    Returns the area under the precision-recall curve as average precision:
+    precision at each threshold weighted by the recall gained there. Scores in
+    the same bin count as ties, so with 100 bins this is typically a few
+    thousandths below sklearn's average_precision_score.
+    """
+    fp, tp = _above(counts)
+    positives = counts[1].sum()
+    if not positives:
+        return float("nan")
+    recall = tp / positives
+    # Recall gained by lowering the threshold from edges[i + 1] to edges[i]
+    gained = recall - np.append(recall[1:], 0.0)
+    return float(np.nansum(gained * _divide(tp, tp + fp)))
+
+
+def calibration_curve(counts, sums):
+    """
+    Returns the mean score, the fraction of positives and the number of
+    scores in each bin, given the sum of the scores per bin in `sums`
+    (shape (2, bins), like counts). Bins without scores are NaN.
+    """
+    total = counts.sum(axis=0)
+    return {
+        "mean_score": _divide(sums.sum(axis=0), total),
+        "fraction_positive": _divide(counts[1], total),
+        "count": total,
+    }
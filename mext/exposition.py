@@ -0,0 +1,184 @@
+"""
+exposition.py
+
+This file contains an HTTP server for the /metrics endpoint that caches
+the rendered exposition text per block of series, so that scrape cost
+follows the rate of change rather than the total number of series.
+"""
+
+import gzip
+import threading
+import time
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import prometheus_client as prom
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, generate_latest
+
+from mext.collector import _Families
+
+# Functions called after each render of a registry, keyed by registry
+_scrape_hooks = weakref.WeakKeyDictionary()
+_scrape_hooks_lock = threading.Lock()
+
+# The caches' own metrics, registered once per registry
+_cache_metrics = weakref.WeakKeyDictionary()
+_cache_metrics_lock = threading.Lock()
+
+
+def add_scrape_hook(hook, registry=prom.REGISTRY):
+    """
+    Registers a function to call after each ExpositionCache render of
+    `registry`, e.g. to count the scrapes a series has been exposed in.
+    """
+    with _scrape_hooks_lock:
+        _scrape_hooks.setdefault(registry, []).append(hook)
+
+
+def _metrics(registry):
+    """
+    Returns the render time histogram and rendered parts counter in
+    `registry`, registering them on first use.
+    """
+    with _cache_metrics_lock:
+        if registry not in _cache_metrics:
+            _cache_metrics[registry] = (
+                prom.Histogram(
+                    "mext_exposition_render_seconds",
+                    "Time spent rendering the /metrics payload",
+                    registry=registry,
+                ),
+                prom.Counter(
+                    "mext_exposition_rendered_parts",
+                    "Blocks of series and families rendered, by whether their "
+                    "cached text was reused",
+                    labelnames=["cached"],
+                    registry=registry,
+                ),
+            )
+        return _cache_metrics[registry]
+
+
+class ExpositionCache:
+    """
+    Renders a registry to the text exposition format, reusing the text of
+    series that have not changed since the last render.
+
+    Families are read with registry.collect(). The per-key gauges of
+    MLMetrics (TextGauge and ArrayGauge, see mext.collector) yield families
+    that carry their text in blocks of series, and only the blocks with
+    series updated since the last scrape are rendered again. Other
+    families are rendered on every scrape. Each block or family is also
+    compressed as its own gzip member, so only changed parts are
+    recompressed; concatenated members form a valid gzip stream. A payload
+    younger than `min_interval` seconds is served as is. The hooks added
+    with add_scrape_hook run after each render, but not when a cached
+    payload is served.
+
+    The cache's own metrics are registered in `metrics_registry`, which
+    defaults to `registry`. Caches with the same `metrics_registry` share
+    them.
+    """
+
+    def __init__(self, registry=prom.REGISTRY, min_interval=0.0, metrics_registry=None):
+        self.registry = registry
+        metrics_registry = registry if metrics_registry is None else metrics_registry
+        self.min_interval = min_interval
+        self._parts = {}
+        self._payload = b""
+        self._gzipped = b""
+        self._rendered_at = None
+        self._lock = threading.Lock()
+        self.render_time, self.rendered_parts = _metrics(metrics_registry)
+
+    def _part(self, key, version, text):
+        """
+        Returns the (version, text, gzip member) of a part of the payload,
+        reusing the cached member if the part is unchanged.
+        """
+        cached = self._parts.get(key)
+        if cached and cached[0] == version:
+            return cached
+        return (version, text, gzip.compress(text, compresslevel=1))
+
+    def _family_parts(self, family):
+        blocks = getattr(family, "text_blocks", None)
+        if blocks is None:
+            # The text is its own version
+            text = generate_latest(_Families([family]))
+            yield (family.name,), text, text
+            return
+        yield (family.name, "header"), family.header, family.header
+        for block, version, text in blocks:
+            yield (family.name, block), version, text
+
+    def render(self):
+        """
+        Returns the current payload and its gzip-compressed form.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if (
+                self._rendered_at is not None
+                and now - self._rendered_at < self.min_interval
+            ):
+                return self._payload, self._gzipped
+            start = time.perf_counter()
+            parts = {}
+            for family in self.registry.collect():
+                for key, version, text in self._family_parts(family):
+                    parts[key] = self._part(key, version, text)
+            reused = sum(parts[key] is self._parts.get(key) for key in parts)
+            self._parts = parts
+            self._payload = b"".join(text for _, text, _ in parts.values())
+            self._gzipped = b"".join(gz for _, _, gz in parts.values())
+            self._rendered_at = now
+            self.render_time.observe(time.perf_counter() - start)
+            self.rendered_parts.labels("true").inc(reused)
+            self.rendered_parts.labels("false").inc(len(parts) - reused)
+            with _scrape_hooks_lock:
+                hooks = list(_scrape_hooks.get(self.registry, ()))
+            for hook in hooks:
+                hook()
+            return self._payload, self._gzipped
+
+
+def _make_handler(cache):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            payload, gzipped = cache.render()
+            accepts_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+            body = gzipped if accepts_gzip else payload
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+            if accepts_gzip:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            return
+
+    return MetricsHandler
+
+
+def start_http_server(
+    port,
+    addr="0.0.0.0",
+    registry=prom.REGISTRY,
+    min_interval=0.0,
+    metrics_registry=None,
+):
+    """
+    Starts a daemon thread serving the registry's metrics from an
+    ExpositionCache on the given port.
+
+    Returns the server and its thread.
+    """
+    cache = ExpositionCache(registry, min_interval, metrics_registry)
+    httpd = ThreadingHTTPServer((addr, port), _make_handler(cache))
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd, thread
@@ -0,0 +1,313 @@
+"""
+features.py
+
+This file contains a metric for the distribution of a model's input
+features, with drift against a reference captured at training time.
+"""
+
+import json
+import threading
+
+import numpy as np
+import prometheus_client as prom
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from mext.multiprocess import is_multiprocess
+from mext.windows import RollingCounts, parse_duration
+
+OTHER = "other"
+
+# Proportions are floored at this value so empty bins do not make PSI or
+# KL infinite
+EPSILON = 1e-4
+
+
+def _category_names(values):
+    """
+    Returns the category of each value as a string. Integral floats are
+    written as integers, so that a column read as int in one window and as
+    float in another (e.g. once it has missing values) has the same
+    categories.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        names = values.astype(str)
+        integral = np.isfinite(values) & (np.abs(values) < 2**53) & (values % 1 == 0)
+        names[integral] = values[integral].astype(np.int64).astype(str)
+        return names
+    if values.dtype.kind == "O":
+        return np.array(
+            [
+                str(int(v)) if isinstance(v, float) and v.is_integer() else str(v)
+                for v in values.tolist()
+            ],
+            dtype=str,
+        )
+    return values.astype(str)
+
+
+def _is_discrete(values, max_categories):
+    """
+    Returns True for columns to count by category: booleans, and integer
+    or object columns with at most `max_categories` distinct values.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == "b":
+        return True
+    if values.dtype.kind not in "iuO":
+        return False
+    return len(np.unique(_category_names(values))) <= max_categories
+
+
+class FeatureReference:
+    """
+    The bins of each feature and their counts in a reference window,
+    usually the training data.
+
+    Continuous columns are split at quantiles of the reference values into
+    at most `bins` bins; discrete columns get one bin per category (up to
+    `max_categories` most frequent) and one for any other value.
+    """
+
+    def __init__(self, columns):
+        # Each column is a dict with its "kind" ("numeric" or "categorical"),
+        # "edges" (interior bin edges) or "categories", and reference "counts"
+        self.columns = columns
+
+    @property
+    def feature_columns(self):
+        return list(self.columns)
+
+    @classmethod
+    def from_frame(
+        cls, df, feature_columns, categorical=None, bins=10, max_categories=50
+    ):
+        """
+        Captures the reference distribution of `feature_columns` in `df`.
+        Columns in `categorical` are counted by category; other columns are
+        detected as categorical if they are discrete (see _is_discrete).
+        """
+        categorical = set(categorical or [])
+        columns = {}
+        for column in feature_columns:
+            values = df[column].to_numpy()
+            if column in categorical or _is_discrete(values, max_categories):
+                names, counts = np.unique(_category_names(values), return_counts=True)
+                top = np.sort(np.argsort(-counts, kind="stable")[:max_categories])
+                columns[column] = {
+                    "kind": "categorical",
+                    "categories": names[top].tolist(),
+                }
+            else:
+                values = values.astype(np.float64)
+                quantiles = np.linspace(0, 1, bins + 1)[1:-1]
+                columns[column] = {
+                    "kind": "numeric",
+                    "edges": np.unique(
+                        np.nanquantile(values, quantiles)
+                    ).tolist(),
+                }
+        reference = cls(columns)
+        counts = reference.bin_counts(df)
+        for column, spec in columns.items():
+            spec["counts"] = counts[column].tolist()
+        return reference
+
+    def bin_labels(self, column):
+        """
+        Returns the label of each bin of a column: the upper edge of numeric
+        bins, or the category.
+        """
+        spec = self.columns[column]
+        if spec["kind"] == "categorical":
+            return spec["categories"] + [OTHER]
+        return [str(edge) for edge in spec["edges"]] + ["+Inf"]
+
+    def num_bins(self, column):
+        spec = self.columns[column]
+        if spec["kind"] == "categorical":
+            return len(spec["categories"]) + 1
+        return len(spec["edges"]) + 1
+
+    def bin_indices(self, df):
+        """
+        Returns the bin of every value, as an array of shape
+        (rows, columns).
+        """
+        indices = np.empty((len(df), len(self.columns)), dtype=np.intp)
+        for j, (column, spec) in enumerate(self.columns.items()):
+            values = df[column].to_numpy()
+            if spec["kind"] == "categorical":
+                # Only the distinct values are converted and looked up
+                distinct, inverse = np.unique(values, return_inverse=True)
+                lookup = {category: i for i, category in enumerate(spec["categories"])}
+                other = len(lookup)
+                bins = np.array(
+                    [lookup.get(v, other) for v in _category_names(distinct).tolist()],
+                    dtype=np.intp,
+                )
+                indices[:, j] = bins[inverse.ravel()]
+            else:
+                # Bins are (edges[i - 1], edges[i]]; NaNs go to the last bin
+                indices[:, j] = np.searchsorted(
+                    spec["edges"], values.astype(np.float64), side="left"
+                )
+        return indices
+
+    def bin_counts(self, df):
+        """
+        Returns the counts per bin of each column in `df`.
+        """
+        sizes = [self.num_bins(column) for column in self.columns]
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        flat = np.bincount(
+            (self.bin_indices(df) + offsets[:-1]).ravel(), minlength=offsets[-1]
+        )
+        return {
+            column: flat[offsets[j] : offsets[j + 1]]
+            for j, column in enumerate(self.columns)
+        }
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.columns, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+
+def drift(expected, actual):
+    """
+    Returns the population stability index and the KL divergence of the
+    `actual` bin counts from the `expected` ones.
+    """
+    expected = np.maximum(np.asarray(expected, dtype=np.float64), 0)
+    actual = np.asarray(actual, dtype=np.float64)
+    if not expected.sum() or not actual.sum():
+        return float("nan"), float("nan")
+    e = np.maximum(expected / expected.sum(), EPSILON)
+    a = np.maximum(actual / actual.sum(), EPSILON)
+    log_ratio = np.log(a / e)
+    return float(np.sum((a - e) * log_ratio)), float(np.sum(a * log_ratio))
+
+
+class _FeatureCollector:
+    """
+    Exports a FeatureDistributionMetric's bin counts and drift, computed at
+    scrape time.
+    """
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def collect(self):
+        metric = self.metric
+        counts = CounterMetricFamily(
+            metric.name + "_bin_observations",
+            f"{metric.description} (observations per bin)",
+            labels=["feature", "bin"],
+        )
+        for column, column_counts in metric.get_counts().items():
+            labels = metric.reference.bin_labels(column)
+            for label, count in zip(labels, column_counts.tolist()):
+                counts.add_metric([column, label], count)
+        yield counts
+
+        families = {
+            name: GaugeMetricFamily(
+                f"{metric.name}_{name}",
+                f"{metric.description} ({title} against the reference)",
+                labels=["feature", "window"],
+            )
+            for name, title in (("psi", "PSI"), ("kl", "KL divergence"))
+        }
+        for window, values in metric.get_drift().items():
+            for column, (psi, kl) in values.items():
+                families["psi"].add_metric([column, window], psi)
+                families["kl"].add_metric([column, window], kl)
+        yield from families.values()
+
+
+class FeatureDistributionMetric:
+    """
+    Histograms of a model's input features, and their drift from a
+    FeatureReference.
+
+    logFeatures(df) bins every feature column of a window with one
+    bincount. PSI and KL divergence against the reference are exported as
+    `<name>_psi{feature, window}` and `<name>_kl{feature, window}`. The
+    "batch" window is the last logged DataFrame; `windows` (e.g. ["1h"])
+    adds rolling windows. Counts per bin since start are exported as
+    `<name>_bin_observations_total{feature, bin}`.
+    """
+
+    def __init__(self, name, description, reference, windows=None, bucket_seconds=None):
+        if is_multiprocess():
+            raise ValueError(
+                "FeatureDistributionMetric is not supported in multi-process mode."
+            )
+        self.name = name
+        self.description = description
+        self.reference = reference
+        self.windows = list(windows or [])
+        self._columns = reference.feature_columns
+        self._sizes = [reference.num_bins(column) for column in self._columns]
+        self._offsets = np.concatenate([[0], np.cumsum(self._sizes)])
+        self._expected = np.concatenate(
+            [reference.columns[column]["counts"] for column in self._columns]
+        ).astype(np.float64)
+        self._total = np.zeros(self._offsets[-1])
+        self._batch = np.zeros(self._offsets[-1])
+        self._lock = threading.Lock()
+        if self.windows:
+            spans = [parse_duration(window) for window in self.windows]
+            self._rolling = RollingCounts(
+                max(spans), bucket_seconds or min(spans) / 30, self._offsets[-1]
+            )
+        prom.REGISTRY.register(_FeatureCollector(self))
+
+    def logFeatures(self, df):
+        """
+        Adds a window of features to the histograms. df must have all of
+        the reference's feature columns.
+        """
+        counts = np.concatenate(list(self.reference.bin_counts(df).values()))
+        with self._lock:
+            self._total += counts
+            self._batch = counts.astype(np.float64)
+        if self.windows:
+            self._rolling.add(counts)
+
+    def _split(self, flat):
+        return {
+            column: flat[self._offsets[j] : self._offsets[j + 1]]
+            for j, column in enumerate(self._columns)
+        }
+
+    def get_counts(self):
+        """
+        Returns the counts per bin of each feature since start.
+        """
+        with self._lock:
+            return self._split(self._total.copy())
+
+    def get_drift(self, window=None, now=None):
+        """
+        Returns (PSI, KL divergence) per feature for `window`, or a dict of
+        them keyed by window for "batch" and each rolling window if no
+        window is given.
+        """
+        if window is None:
+            return {
+                window: self.get_drift(window, now)
+                for window in ["batch"] + self.windows
+            }
+        if window == "batch":
+            with self._lock:
+                actual = self._batch.copy()
+        else:
+            actual = self._rolling.total(window, now)
+        expected, actual = self._split(self._expected), self._split(actual)
+        return {column: drift(expected[column], actual[column]) for column in self._columns}
@@ -0,0 +1,164 @@
+"""
+join.py
+
+This file contains the buffer that holds outputs (or feedback) waiting
+to be joined with their counterpart, so that delayed labels can be
+matched in-process instead of in PromQL.
+"""
+
+import time
+from collections import OrderedDict
+from itertools import repeat
+
+import numpy as np
+
+
+class JoinBuffer:
+    """
+    Pending records keyed by id.
+
+    Each record is a float value, a row of integer tags (e.g. the index of
+    its aggregate label values) and the time it was added. These live in
+    preallocated NumPy arrays; the only per-record Python object is the
+    key -> slot entry of an insertion-ordered index, which makes lookups
+    O(1) and lets expiry pop the oldest records first.
+
+    Records older than `ttl` seconds are dropped by expire(), and once
+    `capacity` records are pending the oldest one is evicted to make room
+    for each new one.
+    """
+
+    def __init__(self, capacity=1_000_000, ttl=None, num_tags=1):
+        if capacity < 1:
+            raise ValueError("capacity must be positive.")
+        self.capacity = capacity
+        self.ttl = ttl
+        self.num_tags = num_tags
+        self.expired = 0
+        self.evicted = 0
+        self._slots = OrderedDict()
+        self._free = []
+        self._next_slot = 0
+        self._allocate(min(capacity, 1024))
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def _allocate(self, size):
+        """
+        Grows the backing arrays to hold `size` records.
+        """
+        values = np.empty(size, dtype=np.float64)
+        tags = np.empty((size, self.num_tags), dtype=np.int32)
+        times = np.empty(size, dtype=np.float64)
+        if self._next_slot:
+            values[: self._next_slot] = self._values[: self._next_slot]
+            tags[: self._next_slot] = self._tags[: self._next_slot]
+            times[: self._next_slot] = self._times[: self._next_slot]
+        self._values, self._tags, self._times = values, tags, times
+
+    def _take_slots(self, n):
+        """
+        Returns `n` free slots, evicting the oldest records if the buffer
+        would otherwise exceed its capacity.
+        """
+        overflow = len(self._slots) + n - self.capacity
+        for _ in range(max(overflow, 0)):
+            self._free.append(self._slots.popitem(last=False)[1])
+        self.evicted += max(overflow, 0)
+
+        reused = self._free[len(self._free) - min(n, len(self._free)) :]
+        del self._free[len(self._free) - len(reused) :]
+        fresh = n - len(reused)
+        if self._next_slot + fresh > len(self._values):
+            size = len(self._values)
+            while size < self._next_slot + fresh:
+                size *= 2
+            self._allocate(min(size, self.capacity))
+        slots = np.empty(n, dtype=np.intp)
+        slots[: len(reused)] = reused
+        slots[len(reused) :] = np.arange(self._next_slot, self._next_slot + fresh)
+        self._next_slot += fresh
+        return slots
+
+    def put_many(self, keys, values, tags=None, now=None):
+        """
+        Adds a batch of records. A key that is already pending is
+        overwritten and counts as new for expiry.
+
+        Returns the number of older records evicted to stay within capacity.
+        """
+        if len(keys) == 0:
+            return 0
+        now = time.time() if now is None else now
+        evicted = self.evicted
+        values = np.asarray(values)
+        if len(keys) > self.capacity:
+            self.evicted += len(keys) - self.capacity
+            keys = keys[-self.capacity :]
+            values = values[-self.capacity :]
+            tags = None if tags is None else tags[-self.capacity :]
+
+        # Keys already pending give their slot back and are re-added at the
+        # young end of the index
+        slots = self._slots
+        self._free.extend(
+            slot for slot in map(slots.pop, keys, repeat(None)) if slot is not None
+        )
+        batch_slots = self._take_slots(len(keys))
+        pending = len(slots)
+        slots.update(zip(keys, batch_slots.tolist()))
+        if len(slots) - pending < len(keys):
+            self._release_duplicates(keys, batch_slots)
+
+        self._values[batch_slots] = values
+        if tags is not None:
+            self._tags[batch_slots] = tags
+        self._times[batch_slots] = now
+        return self.evicted - evicted
+
+    def _release_duplicates(self, keys, batch_slots):
+        """
+        Frees the slots of keys repeated within one batch; only the slot of
+        each key's last occurrence stays in the index.
+        """
+        used = {self._slots[key] for key in keys}
+        self._free.extend(slot for slot in batch_slots.tolist() if slot not in used)
+
+    def pop_many(self, keys):
+        """
+        Removes the pending records for a batch of keys.
+
+        Returns a boolean mask of the keys that were found, and the values
+        and tags of the found records in key order.
+        """
+        batch_slots = np.fromiter(
+            map(self._slots.pop, keys, repeat(-1)), dtype=np.intp, count=len(keys)
+        )
+        found = batch_slots >= 0
+        batch_slots = batch_slots[found]
+        self._free.extend(batch_slots.tolist())
+        return found, self._values[batch_slots], self._tags[batch_slots]
+
+    def expire(self, now=None):
+        """
+        Drops records older than the buffer's ttl.
+
+        Returns the number of records dropped.
+        """
+        if self.ttl is None:
+            return 0
+        cutoff = (time.time() if now is None else now) - self.ttl
+        slots = self._slots
+        expired = 0
+        while slots:
+            key = next(iter(slots))
+            if self._times[slots[key]] >= cutoff:
+                break
+            self._free.append(slots.pop(key))
+            expired += 1
+        self.expired += expired
+        return expired
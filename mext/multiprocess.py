@@ -0,0 +1,64 @@
+"""
+multiprocess.py
+
+This file contains helpers to log mext metrics from several worker
+processes and export them from a single endpoint, built on
+prometheus_client's multi-process mode.
+
+Multi-process mode is enabled by setting PROMETHEUS_MULTIPROC_DIR to an
+empty directory before prometheus_client is first imported. Workers then
+write every value to memory-mapped files in that directory, and an
+exporter merges the files at scrape time: per-key prediction and label
+gauges keep the most recently written value across workers, and counters
+are summed.
+"""
+
+import os
+
+import prometheus_client as prom
+from prometheus_client import multiprocess, values
+
+from mext import exposition
+
+
+def is_multiprocess():
+    """
+    Returns True if prometheus_client runs in multi-process mode.
+    """
+    return getattr(values.ValueClass, "_multiprocess", False)
+
+
+def multiprocess_registry(path=None):
+    """
+    Returns a registry that merges the metric files written by all workers.
+    """
+    registry = prom.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=path)
+    return registry
+
+
+def start_http_server(port, addr="0.0.0.0", path=None, min_interval=0.0):
+    """
+    Starts the single exporter for all workers' metrics.
+
+    Returns the server and its thread.
+    """
+    if not is_multiprocess():
+        raise ValueError(
+            "PROMETHEUS_MULTIPROC_DIR must be set before prometheus_client is imported."
+        )
+    return exposition.start_http_server(
+        port,
+        addr,
+        multiprocess_registry(path),
+        min_interval,
+        metrics_registry=prom.REGISTRY,
+    )
+
+
+def mark_process_dead(pid=None, path=None):
+    """
+    Removes the live gauge files of an exited worker (by default, the
+    current process). Call it when a worker shuts down.
+    """
+    multiprocess.mark_process_dead(os.getpid() if pid is None else pid, path)
@@ -6,36 +6,530 @@ for users to monitor.
 """
 
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from itertools import repeat
+import functools
+import threading
+import time
 
+import numpy as np
+import pandas as pd
 import prometheus_client as prom
+from prometheus_client.core import (
+    CounterMetricFamily,
+    GaugeMetricFamily,
+    HistogramMetricFamily,
+    Metric,
+)
+from prometheus_client.utils import floatToGoString
+
+from mext import curves, exposition
+from mext.collector import ArrayGauge, SeriesIndex, TextGauge
+from mext.join import JoinBuffer
+from mext.multiprocess import is_multiprocess
+from mext.sketch import DDSketch, WindowedSketch
+from mext.slices import SliceCounter
+from mext.telemetry import Telemetry, timed_collector
+from mext.windows import RollingCounts, parse_duration
+
+OUTCOMES = ("tp", "fp", "tn", "fn")
+EVICTION_REASONS = ("max_series", "max_age", "consumed")
+
+
+def _key_fractions(keys):
+    """
+    Maps join keys (strings or tuples of strings) to fractions in [0, 1)
+    with a fixed hash, so every process samples the same keys.
+    """
+    keys = np.array(
+        [key if isinstance(key, str) else "\x1f".join(key) for key in keys],
+        dtype=object,
+    )
+    hashes = pd.util.hash_array(keys, categorize=False)
+    return (hashes >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def _select(batch, mask):
+    """
+    Returns the rows of a batch (a list, array, Series, or dict or DataFrame
+    of columns) where mask is True.
+    """
+    if batch is None:
+        return None
+    if isinstance(batch, dict) or hasattr(batch, "columns"):
+        return {name: _select(batch[name], mask) for name in batch.keys()}
+    if isinstance(batch, np.ndarray) or hasattr(batch, "to_numpy"):
+        return np.asarray(batch)[mask]
+    return [row for row, keep in zip(batch, mask.tolist()) if keep]
+
+
+def _instrumented(method):
+    """
+    Decorates a batch logging method to observe its latency and batch size
+    when the metric is instrumented.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, values, *args, **kwargs):
+        if not self.instrument:
+            return method(self, values, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(self, values, *args, **kwargs)
+        finally:
+            self.telemetry.observe(
+                method.__name__, time.perf_counter() - start, len(values)
+            )
+
+    return wrapper
+
+
+def _to_list(values):
+    """
+    Converts a list, NumPy array or pandas Series to a list of Python
+    scalars in one pass.
+    """
+    if isinstance(values, list):
+        return values
+    return np.asarray(values).tolist()
+
+
+def _labelvalues(keys, labelnames=None):
+    """
+    Converts a batch of keys to the tuples of strings prometheus_client
+    uses to index labelled children. Keys given as dicts are ordered by
+    `labelnames`.
+    """
+    if isinstance(keys, np.ndarray) or hasattr(keys, "to_numpy"):
+        keys = np.asarray(keys)
+        if keys.ndim == 1:
+            return [(key,) for key in keys.astype(str).tolist()]
+    return [
+        tuple(str(key[name]) for name in labelnames)
+        if isinstance(key, dict)
+        else tuple(str(k) for k in key)
+        if isinstance(key, list) or isinstance(key, tuple)
+        else (str(key),)
+        for key in _to_list(keys)
+    ]
+
+
+def _set_many(metric, values, labelvalues):
+    """
+    Sets the series of `metric` for a batch of labelvalues: in one call for
+    an ArrayGauge, or one child at a time through labels() for a Gauge.
+    """
+    if isinstance(metric, ArrayGauge):
+        metric.set_many(values, labelvalues)
+        return
+    for lv, value in zip(labelvalues, values):
+        metric.labels(*lv).set(value)
+
+
+def _remove_many(metric, labelvalues):
+    """
+    Removes the series of `metric` for a batch of labelvalues.
+    """
+    if isinstance(metric, ArrayGauge):
+        metric.remove_many(labelvalues)
+        return
+    for lv in labelvalues:
+        try:
+            metric.remove(*lv)
+        except KeyError:
+            pass
+
+
+def _safe_ratio(numerator, denominator):
+    return numerator / denominator if denominator else float("nan")
+
+
+def classification_metrics(counts):
+    """
+    Computes accuracy, precision, recall and F1 from tp/fp/tn/fn counts.
+    Metrics with a zero denominator are NaN.
+    """
+    tp, fp, tn, fn = (float(c) for c in counts)
+    precision = _safe_ratio(tp, tp + fp)
+    recall = _safe_ratio(tp, tp + fn)
+    return {
+        "accuracy": _safe_ratio(tp + tn, tp + fp + tn + fn),
+        "precision": precision,
+        "recall": recall,
+        "f1": _safe_ratio(2 * tp, 2 * tp + fp + fn),
+    }
+
+
+class _RollingMetricsCollector:
+    """
+    Exports a metric's rolling-window accuracy, precision, recall and F1,
+    computed at scrape time.
+    """
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def collect(self):
+        family = GaugeMetricFamily(
+            self.metric.rolling_metric_name,
+            f"{self.metric.description} (rolling window)",
+            labels=["metric", "window"],
+        )
+        for window, values in self.metric.get_rolling_metrics().items():
+            for name, value in values.items():
+                family.add_metric([name, window], value)
+        yield family
+
+
+class _ScoreHistogramCollector:
+    """
+    Exports a metric's per-label histograms of joined scores, which may
+    hold weighted counts, as a Prometheus histogram.
+    """
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def collect(self):
+        edges, counts, sums = self.metric.get_score_histograms()
+        # Scores above 1 are counted in the last bin, so +Inf repeats it
+        bounds = [floatToGoString(edge) for edge in edges[1:].tolist()] + ["+Inf"]
+        family = HistogramMetricFamily(
+            self.metric.score_histogram_name,
+            "Scores of joined outputs, by label",
+            labels=["label"],
+        )
+        for label in (0, 1):
+            cumulative = np.cumsum(counts[label]).tolist()
+            cumulative.append(cumulative[-1])
+            family.add_metric(
+                [str(label)], list(zip(bounds, cumulative)), float(sums[label].sum())
+            )
+        yield family
+
+
+class _ScoreSketchCollector:
+    """
+    Exports quantiles of a metric's scores as a summary, computed from its
+    sketches at scrape time.
+    """
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def collect(self):
+        metric = self.metric
+        name = metric.score_metric_name
+        family = Metric(name, f"{metric.description} (score quantiles)", "summary")
+        for window in metric.score_windows or [None]:
+            sketch = metric.get_score_sketch(window)
+            labels = {} if window is None else {"window": window}
+            quantiles = sketch.quantile(metric.score_quantiles)
+            for q, value in zip(metric.score_quantiles, quantiles):
+                family.add_sample(
+                    name, {**labels, "quantile": floatToGoString(q)}, float(value)
+                )
+            family.add_sample(name + "_count", labels, sketch.count)
+            family.add_sample(name + "_sum", labels, sketch.sum)
+        yield family
+
+
+class _SliceCollector:
+    """
+    Exports a metric's per-slice outcome counts for the tracked slice
+    values and the "__other__" bucket.
+    """
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def collect(self):
+        family = CounterMetricFamily(
+            self.metric.slice_metric_name,
+            f"{self.metric.description} (by slice)",
+            labels=["slice", "value", "outcome"],
+        )
+        for counter in self.metric._slices:
+            for value, counts in counter.items():
+                for outcome, count in zip(OUTCOMES, counts.tolist()):
+                    family.add_metric([counter.name, value, outcome], count)
+        yield family
+
+
+class _SeriesCollector:
+    """
+    Exports how many per-key series a metric holds and how many it has
+    evicted.
+    """
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def collect(self):
+        yield GaugeMetricFamily(
+            self.metric.series_metric_name,
+            "Live series per key set",
+            value=self.metric.series_count,
+        )
+        evicted = CounterMetricFamily(
+            self.metric.evicted_metric_name,
+            "Series removed by the eviction policy, by reason",
+            labels=["reason"],
+        )
+        for reason, count in self.metric.evicted.items():
+            evicted.add_metric([reason], count)
+        yield evicted
 
 
 class MLMetric(ABC):
     """
     An abstract class that defines the interface for a metric.
+
+    Per-key series are kept until they are evicted by one of the optional
+    policies: `max_series` keeps only the most recently updated key sets,
+    `max_age` removes key sets not updated for that many seconds, and
+    `remove_after_scrapes` removes a key set once its feedback has been
+    exposed in that many scrapes served by mext.exposition (see
+    on_scrape). With any policy set,
+    `<name>_series` and `<name>_evicted_total{reason}` are exported.
+
+    backend selects how per-key series are stored: "gauge" uses
+    prometheus_client Gauges, "array" uses an ArrayGauge collector that
+    keeps values in NumPy arrays and key sets in one index shared by the
+    metric's gauges, which needs far less memory per series. The "gauge"
+    backend sets one child at a time through labels(), so large batches
+    should be logged with the "array" backend.
+
+    With `sample_rate` below 1, only key sets whose hash falls below the
+    rate are logged. The hash is deterministic, so a prediction and its
+    later feedback are sampled together, in every process.
+
+    With `instrument=True`, the metric exports telemetry about itself (see
+    mext.telemetry.Telemetry). `instrument` can be switched on or off at
+    any time, e.g. to measure the telemetry's overhead.
     """
 
-    def __init__(self, name, description, keys):
+    def __init__(
+        self,
+        name,
+        description,
+        keys,
+        max_series=None,
+        max_age=None,
+        remove_after_scrapes=None,
+        backend="gauge",
+        sample_rate=1.0,
+        instrument=False,
+    ):
+        if backend not in ("gauge", "array"):
+            raise ValueError(f"Unknown backend: {backend!r}")
+        if not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be in (0, 1].")
         self.name = name
         self.description = description
         self.keys = keys
+        self.max_series = max_series
+        self.max_age = max_age
+        self.remove_after_scrapes = remove_after_scrapes
+        self.backend = backend
+        self.sample_rate = sample_rate
+        self.instrument = instrument
+        self.series_metric_name = name + "_series"
+        self.evicted_metric_name = name + "_evicted"
+        self.evicted = dict.fromkeys(EVICTION_REASONS, 0)
+        self._series = OrderedDict()
+        self._consumed = OrderedDict()
+        self._scrapes = 0
+        self._series_lock = threading.Lock()
+        self._telemetry = None
+        self._telemetry_lock = threading.Lock()
+        if is_multiprocess() and (backend == "array" or self._expires_series()):
+            raise ValueError(
+                "The array backend and series eviction are not supported in "
+                "multi-process mode."
+            )
+        if instrument:
+            self.telemetry
         self.create_prometheus_metrics()
+        if self._expires_series():
+            if not self.series_metrics():
+                raise ValueError(f"{type(self).__name__} has no per-key series to evict.")
+            self._register(_SeriesCollector(self))
+            exposition.add_scrape_hook(self.on_scrape)
+
+    @property
+    def telemetry(self):
+        """
+        Returns the metric's Telemetry, created the first time it is used
+        so that `instrument` can be turned on after construction.
+        """
+        if self._telemetry is None:
+            with self._telemetry_lock:
+                if self._telemetry is None:
+                    self._telemetry = Telemetry(self)
+        return self._telemetry
+
+    def _register(self, collector):
+        """
+        Registers one of the metric's collectors, timed while instrumented.
+        """
+        prom.REGISTRY.register(timed_collector(collector, self))
+
+    def _reject(self, reason, count):
+        if self.instrument and count:
+            self.telemetry.reject(reason, count)
+
+    def telemetry_state(self):
+        """
+        Returns the live series, pending records per side, and evicted
+        records per reason, for the metric's telemetry.
+        """
+        with self._series_lock:
+            evicted = dict(self.evicted)
+        return {"series": self.series_count, "pending": {}, "evicted": evicted}
+
+    def _expires_series(self):
+        return (
+            self.max_series is not None
+            or self.max_age is not None
+            or self.remove_after_scrapes is not None
+        )
+
+    def create_gauge(self, name, description):
+        """
+        Creates a gauge with one series per key set in the metric's backend.
+        """
+        if self.backend == "array":
+            if not hasattr(self, "_series_index"):
+                self._series_index = SeriesIndex(self.keys)
+            return ArrayGauge(
+                name, description, self.keys, index=self._series_index
+            )
+        # In multi-process mode, export the value last written by any worker.
+        # Otherwise, keep the text of each series so that scrapes only
+        # render the series updated since the last one.
+        gauge = prom.Gauge if is_multiprocess() else TextGauge
+        return gauge(
+            name,
+            description,
+            labelnames=self.keys,
+            multiprocess_mode="mostrecent",
+        )
+
+    def series_metrics(self):
+        """
+        Returns the prometheus metrics that hold one series per key set.
+        """
+        return []
+
+    @property
+    def series_count(self):
+        """
+        Returns the number of key sets with live series.
+        """
+        if self._expires_series():
+            return len(self._series)
+        if self.backend == "array":
+            return len(self._series_index)
+        return max((len(m._metrics) for m in self.series_metrics()), default=0)
 
-    def log(self, metric, value, keys):
+    def log(self, metric, value, keys, consumed=False):
         """
         Logs a metric to Prometheus.
         """
-        if isinstance(keys, list) or isinstance(keys, tuple):
+        if self.sample_rate < 1:
+            labelvalues = _labelvalues([keys], metric._labelnames)
+            if _key_fractions(labelvalues)[0] >= self.sample_rate:
+                self._reject("sampled_out", 1)
+                return
+        if isinstance(keys, dict):
             metric.labels(**keys).set(value)
+        elif isinstance(keys, list) or isinstance(keys, tuple):
+            metric.labels(*keys).set(value)
         else:
             metric.labels(keys).set(value)
+        if self._expires_series():
+            self._touch(_labelvalues([keys], metric._labelnames), consumed)
 
-    def logBatch(self, metric, values, keys):
+    def logBatch(self, metric, values, keys, consumed=False):
         """
         Logs a batch of metrics to Prometheus.
+
+        values and keys may be lists, NumPy arrays or pandas Series. The
+        array backend sets the whole batch at once. consumed marks the key
+        sets as complete for remove_after_scrapes.
+        """
+        values = _to_list(values)
+        labelvalues = _labelvalues(keys, metric._labelnames)
+        if len(values) != len(labelvalues):
+            raise ValueError("values and keys must have the same length.")
+        if self.sample_rate < 1:
+            keep = _key_fractions(labelvalues) < self.sample_rate
+            self._reject("sampled_out", len(keep) - int(keep.sum()))
+            values = _select(values, keep)
+            labelvalues = _select(labelvalues, keep)
+        _set_many(metric, values, labelvalues)
+        if self._expires_series():
+            self._touch(labelvalues, consumed)
+
+    def _touch(self, labelvalues, consumed):
+        """
+        Records an update of a batch of key sets, then evicts stale ones.
+        """
+        now = time.time()
+        with self._series_lock:
+            # Move updated key sets to the young end of the index
+            for lv in labelvalues:
+                self._series.pop(lv, None)
+            self._series.update(zip(labelvalues, repeat(now)))
+            if consumed:
+                for lv in labelvalues:
+                    self._consumed.pop(lv, None)
+                self._consumed.update(zip(labelvalues, repeat(self._scrapes)))
+        self.evict(now)
+
+    def on_scrape(self):
+        """
+        Counts a scrape for remove_after_scrapes, then evicts stale key
+        sets. mext.exposition calls it after each render of the default
+        registry; call it after each scrape when serving the metrics with
+        another exporter.
+        """
+        with self._series_lock:
+            self._scrapes += 1
+        self.evict()
+
+    def evict(self, now=None):
+        """
+        Removes the series of key sets that are stale under the eviction
+        policies, in bulk.
+
+        Returns the number of key sets removed.
         """
-        for value, key in zip(values, keys):
-            self.log(metric, value, key)
+        now = time.time() if now is None else now
+        stale = {}
+        with self._series_lock:
+            series, consumed = self._series, self._consumed
+            if self.max_age is not None:
+                cutoff = now - self.max_age
+                while series and next(iter(series.values())) < cutoff:
+                    stale[series.popitem(last=False)[0]] = "max_age"
+            if self.max_series is not None:
+                while len(series) > self.max_series:
+                    stale[series.popitem(last=False)[0]] = "max_series"
+            if self.remove_after_scrapes is not None:
+                cutoff = self._scrapes - self.remove_after_scrapes
+                while consumed and next(iter(consumed.values())) <= cutoff:
+                    lv = consumed.popitem(last=False)[0]
+                    series.pop(lv, None)
+                    stale[lv] = "consumed"
+            for lv, reason in stale.items():
+                consumed.pop(lv, None)
+                self.evicted[reason] += 1
+        if stale:
+            for metric in self.series_metrics():
+                _remove_many(metric, stale)
+        return len(stale)
 
     @abstractmethod
     def create_prometheus_metrics(self):
@@ -83,53 +577,640 @@ class MLMetric(ABC):
 class BinaryClassificationMetric(MLMetric):
     """
     A class that represents a binary classification metric.
+
+    By default every output and label is logged as its own Gauge series
+    keyed by `keys`, and the join happens in PromQL. With aggregate=True,
+    outputs and labels are joined in-process instead, and each joined pair
+    increments one of a fixed set of tp/fp/tn/fn counters (optionally
+    partitioned by the low-cardinality `aggregate_labels`), so the number
+    of series no longer grows with the number of predictions.
+
+    Outputs (or labels) waiting for their counterpart are held in a
+    JoinBuffer. Those still unmatched after `join_ttl` seconds, or pushed
+    out once `max_pending` are waiting, are dropped and counted in
+    `<name>_expired_total`. Joins hold a lock, so outputs and feedback may
+    be logged from different threads.
+
+    `rolling_windows` (e.g. ["5m", "1h", "1d"]) additionally keeps joined
+    outcomes in a time-bucketed ring buffer, from which
+    get_rolling_metrics() returns accuracy, precision, recall and F1 per
+    window in O(buckets). They are also exported as
+    `<name>_rolling{metric, window}`.
+
+    `score_quantiles` (e.g. [0.5, 0.9, 0.99]) keeps a DDSketch of the
+    logged scores, accurate to `score_accuracy` relative error, and exports
+    those quantiles as the `<name>_score` summary. With `score_windows`,
+    scores are sketched per time bucket and the summary has one set of
+    quantiles per window; otherwise it covers all scores logged so far.
+
+    `slices` (aggregate mode) names slices such as "PULocationID", whose
+    values are passed to logOutputs. For each slice, outcome counts are
+    kept for the `slice_top_k` most frequent values, tracked with a
+    space-saving heavy-hitter counter, and the rest are rolled into a
+    "__other__" value. They are exported as
+    `<name>_slice_outcomes_total{slice, value, outcome}`, at most len(slices) * (slice_top_k + 1) * 4 series.
+
+    In aggregate mode, `label_sample_rates` (e.g. {0: 0.05, 1: 0.5})
+    stratifies sampling by true label. Outputs are held at the highest of
+    the rates, and a joined pair is counted if its key's hash falls below
+    the rate of its label. Counted pairs are weighted by the inverse of
+    that rate, so the outcome counters (and everything derived from them)
+    estimate the unsampled counts. Without it, `sample_rate` applies to
+    both labels.
+
+    `score_bins` (aggregate mode) keeps a histogram of joined scores per
+    label, in that many equal-width bins over [0, 1], from which ROC-AUC,
+    PR-AUC, a threshold sweep and a calibration curve are computed in
+    O(bins). The histograms are exported as the `<name>_joined_score`
+    Prometheus histogram, labelled by label.
+
+    In the per-key mode, max_series, max_age and remove_after_scrapes set
+    the eviction policy for the prediction and label series (see MLMetric).
+
+    In multi-process mode (see mext.multiprocess), per-key series and
+    outcome counters from all workers are merged by the exporter. The
+    aggregated join runs within each worker, so an output and its feedback
+    must be logged by the same process to be counted.
     """
 
-    def __init__(self, name, description, keys, threshold=0.5):
+    def __init__(
+        self,
+        name,
+        description,
+        keys,
+        threshold=0.5,
+        aggregate=False,
+        aggregate_labels=None,
+        window="5m",
+        join_ttl=None,
+        max_pending=1_000_000,
+        rolling_windows=None,
+        bucket_seconds=None,
+        score_quantiles=None,
+        score_windows=None,
+        score_accuracy=0.01,
+        score_bins=None,
+        slices=None,
+        slice_top_k=20,
+        label_sample_rates=None,
+        **eviction,
+    ):
         self.threshold = threshold
+        self.aggregate = aggregate
+        self.aggregate_labels = list(aggregate_labels or [])
+        if self.aggregate_labels and not aggregate:
+            raise ValueError("aggregate_labels requires aggregate=True.")
+        self.window = window
+        self.join_ttl = join_ttl
+        self.max_pending = max_pending
+        self.rolling_windows = list(rolling_windows or [])
+        if self.rolling_windows and not aggregate:
+            raise ValueError("rolling_windows requires aggregate=True.")
+        if self.rolling_windows and is_multiprocess():
+            raise ValueError("rolling_windows is not supported in multi-process mode.")
+        self.bucket_seconds = bucket_seconds
+        self.score_quantiles = list(score_quantiles or [])
+        self.score_windows = list(score_windows or [])
+        self.score_accuracy = score_accuracy
+        if self.score_windows and not self.score_quantiles:
+            raise ValueError("score_windows requires score_quantiles.")
+        if self.score_quantiles and is_multiprocess():
+            raise ValueError("score_quantiles is not supported in multi-process mode.")
+        self.score_bins = score_bins
+        if score_bins and not aggregate:
+            raise ValueError("score_bins requires aggregate=True.")
+        if score_bins and is_multiprocess():
+            raise ValueError("score_bins is not supported in multi-process mode.")
+        self.slice_names = list(slices or [])
+        self.slice_top_k = slice_top_k
+        if self.slice_names and not aggregate:
+            raise ValueError("slices requires aggregate=True.")
+        if self.slice_names and is_multiprocess():
+            raise ValueError("slices is not supported in multi-process mode.")
+        if label_sample_rates and not aggregate:
+            raise ValueError("label_sample_rates requires aggregate=True.")
+        self.label_sample_rates = label_sample_rates
         self.pred_metric_name = name + "_prediction"
         self.label_metric_name = name + "_label"
-        super().__init__(name, description, keys)
+        self.outcome_metric_name = name + "_outcomes"
+        self.pending_metric_name = name + "_pending"
+        self.expired_metric_name = name + "_expired"
+        self.rolling_metric_name = name + "_rolling"
+        self.score_metric_name = name + "_score"
+        self.score_histogram_name = name + "_joined_score"
+        self.slice_metric_name = name + "_slice_outcomes"
+        super().__init__(name, description, keys, **eviction)
+        if label_sample_rates:
+            rates = [label_sample_rates[0], label_sample_rates[1]]
+            if not all(0 < rate <= 1 for rate in rates):
+                raise ValueError("label_sample_rates must be in (0, 1].")
+        else:
+            rates = [self.sample_rate] * 2
+        self._label_rates = np.array(rates, dtype=np.float64)
 
     def create_prometheus_metrics(self):
-        self.pred_metric = prom.Gauge(
-            self.pred_metric_name, self.description, labelnames=self.keys
+        if self.score_quantiles:
+            self._create_score_sketch()
+        if self.aggregate:
+            self._join_lock = threading.Lock()
+            self._groups = [()] if not self.aggregate_labels else []
+            self._group_index = {(): 0} if not self.aggregate_labels else {}
+            # Outputs are tagged with their group and a ticket per slice
+            self._pending = {
+                "output": JoinBuffer(
+                    self.max_pending, self.join_ttl, 1 + len(self.slice_names)
+                ),
+                "feedback": JoinBuffer(self.max_pending, self.join_ttl, 0),
+            }
+            self.pending_metric = prom.Gauge(
+                self.pending_metric_name,
+                "Records waiting to be joined, by side",
+                labelnames=["side"],
+                multiprocess_mode="livesum",
+            )
+            self.expired_metric = prom.Counter(
+                self.expired_metric_name,
+                "Records dropped before being joined, by side and reason",
+                labelnames=["side", "reason"],
+            )
+            for side in self._pending:
+                self.pending_metric.labels(side)
+                for reason in ("ttl", "capacity"):
+                    self.expired_metric.labels(side, reason)
+            self.outcome_metric = prom.Counter(
+                self.outcome_metric_name,
+                self.description,
+                labelnames=self.aggregate_labels + ["outcome"],
+            )
+            if not self.aggregate_labels:
+                # Export all four outcomes from the start so rate() ratios
+                # are defined before the first join
+                for outcome in OUTCOMES:
+                    self.outcome_metric.labels(outcome)
+            if self.rolling_windows:
+                self._create_rolling_metrics()
+            if self.score_bins:
+                self._create_score_histograms()
+            self._slices = [
+                SliceCounter(name, self.slice_top_k, len(OUTCOMES))
+                for name in self.slice_names
+            ]
+            if self._slices:
+                self._register(_SliceCollector(self))
+            return
+
+        self.pred_metric = self.create_gauge(
+            self.pred_metric_name, self.description
         )
-        self.label_metric = prom.Gauge(
-            self.label_metric_name,
-            self.description,
-            labelnames=self.keys,
+        self.label_metric = self.create_gauge(
+            self.label_metric_name, self.description
         )
 
-    def logOutput(self, pred, keys):
+    def series_metrics(self):
+        if self.aggregate:
+            return []
+        return [self.pred_metric, self.label_metric]
+
+    def _create_rolling_metrics(self):
+        spans = [parse_duration(window) for window in self.rolling_windows]
+        # By default, the shortest window spans 30 buckets
+        bucket_seconds = self.bucket_seconds or min(spans) / 30
+        self._rolling = RollingCounts(max(spans), bucket_seconds, len(OUTCOMES))
+        self._register(_RollingMetricsCollector(self))
+
+    def get_rolling_metrics(self, window=None, now=None):
+        """
+        Returns accuracy, precision, recall and F1 over the last `window`
+        of joined outcomes, or a dict of them keyed by window for each of
+        the metric's rolling_windows if no window is given.
+        """
+        if not self.rolling_windows:
+            raise ValueError("No rolling_windows configured.")
+        if window is None:
+            return {
+                window: self.get_rolling_metrics(window, now)
+                for window in self.rolling_windows
+            }
+        return classification_metrics(self._rolling.total(window, now))
+
+    def _create_score_sketch(self):
+        if self.score_windows:
+            spans = [parse_duration(window) for window in self.score_windows]
+            self._scores = WindowedSketch(
+                max(spans),
+                self.bucket_seconds or min(spans) / 30,
+                relative_accuracy=self.score_accuracy,
+            )
+        else:
+            self._scores = DDSketch(self.score_accuracy)
+        self._score_lock = threading.Lock()
+        self._register(_ScoreSketchCollector(self))
+
+    def _observe_scores(self, preds, weight=None):
+        if not self.score_quantiles:
+            return
+        if self.score_windows:
+            self._scores.add(preds, weight)
+            return
+        with self._score_lock:
+            self._scores.add(preds, weight)
+
+    def get_score_sketch(self, window=None, now=None):
+        """
+        Returns a DDSketch of the scores logged in the last `window`, or of
+        all scores logged if the metric has no score_windows.
+        """
+        if not self.score_quantiles:
+            raise ValueError("No score_quantiles configured.")
+        if self.score_windows:
+            return self._scores.sketch(window or self.score_windows[0], now)
+        with self._score_lock:
+            return self._scores.copy()
+
+    def get_score_quantiles(self, window=None, now=None):
+        """
+        Returns the configured quantiles of the logged scores, or a dict of
+        them keyed by window for each of the metric's score_windows if no
+        window is given.
+        """
+        if self.score_windows and window is None:
+            return {
+                window: self.get_score_quantiles(window, now)
+                for window in self.score_windows
+            }
+        sketch = self.get_score_sketch(window, now)
+        quantiles = sketch.quantile(self.score_quantiles)
+        return {q: float(value) for q, value in zip(self.score_quantiles, quantiles)}
+
+    def _create_score_histograms(self):
+        # i / bins is the float nearest each edge, unlike linspace's i * step
+        # (e.g. 0.30000000000000004), so the `le` labels are exact
+        self._score_edges = np.arange(self.score_bins + 1) / self.score_bins
+        self._score_counts = np.zeros((2, self.score_bins))
+        self._score_sums = np.zeros((2, self.score_bins))
+        self._histogram_lock = threading.Lock()
+        self._register(_ScoreHistogramCollector(self))
+
+    def _add_score_histograms(self, preds, trues, weights=None):
+        """
+        Adds a batch of joined scores to the per-label histograms. Scores
+        outside [0, 1] are counted in the first or last bin.
+        """
+        bins = np.searchsorted(self._score_edges[1:-1], preds, side="left")
+        index = (np.asarray(trues) == 1) * self.score_bins + bins
+        size = 2 * self.score_bins
+        if weights is not None:
+            counts = np.bincount(index, weights=weights, minlength=size)
+            sums = np.bincount(index, weights=preds * weights, minlength=size)
+        else:
+            counts = np.bincount(index, minlength=size)
+            sums = np.bincount(index, weights=preds, minlength=size)
+        counts, sums = counts.reshape(2, -1), sums.reshape(2, -1)
+        with self._histogram_lock:
+            self._score_counts += counts
+            self._score_sums += sums
+
+    def get_score_histograms(self):
+        """
+        Returns the bin edges, and the count and sum of joined scores per
+        label (rows) and bin (columns).
+        """
+        if not self.score_bins:
+            raise ValueError("No score_bins configured.")
+        with self._histogram_lock:
+            return (
+                self._score_edges.copy(),
+                self._score_counts.copy(),
+                self._score_sums.copy(),
+            )
+
+    def get_ranking_metrics(self):
+        """
+        Returns ROC-AUC and PR-AUC (average precision) of the joined scores.
+        """
+        _, counts, _ = self.get_score_histograms()
+        return {"roc_auc": curves.roc_auc(counts), "pr_auc": curves.pr_auc(counts)}
+
+    def get_threshold_sweep(self):
+        """
+        Returns accuracy, precision, recall and F1 at every bin edge used
+        as the threshold.
+        """
+        edges, counts, _ = self.get_score_histograms()
+        return curves.threshold_sweep(counts, edges)
+
+    def get_calibration_curve(self):
+        """
+        Returns the mean score, fraction of positives and count per bin.
+        """
+        _, counts, sums = self.get_score_histograms()
+        return curves.calibration_curve(counts, sums)
+
+    def get_slice_metrics(self, slice_name=None):
+        """
+        Returns accuracy, precision, recall and F1 for each tracked value of
+        a slice and for "__other__", or a dict of them keyed by slice name
+        for every slice if no name is given.
+        """
+        if slice_name is None:
+            return {name: self.get_slice_metrics(name) for name in self.slice_names}
+        if slice_name not in self.slice_names:
+            raise ValueError(f"Unknown slice: {slice_name!r}")
+        counter = self._slices[self.slice_names.index(slice_name)]
+        return {
+            value: classification_metrics(counts) for value, counts in counter.items()
+        }
+
+    def _join_keys(self, keys):
+        """
+        Converts a batch of keys to hashable join keys.
+        """
+        if isinstance(keys, np.ndarray) or hasattr(keys, "to_numpy"):
+            keys = np.asarray(keys)
+            if keys.ndim == 1:
+                return keys.astype(str).tolist()
+            # Rows of a 2-D array or DataFrame join like tuples of keys
+            return [tuple(map(str, row)) for row in keys.tolist()]
+        return [
+            tuple(str(k) for k in key)
+            if isinstance(key, (list, tuple, np.ndarray))
+            else str(key)
+            for key in keys
+        ]
+
+    def _group(self, labels):
+        """
+        Returns the index of the aggregate label values for one output,
+        interning them on first use.
+        """
+        if not self.aggregate_labels:
+            group = ()
+        elif isinstance(labels, dict):
+            group = tuple(str(labels[name]) for name in self.aggregate_labels)
+        elif isinstance(labels, list) or isinstance(labels, tuple):
+            group = tuple(str(label) for label in labels)
+        else:
+            group = (str(labels),)
+        if group not in self._group_index:
+            self._group_index[group] = len(self._groups)
+            self._groups.append(group)
+        return self._group_index[group]
+
+    def _fold(self, preds, trues, tags, weights=None):
+        """
+        Increments the outcome counters for a batch of joined outputs,
+        given their tags: the group index, then a ticket per slice, and
+        optionally a weight per output.
+        """
+        if len(preds) == 0:
+            return
+        groups = tags[:, 0]
+        positive = np.asarray(preds) > self.threshold
+        true = np.asarray(trues) == 1
+        # Outcome indices follow OUTCOMES: tp, fp, tn, fn
+        outcome = np.where(true, np.where(positive, 0, 3), np.where(positive, 1, 2))
+        counts = np.bincount(
+            np.asarray(groups) * len(OUTCOMES) + outcome,
+            weights=weights,
+            minlength=len(self._groups) * len(OUTCOMES),
+        ).reshape(-1, len(OUTCOMES))
+        if self.rolling_windows:
+            self._rolling.add(counts.sum(axis=0))
+        if self.score_bins:
+            self._add_score_histograms(
+                np.asarray(preds, dtype=np.float64), trues, weights
+            )
+        for j, counter in enumerate(self._slices, start=1):
+            counter.add(tags[:, j], outcome, weights)
+        for group, outcome in zip(*np.nonzero(counts)):
+            self.outcome_metric.labels(*self._groups[group], OUTCOMES[outcome]).inc(
+                counts[group, outcome]
+            )
+
+    def _expire(self, side, now=None):
+        buffer = self._pending[side]
+        expired = buffer.expire(now)
+        if expired:
+            self.expired_metric.labels(side, "ttl").inc(expired)
+
+    def _hold(self, side, keys, values, tags=None):
+        evicted = self._pending[side].put_many(keys, values, tags)
+        if evicted:
+            self.expired_metric.labels(side, "capacity").inc(evicted)
+
+    def telemetry_state(self):
+        state = super().telemetry_state()
+        if self.aggregate:
+            state["pending"] = {
+                side: len(buffer) for side, buffer in self._pending.items()
+            }
+            for side in self._pending:
+                for reason in ("ttl", "capacity"):
+                    state["evicted"][f"pending_{side}_{reason}"] = (
+                        self.expired_metric.labels(side, reason)._value.get()
+                    )
+        return state
+
+    def _update_pending(self):
+        for side, buffer in self._pending.items():
+            self.pending_metric.labels(side).set(len(buffer))
+
+    def _sampled(self):
+        return bool(np.any(self._label_rates < 1))
+
+    def _pair_weights(self, fractions, trues):
+        """
+        Returns which joined pairs are sampled, given their key fractions
+        and true labels, and the weights of the sampled ones.
+        """
+        rates = self._label_rates[(np.asarray(trues) == 1).astype(np.intp)]
+        keep = fractions < rates
+        return keep, 1 / rates[keep]
+
+    def _fold_sampled(self, preds, trues, tags, fractions):
+        if fractions is None:
+            self._fold(preds, trues, tags)
+            return
+        keep, weights = self._pair_weights(fractions, trues)
+        # Both records of a pair that is not sampled are dropped
+        self._reject("sampled_out", 2 * (len(keep) - int(keep.sum())))
+        self._fold(preds[keep], trues[keep], tags[keep], weights)
+
+    def _join_outputs(self, preds, keys, labels, slices):
+        # The lookup, pop and insert of a join must not interleave with
+        # the other side's, or an output and its feedback can both be held
+        with self._join_lock:
+            self._expire("feedback")
+            keys = self._join_keys(keys)
+            preds = np.asarray(preds, dtype=np.float64)
+            fractions = None
+            if self._sampled():
+                # Hold outputs at the highest rate; pairs are sampled by label
+                # once joined
+                rate = self._label_rates.max()
+                fractions = _key_fractions(keys)
+                keep = fractions < rate
+                self._reject("sampled_out", len(keep) - int(keep.sum()))
+                keys, preds, labels = _select(keys, keep), preds[keep], _select(labels, keep)
+                slices, fractions = _select(slices, keep), fractions[keep]
+                self._observe_scores(preds, 1 / rate)
+            else:
+                self._observe_scores(preds)
+            if self.aggregate_labels:
+                groups = np.fromiter(
+                    (self._group(label) for label in labels),
+                    dtype=np.int32,
+                    count=len(labels),
+                )
+            else:
+                groups = np.zeros(len(keys), dtype=np.int32)
+            tags = np.empty((len(keys), 1 + len(self._slices)), dtype=np.int32)
+            tags[:, 0] = groups
+            for j, counter in enumerate(self._slices, start=1):
+                tags[:, j] = counter.assign(slices[counter.name])
+            found, trues, _ = self._pending["feedback"].pop_many(keys)
+            self._fold_sampled(
+                preds[found], trues, tags[found], None if fractions is None else fractions[found]
+            )
+            self._hold(
+                "output",
+                [key for key, joined in zip(keys, found) if not joined],
+                preds[~found],
+                tags[~found],
+            )
+            self._update_pending()
+
+    def _join_feedbacks(self, trues, keys):
+        # The lookup, pop and insert of a join must not interleave with
+        # the other side's, or an output and its feedback can both be held
+        with self._join_lock:
+            self._expire("output")
+            keys = self._join_keys(keys)
+            trues = np.asarray(trues, dtype=np.float64)
+            fractions = None
+            if self._sampled():
+                # Outputs are held at the highest rate, so feedback above it
+                # has nothing to join. Feedback below it is held even if its
+                # pair will not be sampled, so that its output is popped.
+                fractions = _key_fractions(keys)
+                keep = fractions < self._label_rates.max()
+                self._reject("sampled_out", len(keep) - int(keep.sum()))
+                keys, trues, fractions = _select(keys, keep), trues[keep], fractions[keep]
+            found, preds, tags = self._pending["output"].pop_many(keys)
+            self._fold_sampled(
+                preds, trues[found], tags, None if fractions is None else fractions[found]
+            )
+            self._hold(
+                "feedback",
+                [key for key, joined in zip(keys, found) if not joined],
+                trues[~found],
+            )
+            self._update_pending()
+
+    def _check_labels(self, preds, labels):
+        if labels is not None and not self.aggregate:
+            raise ValueError("labels are only supported with aggregate=True.")
+        if labels is None:
+            if self.aggregate_labels:
+                raise ValueError(
+                    f"Values for labels {self.aggregate_labels} are required."
+                )
+            return [None] * len(preds)
+        return _to_list(labels)
+
+    def _check_slices(self, slices):
+        if slices is not None and not self.slice_names:
+            raise ValueError("slices were passed but none are configured.")
+        if self.slice_names and slices is None:
+            raise ValueError(f"Values for slices {self.slice_names} are required.")
+
+    def logOutput(self, pred, keys, labels=None, slices=None):
+        if self.aggregate:
+            labels = None if labels is None else [labels]
+            if slices is not None:
+                slices = {name: [value] for name, value in slices.items()}
+            self.logOutputs([pred], [keys], labels, slices)
+            return
+        self._check_labels([pred], labels)
+        self._check_slices(slices)
+        self._observe_scores([pred])
         self.log(self.pred_metric, pred, keys)
 
-    def logOutputs(self, preds, keys):
+    @_instrumented
+    def logOutputs(self, preds, keys, labels=None, slices=None):
+        """
+        Logs a batch of predictions. preds, keys and labels may be lists,
+        NumPy arrays or pandas Series. slices maps each of the metric's
+        slice names to a batch of values, e.g. a DataFrame with those
+        columns.
+        """
+        labels = self._check_labels(preds, labels)
+        self._check_slices(slices)
+        if self.aggregate:
+            self._join_outputs(preds, keys, labels, slices)
+            return
+        self._observe_scores(preds)
         self.logBatch(self.pred_metric, preds, keys)
 
     def _check_label_validity(self, label):
         """
-        Checks if a label is valid.
+        Checks if a label, or every label in an array, is valid.
 
         Returns True if label is 0 or 1.
         """
-        return label == 0 or label == 1
+        label = np.asarray(label)
+        return bool(np.all((label == 0) | (label == 1)))
 
     def logFeedback(self, true, keys):
         assert self._check_label_validity(true), "Label must be 0 or 1."
-        self.log(self.label_metric, true, keys)
+        if self.aggregate:
+            self._join_feedbacks([true], [keys])
+            return
+        self.log(self.label_metric, true, keys, consumed=True)
 
+    @_instrumented
     def logFeedbacks(self, trues, keys):
-        for true in trues:
-            assert self._check_label_validity(true), "Label must be 0 or 1."
-        self.logBatch(self.label_metric, trues, keys)
+        """
+        Logs a batch of true labels. trues and keys may be lists, NumPy
+        arrays or pandas Series; labels are validated in one pass.
+        """
+        trues = np.asarray(trues)
+        valid = self._check_label_validity(trues)
+        if not valid:
+            self._reject("invalid_label", len(trues))
+        assert valid, "Label must be 0 or 1."
+        trues = trues.astype(int)
+        if self.aggregate:
+            self._join_feedbacks(trues, keys)
+            return
+        self.logBatch(self.label_metric, trues, keys, consumed=True)
 
-    def get_query_strings(self):
+    def _get_aggregate_query_strings(self, window):
+        by = (
+            f" by ({','.join(self.aggregate_labels)})"
+            if self.aggregate_labels
+            else ""
+        )
+
+        def rate(outcomes):
+            return f'sum{by} (rate({self.outcome_metric_name}_total{{outcome=~"{outcomes}"}}[{window}]))'
+
+        return {
+            "accuracy": f"{rate('tp|tn')} / {rate('tp|fp|tn|fn')}",
+            "precision": f"{rate('tp')} / {rate('tp|fp')}",
+            "recall": f"{rate('tp')} / {rate('tp|fn')}",
+        }
+
+    def get_query_strings(self, window=None):
         """
         Returns the query strings for the metrics.
 
-        Accuracy, precision, recall
+        Accuracy, precision, recall. In aggregate mode these are ratios of
+        counter rates over `window` (defaults to the metric's window).
         """
+        if self.aggregate:
+            return self._get_aggregate_query_strings(window or self.window)
+
         accuracy_query = f"""
             count(abs({self.label_metric_name} - on ({','.join(self.keys)}) {self.pred_metric_name}) < {self.threshold}) / count({self.label_metric_name} - on ({','.join(self.keys)}) {self.pred_metric_name})
         """
@@ -0,0 +1,197 @@
+"""
+query.py
+
+This file contains a client for reading an MLMetric's queries back from
+the Prometheus HTTP API, over a pooled keep-alive session and with a TTL
+cache of results.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from mext.rules import recorded_queries
+
+# Names starting with "__" are reserved for Prometheus' internal labels
+QUERY_LABEL = "mext_query"
+
+
+def combine_queries(queries):
+    """
+    Combines named queries into one PromQL expression. Each query's series
+    are tagged with its name in the QUERY_LABEL label, so they can be
+    split apart again, and the tagged results are joined with `or`.
+    """
+    return " or ".join(
+        f'label_replace(({query}), "{QUERY_LABEL}", "{name}", "", "")'
+        for name, query in queries.items()
+    )
+
+
+class QueryClient:
+    """
+    Reads query results from a Prometheus server.
+
+    Requests share one requests.Session, so connections are kept alive and
+    reused, and failed connections and 502/503/504 responses are retried
+    up to `retries` times with exponential backoff. Every request has a
+    `timeout` in seconds.
+
+    Results are cached for `cache_ttl` seconds, keyed on the query and its
+    evaluation times, and at most `cache_size` results are kept. With a
+    `cache_ttl` of 0, every call queries the server.
+    """
+
+    def __init__(
+        self,
+        url="http://localhost:9090",
+        timeout=5.0,
+        retries=3,
+        backoff=0.1,
+        cache_ttl=5.0,
+        cache_size=1024,
+        pool_size=4,
+    ):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=("GET", "POST"),
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def _cached(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.cache_ttl:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return entry[1]
+
+    def _store(self, key, result):
+        with self._lock:
+            self._cache[key] = (time.monotonic(), result)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _request(self, path, params):
+        key = (path, tuple(sorted(params.items())))
+        result = self._cached(key) if self.cache_ttl > 0 else None
+        if result is not None:
+            return result
+        # POST keeps long queries out of the URL
+        response = self.session.post(
+            self.url + path, data=params, timeout=self.timeout
+        )
+        try:
+            body = response.json()
+        except ValueError:
+            response.raise_for_status()
+            raise
+        if body.get("status") != "success":
+            raise RuntimeError(
+                f"Prometheus query failed ({response.status_code}): "
+                f"{body.get('errorType')}: {body.get('error')}"
+            )
+        result = body["data"]["result"]
+        if self.cache_ttl > 0:
+            self._store(key, result)
+        return result
+
+    def query(self, query, time=None):
+        """
+        Runs an instant query and returns its result vector.
+        """
+        params = {"query": query}
+        if time is not None:
+            params["time"] = time
+        return self._request("/api/v1/query", params)
+
+    def query_range(self, query, start, end, step):
+        """
+        Runs a range query and returns its result matrix.
+        """
+        return self._request(
+            "/api/v1/query_range",
+            {"query": query, "start": start, "end": end, "step": step},
+        )
+
+    def read(self, metric, start=None, end=None, step=15, window=None, recorded=False):
+        """
+        Evaluates all of a metric's get_query_strings() with one range
+        query from `start` to `end` (Unix seconds) every `step` seconds.
+        With `recorded=True`, the series recorded for them by the rules of
+        mext.rules are read instead, which avoids re-running the joins.
+
+        `end` defaults to now, rounded down to a multiple of `step` so that
+        reads within the same step share a cache entry, and `start`
+        defaults to `end`, giving a single point per series.
+
+        Returns a dict from query name to a list of series, each a dict
+        with the series' labels under "metric" and a list of
+        (timestamp, value) pairs under "values".
+        """
+        if end is None:
+            end = math.floor(time.time() / step) * step
+        if start is None:
+            start = end
+        if recorded:
+            queries = recorded_queries(metric, window)
+        elif window:
+            queries = metric.get_query_strings(window)
+        else:
+            queries = metric.get_query_strings()
+        result = self.query_range(combine_queries(queries), start, end, step)
+
+        series = {name: [] for name in queries}
+        for entry in result:
+            labels = dict(entry["metric"])
+            name = labels.pop(QUERY_LABEL)
+            values = [(float(t), float(v)) for t, v in entry["values"]]
+            series[name].append({"metric": labels, "values": values})
+        return series
+
+    def latest(self, metric, window=None, step=15, end=None, recorded=False):
+        """
+        Returns the most recent value of each of a metric's queries, or None
+        for queries without data. Queries that return several series (e.g.
+        with aggregate labels) map to a list of (labels, value) pairs.
+        `end` and `recorded` are passed to read().
+        """
+        latest = {}
+        series_by_query = self.read(
+            metric, end=end, step=step, window=window, recorded=recorded
+        )
+        for name, series in series_by_query.items():
+            values = [(s["metric"], s["values"][-1][1]) for s in series if s["values"]]
+            if not values:
+                latest[name] = None
+            elif len(values) == 1 and not values[0][0]:
+                latest[name] = values[0][1]
+            else:
+                latest[name] = values
+        return latest
@@ -0,0 +1,135 @@
+"""
+rules.py
+
+This file generates Prometheus recording rules for the queries returned
+by get_query_strings(), and a Grafana dashboard that reads the recorded
+series, so that dashboards and metric reads do not re-run the full
+queries on every refresh.
+"""
+
+import json
+
+from grafanalib._gen import DashboardEncoder
+from grafanalib.core import Dashboard, GridPos, Target, TimeSeries
+
+
+def recorded_name(metric, query, window=None):
+    """
+    Returns the name of the series recorded for one of a metric's queries,
+    following the level:metric:operations naming convention.
+    """
+    if window is None:
+        return f"{metric.name}:{query}"
+    return f"{metric.name}:{query}:rate{window}"
+
+
+def _windows(metric, windows):
+    """
+    Returns the windows to record a metric's queries over. Queries of the
+    per-key mode have no window.
+    """
+    if not getattr(metric, "aggregate", False):
+        return [None]
+    return list(windows or [metric.window])
+
+
+def recorded_queries(metric, window=None):
+    """
+    Returns the names of the series recorded for a metric's queries, keyed
+    by query, to read them instead of evaluating the queries. Aggregated
+    metrics are read over `window` (by default, the metric's own window).
+    """
+    window = _windows(metric, [window] if window else None)[0]
+    return {
+        query: recorded_name(metric, query, window)
+        for query in metric.get_query_strings(window)
+    }
+
+
+def recording_rules(metrics, interval="30s", windows=None):
+    """
+    Returns the recording rules for the metrics' queries as a dict in the
+    layout of a Prometheus rules file, with one group per metric evaluated
+    every `interval`. Aggregated metrics are recorded over each of
+    `windows` (by default, the metric's own window).
+    """
+    groups = []
+    for metric in metrics:
+        rules = []
+        for window in _windows(metric, windows):
+            queries = metric.get_query_strings(window)
+            for query, expr in queries.items():
+                rules.append(
+                    {"record": recorded_name(metric, query, window), "expr": expr}
+                )
+        groups.append(
+            {"name": f"mext_{metric.name}", "interval": interval, "rules": rules}
+        )
+    return {"groups": groups}
+
+
+def write_recording_rules(metrics, path, interval="30s", windows=None):
+    """
+    Writes the metrics' recording rules to a Prometheus rules file.
+    """
+    # Expressions are written as JSON strings, which are valid YAML scalars
+    lines = [
+        "# Generated by mext.rules.write_recording_rules; do not edit.",
+        "groups:",
+    ]
+    for group in recording_rules(metrics, interval, windows)["groups"]:
+        lines.append(f"  - name: {group['name']}")
+        lines.append(f"    interval: {group['interval']}")
+        lines.append("    rules:")
+        for rule in group["rules"]:
+            lines.append(f"      - record: {rule['record']}")
+            lines.append(f"        expr: {json.dumps(rule['expr'])}")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def dashboard(metrics, title="mext", windows=None, datasource="Prometheus"):
+    """
+    Returns a Grafana dashboard with one time series panel per metric and
+    window, plotting the recorded accuracy, precision and recall.
+    """
+    panels = []
+    for metric in metrics:
+        labels = getattr(metric, "aggregate_labels", [])
+        legend = " ".join(f"{{{{{label}}}}}" for label in labels)
+        for window in _windows(metric, windows):
+            targets = [
+                Target(
+                    expr=recorded_name(metric, query, window),
+                    legendFormat=f"{query} {legend}".strip(),
+                    refId=chr(ord("A") + i),
+                )
+                for i, query in enumerate(metric.get_query_strings(window))
+            ]
+            panels.append(
+                TimeSeries(
+                    title=f"{metric.name}" + (f" ({window})" if window else ""),
+                    dataSource=datasource,
+                    targets=targets,
+                    valueMin=0,
+                    valueMax=1,
+                    unit="percentunit",
+                    gridPos=GridPos(h=8, w=12, x=12 * (len(panels) % 2), y=8 * (len(panels) // 2)),
+                )
+            )
+    return Dashboard(title=title, panels=panels).auto_panel_ids()
+
+
+def write_dashboard(metrics, path, title="mext", windows=None, datasource="Prometheus"):
+    """
+    Writes the metrics' dashboard as Grafana dashboard JSON.
+    """
+    with open(path, "w") as f:
+        json.dump(
+            dashboard(metrics, title, windows, datasource).to_json_data(),
+            f,
+            cls=DashboardEncoder,
+            indent=2,
+            sort_keys=True,
+        )
+        f.write("\n")
@@ -0,0 +1,257 @@
+"""
+sketch.py
+
+This file contains a mergeable quantile sketch in the style of DDSketch,
+used to summarize the distribution of a model's scores in bounded memory.
+"""
+
+import math
+import threading
+import time
+
+import numpy as np
+
+from mext.windows import parse_duration
+
+
+class _Store:
+    """
+    Counts per bucket index, in a dense array starting at `offset`. When
+    the indices span more than `max_bins`, the lowest ones are collapsed
+    into the lowest kept bucket.
+    """
+
+    def __init__(self, max_bins):
+        self.max_bins = max_bins
+        self.counts = np.zeros(0, dtype=np.float64)
+        self.offset = 0
+
+    def copy(self):
+        store = _Store(self.max_bins)
+        store.counts = self.counts.copy()
+        store.offset = self.offset
+        return store
+
+    def indices(self):
+        return np.arange(self.offset, self.offset + len(self.counts))
+
+    def _extend(self, lo, hi):
+        if len(self.counts):
+            lo = min(lo, self.offset)
+            hi = max(hi, self.offset + len(self.counts) - 1)
+        lo = max(lo, hi - self.max_bins + 1)
+        counts = np.zeros(hi - lo + 1, dtype=np.float64)
+        if len(self.counts):
+            counts += np.bincount(
+                np.maximum(self.indices(), lo) - lo,
+                weights=self.counts,
+                minlength=len(counts),
+            )
+        self.counts, self.offset = counts, lo
+
+    def add(self, indices, weights=None):
+        if len(indices) == 0:
+            return
+        lo, hi = int(indices.min()), int(indices.max())
+        if (
+            not len(self.counts)
+            or lo < self.offset
+            or hi >= self.offset + len(self.counts)
+        ):
+            self._extend(lo, hi)
+        self.counts += np.bincount(
+            np.maximum(indices, self.offset) - self.offset,
+            weights=weights,
+            minlength=len(self.counts),
+        )
+
+    def merge(self, other):
+        if len(other.counts):
+            self.add(other.indices(), other.counts)
+
+
+class DDSketch:
+    """
+    A quantile sketch with relative accuracy guarantees.
+
+    Values are counted in logarithmically sized buckets, so that any
+    quantile is returned within `relative_accuracy` of the true value.
+    Positive and negative values are kept in separate stores of at most
+    `max_bins` buckets each (beyond that, the buckets of smallest magnitude
+    are collapsed), and values within `min_value` of zero are counted as
+    zero. Sketches with the same parameters can be merged, e.g.
+    to combine the sketches of several workers.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048, min_value=1e-9):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1.")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self._positive = _Store(max_bins)
+        self._negative = _Store(max_bins)
+        self.zero_count = 0.0
+        self.count = 0.0
+        self.sum = 0.0
+
+    def _index(self, values):
+        return np.ceil(np.log(values) / self._log_gamma).astype(np.int64)
+
+    def _value(self, indices):
+        return 2 * np.power(self.gamma, indices) / (self.gamma + 1)
+
+    def add(self, values, weights=None):
+        """
+        Adds a batch of values, optionally with a weight per value.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        weights = (
+            np.ones(len(values))
+            if weights is None
+            else np.broadcast_to(np.asarray(weights, dtype=np.float64), values.shape)
+        )
+        valid = ~np.isnan(values)
+        values, weights = values[valid], weights[valid]
+        positive = values > self.min_value
+        negative = values < -self.min_value
+        self._positive.add(self._index(values[positive]), weights[positive])
+        self._negative.add(self._index(-values[negative]), weights[negative])
+        self.zero_count += float(weights[~(positive | negative)].sum())
+        self.count += float(weights.sum())
+        self.sum += float(np.dot(values, weights))
+
+    def _check_mergeable(self, other):
+        if (other.relative_accuracy, other.min_value) != (
+            self.relative_accuracy,
+            self.min_value,
+        ):
+            raise ValueError("Sketches with different parameters cannot be merged.")
+
+    def merge(self, other):
+        """
+        Adds the values counted by another sketch to this one.
+        """
+        self._check_mergeable(other)
+        self._positive.merge(other._positive)
+        self._negative.merge(other._negative)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+
+    def copy(self):
+        sketch = DDSketch(self.relative_accuracy, self.max_bins, self.min_value)
+        sketch._positive = self._positive.copy()
+        sketch._negative = self._negative.copy()
+        sketch.zero_count, sketch.count, sketch.sum = (
+            self.zero_count,
+            self.count,
+            self.sum,
+        )
+        return sketch
+
+    def quantile(self, q):
+        """
+        Returns the value at quantile `q`, or an array of values for an
+        array of quantiles. Returns NaN if the sketch is empty.
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)[()]
+        # Buckets in increasing order of value
+        values = np.concatenate(
+            [
+                -self._value(self._negative.indices()[::-1]),
+                [0.0],
+                self._value(self._positive.indices()),
+            ]
+        )
+        counts = np.concatenate(
+            [self._negative.counts[::-1], [self.zero_count], self._positive.counts]
+        )
+        rank = np.clip(q, 0, 1) * (self.count - 1)
+        index = np.searchsorted(np.cumsum(counts), rank, side="right")
+        return values[np.minimum(index, len(values) - 1)][()]
+
+    def to_dict(self):
+        """
+        Returns the sketch as a JSON-serializable dict, e.g. to send it to
+        the process that merges the sketches of all workers.
+        """
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "max_bins": self.max_bins,
+            "min_value": self.min_value,
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "positive": [self._positive.offset, self._positive.counts.tolist()],
+            "negative": [self._negative.offset, self._negative.counts.tolist()],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"], data["max_bins"], data["min_value"])
+        for store, (offset, counts) in (
+            (sketch._positive, data["positive"]),
+            (sketch._negative, data["negative"]),
+        ):
+            store.offset = offset
+            store.counts = np.asarray(counts, dtype=np.float64)
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        return sketch
+
+
+class WindowedSketch:
+    """
+    DDSketches of values added over time, one per fixed-width time bucket
+    in a ring, like RollingCounts. The sketch of a window merges the
+    buckets it covers, so memory is bounded by the number of buckets.
+    Windows are aligned to bucket boundaries, so a window includes up to
+    one bucket's worth of older values.
+    """
+
+    def __init__(self, span, bucket_seconds, **sketch_args):
+        self.span = parse_duration(span)
+        self.bucket_seconds = parse_duration(bucket_seconds)
+        self.num_buckets = int(math.ceil(self.span / self.bucket_seconds)) + 1
+        self._sketch_args = sketch_args
+        self._sketches = [None] * self.num_buckets
+        self._buckets = np.full(self.num_buckets, -1, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def _bucket(self, now):
+        return int((time.time() if now is None else now) // self.bucket_seconds)
+
+    def add(self, values, weights=None, now=None):
+        """
+        Adds a batch of values to the bucket for time `now`.
+        """
+        bucket = self._bucket(now)
+        slot = bucket % self.num_buckets
+        with self._lock:
+            if self._buckets[slot] != bucket:
+                self._buckets[slot] = bucket
+                self._sketches[slot] = DDSketch(**self._sketch_args)
+            self._sketches[slot].add(values, weights)
+
+    def sketch(self, window, now=None):
+        """
+        Returns a sketch of the values added in the last `window` seconds.
+        """
+        window = parse_duration(window)
+        if window > self.span:
+            raise ValueError(f"Window {window}s exceeds span {self.span}s.")
+        bucket = self._bucket(now)
+        oldest = bucket - int(math.ceil(window / self.bucket_seconds))
+        merged = DDSketch(**self._sketch_args)
+        with self._lock:
+            for slot in np.flatnonzero(
+                (self._buckets > oldest) & (self._buckets <= bucket)
+            ):
+                merged.merge(self._sketches[slot])
+        return merged
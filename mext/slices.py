@@ -0,0 +1,166 @@
+"""
+slices.py
+
+This file contains the heavy-hitter tracking behind per-slice metrics:
+confusion counts are kept for the most frequent values of a slice (e.g.
+PULocationID), and the long tail is rolled into an OTHER bucket.
+"""
+
+import threading
+
+import numpy as np
+
+# Value of the bucket for untracked values, named so that it does not
+# collide with a real slice value such as "other"
+OTHER = "__other__"
+
+# Tickets wrap around so that they fit in JoinBuffer's int32 tags
+_MAX_TICKET = 2**31 - 1
+
+
+class SpaceSaving:
+    """
+    The space-saving heavy-hitter algorithm over `k` counters.
+
+    Every value with a frequency above N / k (for N values seen) is kept,
+    with an estimated count that overestimates the true one by at most its
+    recorded error. A value that is not tracked replaces the one with the
+    lowest count. Batches are folded in by distinct value, new values in
+    decreasing order of frequency.
+
+    Each admission of a value to a counter gets a new ticket, so that
+    records tagged with a ticket can later be checked against the counter
+    still holding the same value.
+    """
+
+    def __init__(self, k):
+        if k < 1:
+            raise ValueError("k must be positive.")
+        self.k = k
+        self.values = [None] * k
+        self.counts = np.zeros(k, dtype=np.float64)
+        self.errors = np.zeros(k, dtype=np.float64)
+        self.tickets = np.full(k, -1, dtype=np.int64)
+        self._index = {}
+        self._next_ticket = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def _admit(self, slot, value, count, error):
+        if self.values[slot] is not None:
+            del self._index[self.values[slot]]
+        self.values[slot] = value
+        self._index[value] = slot
+        self.counts[slot] = count
+        self.errors[slot] = error
+        self.tickets[slot] = self._next_ticket
+        self._next_ticket = (self._next_ticket + 1) % _MAX_TICKET
+
+    def update(self, values):
+        """
+        Counts a batch of values.
+
+        Returns the ticket of each value's counter after the update (-1 for
+        values not tracked), and the counters whose value was replaced.
+        """
+        distinct, inverse, frequencies = np.unique(
+            np.asarray(values).astype(str), return_inverse=True, return_counts=True
+        )
+        distinct = distinct.tolist()
+        new = []
+        for i, value in enumerate(distinct):
+            slot = self._index.get(value)
+            if slot is None:
+                new.append(i)
+            else:
+                self.counts[slot] += frequencies[i]
+
+        replaced = []
+        free = self.k - len(self._index)
+        for i in sorted(new, key=lambda i: -frequencies[i]):
+            if free:
+                slot = self.values.index(None)
+                self._admit(slot, distinct[i], frequencies[i], 0.0)
+                free -= 1
+                continue
+            slot = int(np.argmin(self.counts))
+            replaced.append(slot)
+            minimum = self.counts[slot]
+            self._admit(slot, distinct[i], minimum + frequencies[i], minimum)
+
+        tickets = np.array(
+            [
+                self.tickets[self._index[value]] if value in self._index else -1
+                for value in distinct
+            ],
+            dtype=np.int64,
+        )
+        return tickets[inverse.ravel()], replaced
+
+    def slots(self, tickets):
+        """
+        Returns the counter holding each ticket's value, or k for tickets
+        whose value has since been replaced.
+        """
+        tickets = np.asarray(tickets, dtype=np.int64)
+        order = np.argsort(self.tickets)
+        live = self.tickets[order]
+        position = np.minimum(np.searchsorted(live, tickets), self.k - 1)
+        held = (live[position] == tickets) & (tickets >= 0)
+        return np.where(held, order[position], self.k)
+
+
+class SliceCounter:
+    """
+    Confusion counts (tp/fp/tn/fn) per value of one slice, kept exactly for
+    the `k` most frequent values and in a shared OTHER bucket for the
+    rest.
+
+    Values are tracked with SpaceSaving. Counts for a value start when it
+    enters the top k; when it is replaced, its counts move to OTHER.
+    """
+
+    def __init__(self, name, k, width):
+        self.name = name
+        self.tracker = SpaceSaving(k)
+        self.counts = np.zeros((k + 1, width), dtype=np.float64)
+        self._lock = threading.Lock()
+
+    def assign(self, values):
+        """
+        Counts a batch of slice values and returns the tickets to tag their
+        records with.
+        """
+        with self._lock:
+            tickets, replaced = self.tracker.update(values)
+            for slot in replaced:
+                self.counts[-1] += self.counts[slot]
+                self.counts[slot] = 0
+        return tickets
+
+    def add(self, tickets, outcomes, weights=None):
+        """
+        Adds a batch of outcome indices for records tagged with `tickets`,
+        optionally weighted.
+        """
+        width = self.counts.shape[1]
+        with self._lock:
+            slots = self.tracker.slots(tickets)
+            self.counts += np.bincount(
+                slots * width + outcomes, weights=weights, minlength=self.counts.size
+            ).reshape(self.counts.shape)
+
+    def items(self):
+        """
+        Returns (value, counts) pairs for the tracked values and OTHER.
+        """
+        with self._lock:
+            values = list(self.tracker.values)
+            counts = self.counts.copy()
+        items = [
+            (value, counts[slot])
+            for slot, value in enumerate(values)
+            if value is not None
+        ]
+        return items + [(OTHER, counts[-1])]
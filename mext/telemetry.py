@@ -0,0 +1,170 @@
+"""
+telemetry.py
+
+This file contains the metrics mext exports about itself: how long its
+logging calls take and how large their batches are, how much state each
+metric holds, and how long its collectors take to render at scrape time.
+"""
+
+import threading
+import time
+
+import prometheus_client as prom
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from mext.multiprocess import is_multiprocess
+
+CALLS = ("logOutputs", "logFeedbacks")
+REJECT_REASONS = ("sampled_out", "invalid_label")
+
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, float("inf"),
+)
+BATCH_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000, float("inf"))
+
+# Families shared by the instrumented metrics of each registry, which are
+# told apart by a "metric" label
+_families = {}
+_families_lock = threading.Lock()
+
+
+def _shared_families(registry):
+    with _families_lock:
+        if registry not in _families:
+            _families[registry] = {
+                "latency": prom.Histogram(
+                    "mext_log_seconds",
+                    "Time spent in mext logging calls",
+                    labelnames=["metric", "call"],
+                    buckets=LATENCY_BUCKETS,
+                    registry=registry,
+                ),
+                "batch_size": prom.Histogram(
+                    "mext_log_batch_size",
+                    "Records per mext logging call",
+                    labelnames=["metric", "call"],
+                    buckets=BATCH_BUCKETS,
+                    registry=registry,
+                ),
+                "rejected": prom.Counter(
+                    "mext_rejected_records",
+                    "Records not logged, by reason",
+                    labelnames=["metric", "reason"],
+                    registry=registry,
+                ),
+                "collect": prom.Histogram(
+                    "mext_collect_seconds",
+                    "Time spent rendering a mext collector at scrape time",
+                    labelnames=["metric", "collector"],
+                    buckets=LATENCY_BUCKETS,
+                    registry=registry,
+                ),
+                "state": _StateCollector(),
+            }
+            if not is_multiprocess():
+                registry.register(_families[registry]["state"])
+        return _families[registry]
+
+
+class _StateCollector:
+    """
+    Exports the state the instrumented MLMetrics of a registry hold, read
+    at scrape time so that it costs nothing while logging.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def collect(self):
+        series = GaugeMetricFamily(
+            "mext_series", "Live per-key series", labels=["metric"]
+        )
+        pending = GaugeMetricFamily(
+            "mext_pending",
+            "Records waiting to be joined, by side",
+            labels=["metric", "side"],
+        )
+        evicted = CounterMetricFamily(
+            "mext_evicted_records",
+            "Series and pending records evicted, by reason",
+            labels=["metric", "reason"],
+        )
+        for metric in list(self.metrics):
+            if not metric.instrument:
+                continue
+            state = metric.telemetry_state()
+            series.add_metric([metric.name], state["series"])
+            for side, count in state["pending"].items():
+                pending.add_metric([metric.name, side], count)
+            for reason, count in state["evicted"].items():
+                evicted.add_metric([metric.name, reason], count)
+        return [series, pending, evicted]
+
+
+class _TimedCollector:
+    """
+    Wraps a collector of an MLMetric to observe how long it takes to
+    render while the metric is instrumented.
+    """
+
+    def __init__(self, collector, metric):
+        self.collector = collector
+        self.metric = metric
+        self.name = type(collector).__name__.strip("_")
+
+    def collect(self):
+        if not self.metric.instrument:
+            return self.collector.collect()
+        start = time.perf_counter()
+        families = list(self.collector.collect())
+        self.metric.telemetry.observe_collect(self.name, time.perf_counter() - start)
+        return families
+
+
+def timed_collector(collector, metric):
+    """
+    Returns a collector of `metric` wrapped to time its renders whenever
+    the metric is instrumented.
+    """
+    return _TimedCollector(collector, metric)
+
+
+class Telemetry:
+    """
+    The self-instrumentation of one MLMetric.
+
+    Logging calls are observed in `mext_log_seconds{metric, call}` and
+    `mext_log_batch_size{metric, call}`, and records that are not logged
+    are counted in `mext_rejected_records_total{metric, reason}`. The
+    metric's collectors are timed in `mext_collect_seconds{metric,
+    collector}`. `mext_series{metric}`, `mext_pending{metric, side}` and
+    `mext_evicted_records_total{metric, reason}` are read from the metric
+    at scrape time, in single-process mode only.
+    """
+
+    def __init__(self, metric, registry=prom.REGISTRY):
+        self.metric = metric
+        families = _shared_families(registry)
+        self._latency = {
+            call: families["latency"].labels(metric.name, call) for call in CALLS
+        }
+        self._batch_size = {
+            call: families["batch_size"].labels(metric.name, call) for call in CALLS
+        }
+        self._rejected = {
+            reason: families["rejected"].labels(metric.name, reason)
+            for reason in REJECT_REASONS
+        }
+        self._collect = families["collect"]
+        families["state"].metrics.append(metric)
+
+    def observe(self, call, seconds, size):
+        self._latency[call].observe(seconds)
+        self._batch_size[call].observe(size)
+
+    def reject(self, reason, count):
+        self._rejected[reason].inc(count)
+
+    def observe_collect(self, collector, seconds):
+        self._collect.labels(self.metric.name, collector).observe(seconds)
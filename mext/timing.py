@@ -0,0 +1,378 @@
+"""
+timing.py
+
+This file contains a timer for the stages of a pipeline (loading,
+cleaning, featurizing, inference, logging): wall and CPU time, rows and
+peak memory per run of a stage, exported as Prometheus histograms and as
+the timing CSV format of analysis/.
+"""
+
+import cProfile
+import functools
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+import pandas as pd
+import prometheus_client as prom
+
+SECONDS_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0, float("inf"),
+)
+ROWS_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, float("inf"))
+BYTES_BUCKETS = tuple(2.0**i for i in range(16, 36, 2)) + (float("inf"),)
+
+TIMING_INDEX = ["start_date", "end_date"]
+
+
+def _count_rows(result):
+    """
+    Returns the number of rows of a stage's result: the length of a
+    DataFrame, Series, array or list, or of the first item of a tuple.
+    """
+    if isinstance(result, tuple):
+        return _count_rows(result[0]) if result else None
+    if hasattr(result, "__len__") and not isinstance(result, (str, dict)):
+        return len(result)
+    return None
+
+
+class _Run:
+    """
+    One run of a stage. `rows` may be set inside the `with` block.
+    """
+
+    def __init__(self, stage, window, rows):
+        self.stage = stage
+        self.window = window
+        self.rows = rows
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_bytes = None
+
+    def as_dict(self):
+        return {
+            "stage": self.stage,
+            "window": self.window,
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "rows": self.rows,
+            "peak_bytes": self.peak_bytes,
+        }
+
+
+class StageTimer:
+    """
+    Times named stages of a pipeline.
+
+    `timer.stage("clean_data", rows=len(df))` is a context manager and
+    `@timer.timed("clean_data")` a decorator, which takes the rows from the
+    length of the result. Each run records wall time, CPU time of its
+    thread and rows, and with `trace_memory=True`, the peak memory
+    allocated during the run, measured with tracemalloc (which slows
+    allocation-heavy code down, so it is off by default). tracemalloc's
+    peak covers the whole process, so runs that overlap another run, in
+    another thread or nested, record no peak.
+
+    Runs are exported in `registry` (None to disable) as
+    `<name>_stage_seconds{stage, clock}` with clock "wall" or "cpu",
+    `<name>_stage_rows{stage}` and `<name>_stage_peak_bytes{stage}`.
+
+    Runs between start_window() and end_window() are grouped into one row
+    of timing_frame(), in the format of analysis/timing_df_*.csv. The
+    current window is per thread; use_window() sets it in worker threads.
+
+    With `profile="auto"`, each run of the stage with the most wall time so
+    far is profiled with cProfile; with a stage name, that stage is. Each
+    thread profiles into its own profile, and nested runs are not profiled.
+    profile_stats() returns the accumulated profile.
+
+    runs_frame() keeps the last `max_runs` runs; summary() and
+    timing_frame() are kept up to date as runs are recorded, so they cover
+    every run.
+    """
+
+    def __init__(
+        self,
+        name="pipeline",
+        registry=prom.REGISTRY,
+        trace_memory=False,
+        profile=None,
+        max_runs=10_000,
+    ):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self._runs = deque(maxlen=max_runs)
+        self._stats = {}
+        self._windows = []
+        self._local = threading.local()
+        self._profiles = {}
+        # Runs in progress, and runs started so far, to detect overlaps
+        self._active = 0
+        self._started = 0
+        self._lock = threading.Lock()
+        self._histograms = None
+        if registry is not None:
+            self._histograms = {
+                "seconds": prom.Histogram(
+                    name + "_stage_seconds",
+                    "Time spent per run of a pipeline stage",
+                    labelnames=["stage", "clock"],
+                    buckets=SECONDS_BUCKETS,
+                    registry=registry,
+                ),
+                "rows": prom.Histogram(
+                    name + "_stage_rows",
+                    "Rows processed per run of a pipeline stage",
+                    labelnames=["stage"],
+                    buckets=ROWS_BUCKETS,
+                    registry=registry,
+                ),
+                "peak_bytes": prom.Histogram(
+                    name + "_stage_peak_bytes",
+                    "Peak memory allocated per run of a pipeline stage",
+                    labelnames=["stage"],
+                    buckets=BYTES_BUCKETS,
+                    registry=registry,
+                ),
+            }
+
+    @property
+    def _window(self):
+        return getattr(self._local, "window", None)
+
+    def start_window(self, start_date, end_date):
+        """
+        Starts a window (e.g. a batch of inference); later runs in this
+        thread belong to it. Returns the window.
+        """
+        with self._lock:
+            self._windows.append(
+                {
+                    "start_date": start_date,
+                    "end_date": end_date,
+                    "num_points": None,
+                    "stages": {},
+                }
+            )
+            self._local.window = len(self._windows) - 1
+            return self._local.window
+
+    @contextmanager
+    def use_window(self, window):
+        """
+        Makes runs in this thread belong to `window` within the block.
+        """
+        previous = self._window
+        self._local.window = window
+        try:
+            yield window
+        finally:
+            self._local.window = previous
+
+    def end_window(self, num_points=None, window=None):
+        """
+        Ends `window` (by default, the current window). Windows appear in
+        timing_frame() in the order they were started, once ended.
+        """
+        with self._lock:
+            window = self._window if window is None else window
+            if window is not None:
+                self._windows[window]["num_points"] = num_points
+                self._windows[window]["ended"] = True
+            if window == self._window:
+                self._local.window = None
+
+    def _profile_target(self):
+        if self.profile != "auto":
+            return self.profile
+        with self._lock:
+            return max(
+                self._stats,
+                key=lambda stage: self._stats[stage]["wall_seconds"],
+                default=None,
+            )
+
+    def _profiler(self, stage):
+        """
+        Returns an enabled profiler for a run of `stage` in this thread, or
+        None if the run is not profiled.
+        """
+        # A thread runs one profiler at a time, so nested runs are not profiled
+        if getattr(self._local, "profiling", False) or self._profile_target() != stage:
+            return None
+        with self._lock:
+            profiles = self._profiles.setdefault(stage, {})
+            profiler = profiles.get(threading.get_ident(), cProfile.Profile())
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active, e.g. where profilers are process-wide
+            return None
+        with self._lock:
+            profiles[threading.get_ident()] = profiler
+        self._local.profiling = True
+        return profiler
+
+    @contextmanager
+    def stage(self, stage, rows=None, window=None):
+        """
+        Times a run of `stage`, which belongs to `window` (by default, the
+        current window). Yields the run, so that its rows can be set.
+        """
+        run = _Run(stage, self._window if window is None else window, rows)
+        if self.trace_memory:
+            with self._lock:
+                overlapped = self._active > 0
+                self._active += 1
+                self._started += 1
+                started = self._started
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        profiler = self._profiler(stage) if self.profile else None
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield run
+        finally:
+            run.wall_seconds = time.perf_counter() - wall
+            run.cpu_seconds = time.thread_time() - cpu
+            if profiler:
+                profiler.disable()
+                self._local.profiling = False
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                with self._lock:
+                    self._active -= 1
+                    overlapped = overlapped or self._started != started
+                if not overlapped:
+                    run.peak_bytes = peak
+            self._record(run)
+
+    def timed(self, stage, rows=_count_rows):
+        """
+        Decorates a function to time its calls as runs of `stage`, with
+        rows computed from its result by `rows`.
+        """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage) as run:
+                    result = function(*args, **kwargs)
+                    run.rows = rows(result)
+                return result
+
+            return wrapper
+
+        return decorator
+
+    def _record(self, run):
+        with self._lock:
+            self._runs.append(run)
+            stats = self._stats.setdefault(
+                run.stage,
+                {"runs": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "rows": 0, "peak_bytes": None},
+            )
+            stats["runs"] += 1
+            stats["wall_seconds"] += run.wall_seconds
+            stats["cpu_seconds"] += run.cpu_seconds
+            stats["rows"] += run.rows or 0
+            if run.peak_bytes is not None:
+                stats["peak_bytes"] = max(stats["peak_bytes"] or 0, run.peak_bytes)
+            if run.window is not None:
+                totals = self._windows[run.window]["stages"]
+                totals[run.stage] = totals.get(run.stage, 0.0) + run.wall_seconds
+        if self._histograms is None:
+            return
+        self._histograms["seconds"].labels(run.stage, "wall").observe(run.wall_seconds)
+        self._histograms["seconds"].labels(run.stage, "cpu").observe(run.cpu_seconds)
+        if run.rows is not None:
+            self._histograms["rows"].labels(run.stage).observe(run.rows)
+        if run.peak_bytes is not None:
+            self._histograms["peak_bytes"].labels(run.stage).observe(run.peak_bytes)
+
+    def runs_frame(self):
+        """
+        Returns a DataFrame with one row per run, for the last `max_runs`
+        runs.
+        """
+        with self._lock:
+            runs = [run.as_dict() for run in self._runs]
+        return pd.DataFrame(
+            runs,
+            columns=["stage", "window", "wall_seconds", "cpu_seconds", "rows", "peak_bytes"],
+        )
+
+    def summary(self):
+        """
+        Returns the runs, total wall and CPU time, rows, rows per second of
+        wall time and largest peak memory of each stage, slowest first.
+        """
+        with self._lock:
+            stats = {stage: dict(stats) for stage, stats in self._stats.items()}
+        summary = pd.DataFrame.from_dict(
+            stats,
+            orient="index",
+            columns=["runs", "wall_seconds", "cpu_seconds", "rows", "peak_bytes"],
+        ).astype({"peak_bytes": float})
+        summary.index.name = "stage"
+        summary.insert(4, "rows_per_second", summary["rows"] / summary["wall_seconds"])
+        return summary.sort_values("wall_seconds", ascending=False)
+
+    def timing_frame(self, stages=None):
+        """
+        Returns one row per ended window with the total wall time of each
+        stage in `<stage>_times`, in the format of analysis/timing_df_*.csv:
+        start_date, end_date, the columns of `stages` in order, num_points,
+        then the columns of any other stages.
+        """
+        with self._lock:
+            windows = pd.DataFrame(
+                [{**window, "stages": dict(window["stages"])} for window in self._windows]
+            )
+            timed = [stage for stage in self._stats if any(
+                stage in window["stages"] for window in self._windows
+            )]
+        stages = list(stages or [])
+        others = [stage for stage in timed if stage not in stages]
+        if windows.empty or "ended" not in windows:
+            return pd.DataFrame(
+                columns=TIMING_INDEX + [f"{s}_times" for s in stages] + ["num_points"]
+                + [f"{s}_times" for s in others]
+            )
+        windows = windows[windows["ended"].fillna(False).astype(bool)]
+        totals = pd.DataFrame(
+            list(windows["stages"]), index=windows.index, columns=stages + others, dtype=float
+        )
+        totals.columns = [f"{stage}_times" for stage in totals.columns]
+        timing = pd.concat([windows[TIMING_INDEX], totals], axis=1)
+        timing.insert(
+            len(TIMING_INDEX) + len(stages),
+            "num_points",
+            windows["num_points"].astype("Int64"),
+        )
+        return timing.reset_index(drop=True)
+
+    def profile_stats(self, stage=None):
+        """
+        Returns the pstats.Stats of a profiled stage (by default, the
+        slowest one profiled), or None if nothing was profiled.
+        """
+        with self._lock:
+            if stage is None:
+                stage = max(
+                    self._profiles,
+                    key=lambda stage: self._stats.get(stage, {}).get("wall_seconds", 0.0),
+                    default=None,
+                )
+            profiles = list(self._profiles.get(stage, {}).values())
+        if not profiles:
+            return None
+        return pstats.Stats(*profiles)
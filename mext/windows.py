@@ -0,0 +1,76 @@
+"""
+windows.py
+
+This file contains the time-bucketed ring buffer used to compute metrics
+over rolling windows inside the extension.
+"""
+
+import math
+import re
+import threading
+import time
+
+import numpy as np
+
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(duration):
+    """
+    Converts a Prometheus-style duration such as "5m" or "1h30m", or a
+    number of seconds, to seconds.
+    """
+    if isinstance(duration, (int, float)):
+        return float(duration)
+    parts = re.findall(r"(\d+(?:\.\d+)?)([smhdw])", duration)
+    if not parts or "".join(n + u for n, u in parts) != duration:
+        raise ValueError(f"Invalid duration: {duration!r}")
+    return float(sum(float(n) * _DURATION_UNITS[u] for n, u in parts))
+
+
+class RollingCounts:
+    """
+    Counts added over time, kept in a ring of fixed-width time buckets.
+
+    Each bucket holds a vector of `width` counts (e.g. tp/fp/tn/fn). Reading
+    the total over a window sums the buckets it covers, so both updates and
+    reads are O(buckets) regardless of how many records were added. Windows
+    are aligned to bucket boundaries, so a window includes up to one
+    bucket's worth of older data.
+    """
+
+    def __init__(self, span, bucket_seconds, width):
+        self.span = parse_duration(span)
+        self.bucket_seconds = parse_duration(bucket_seconds)
+        self.num_buckets = int(math.ceil(self.span / self.bucket_seconds)) + 1
+        self._counts = np.zeros((self.num_buckets, width), dtype=np.float64)
+        self._buckets = np.full(self.num_buckets, -1, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def _bucket(self, now):
+        return int((time.time() if now is None else now) // self.bucket_seconds)
+
+    def add(self, counts, now=None):
+        """
+        Adds a vector of counts to the bucket for time `now`.
+        """
+        bucket = self._bucket(now)
+        slot = bucket % self.num_buckets
+        with self._lock:
+            if self._buckets[slot] != bucket:
+                self._buckets[slot] = bucket
+                self._counts[slot] = 0
+            self._counts[slot] += counts
+
+    def total(self, window, now=None):
+        """
+        Returns the counts added in the last `window` seconds.
+        """
+        window = parse_duration(window)
+        if window > self.span:
+            raise ValueError(f"Window {window}s exceeds span {self.span}s.")
+        bucket = self._bucket(now)
+        oldest = bucket - int(math.ceil(window / self.bucket_seconds))
+        with self._lock:
+            live = (self._buckets > oldest) & (self._buckets <= bucket)
+            return self._counts[live].sum(axis=0)
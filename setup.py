@@ -17,7 +17,10 @@ setup(
     install_requires=[
         "prometheus-client",
         "grafanalib",
+        "numpy",
         "pandas",
+        "requests",
         "scikit-learn",
     ],
+    extras_require={"cache": ["pyarrow>=14"]},
 )
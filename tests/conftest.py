@@ -0,0 +1,18 @@
+import itertools
+
+import prometheus_client as prom
+import pytest
+
+_names = itertools.count()
+
+
+@pytest.fixture
+def name():
+    """
+    A metric name not yet registered in the default registry.
+    """
+    return f"test_metric_{next(_names)}"
+
+
+def sample(name, labels=None):
+    return prom.REGISTRY.get_sample_value(name, labels or {})
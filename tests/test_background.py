@@ -0,0 +1,119 @@
+import threading
+
+from mext import BinaryClassificationMetric
+from mext.background import BackgroundLogger
+from tests.conftest import sample
+
+OUTPUTS = [
+    (0.9, "a", {"vendor": "1"}, 1),
+    (0.2, "b", {"vendor": "1"}, 1),
+    (0.7, "c", {"vendor": "2"}, 0),
+    (0.1, "d", {"vendor": "2"}, 0),
+]
+
+
+def outcomes(name):
+    return {
+        (vendor, outcome): sample(
+            name + "_outcomes_total", {"vendor": vendor, "outcome": outcome}
+        )
+        for vendor in ("1", "2", "vendor")
+        for outcome in ("tp", "fp", "tn", "fn")
+    }
+
+
+def test_log_output_with_dict_labels_matches_direct_path(name):
+    direct = BinaryClassificationMetric(
+        name + "_direct", "", ["id"], aggregate=True, aggregate_labels=["vendor"]
+    )
+    queued = BinaryClassificationMetric(
+        name + "_queued", "", ["id"], aggregate=True, aggregate_labels=["vendor"]
+    )
+    logger = BackgroundLogger(queued, flush_interval=0.01)
+    for pred, key, labels, true in OUTPUTS:
+        direct.logOutput(pred, key, labels=labels)
+        logger.logOutput(pred, key, labels=labels)
+    for pred, key, labels, true in OUTPUTS:
+        direct.logFeedback(true, key)
+        logger.logFeedback(true, key)
+    logger.close()
+
+    expected = outcomes(direct.name)
+    assert expected[("1", "tp")] == 1 and expected[("2", "fp")] == 1
+    assert outcomes(queued.name) == expected
+
+
+class Recorder:
+    def __init__(self, name):
+        self.name = name
+        self.keys = {"logOutputs": [], "logFeedbacks": []}
+
+    def logOutputs(self, preds, keys, **kwargs):
+        self.keys["logOutputs"].extend(keys)
+
+    def logFeedbacks(self, trues, keys):
+        self.keys["logFeedbacks"].extend(keys)
+
+
+def test_sample_policy_keeps_predictions_with_their_labels(name):
+    recorder = Recorder(name)
+    logger = BackgroundLogger(recorder, max_records=1_000, policy="sample")
+    keys = [f"trip-{i}" for i in range(10_000)]
+    logger.logOutputs([0.5] * len(keys), keys)
+    logger.flush()
+    logger.logFeedbacks([1] * len(keys), list(reversed(keys)))
+    logger.close()
+
+    outputs, feedbacks = recorder.keys["logOutputs"], recorder.keys["logFeedbacks"]
+    assert 900 <= len(outputs) <= 1_000
+    assert set(outputs) == set(feedbacks)
+    assert sample(name + "_queue_dropped_total", {"reason": "sample"}) == 2 * (
+        len(keys) - len(outputs)
+    )
+
+
+class GatedRecorder(Recorder):
+    """
+    Holds the background thread inside logOutputs until the gate opens.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+
+    def logOutputs(self, preds, keys, **kwargs):
+        self.entered.set()
+        self.gate.wait()
+        super().logOutputs(preds, keys, **kwargs)
+
+
+def test_rows_being_logged_count_against_the_bound(name):
+    recorder = GatedRecorder(name)
+    logger = BackgroundLogger(recorder, max_records=100, flush_interval=0)
+    logger.logOutputs([0.5] * 100, [str(i) for i in range(100)])
+    recorder.entered.wait()
+    blocked = threading.Thread(target=logger.logOutputs, args=([0.5], ["late"]))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    recorder.gate.set()
+    blocked.join()
+    logger.close()
+    assert len(recorder.keys["logOutputs"]) == 101
+
+
+def test_drop_oldest_truncates_a_call_larger_than_the_room(name):
+    recorder = GatedRecorder(name)
+    logger = BackgroundLogger(
+        recorder, max_records=100, policy="drop_oldest", flush_interval=0
+    )
+    logger.logOutputs([0.5] * 60, [f"a{i}" for i in range(60)])
+    recorder.entered.wait()
+    logger.logOutputs([0.5] * 150, [f"b{i}" for i in range(150)])
+    recorder.gate.set()
+    logger.close()
+    logged = recorder.keys["logOutputs"]
+    assert len(logged) == 100
+    assert logged[60:] == [f"b{i}" for i in range(110, 150)]
+    assert sample(name + "_queue_dropped_total", {"reason": "drop_oldest"}) == 110
@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+# Importing components loads components.main, which needs ttb
+pytest.importorskip("ttb")
+
+from components.cache import DayCache  # noqa: E402
+
+
+def _trips(days=4, per_day=24):
+    pickup = pd.Timestamp("2020-01-01") + pd.to_timedelta(
+        np.arange(days * per_day) * 86400 // per_day, unit="s"
+    )
+    count = np.arange(days * per_day, dtype=np.float64)
+    # Missing values on the second day only, so only its counts are floats
+    count[per_day : 2 * per_day : 5] = np.nan
+    return pd.DataFrame(
+        {"tpep_pickup_datetime": pickup, "passenger_count": count, "fare": count * 2}
+    )
+
+
+class Loader:
+    def __init__(self, df):
+        self.df = df
+        self.calls = []
+
+    def __call__(self, start_date, end_date):
+        self.calls.append((start_date, end_date))
+        pickup = self.df.tpep_pickup_datetime
+        df = self.df[
+            (pickup >= pd.Timestamp(start_date)) & (pickup < pd.Timestamp(end_date))
+        ].reset_index(drop=True)
+        # Like a reader that infers integers for a day without nulls
+        if not df.passenger_count.hasnans:
+            df = df.astype({"passenger_count": np.int64})
+        return df
+
+
+def test_misses_fetch_one_day_and_hits_read_the_files(tmp_path):
+    fetch = Loader(_trips())
+    cache = DayCache(str(tmp_path), fetch)
+    expected = fetch.df.iloc[:72]
+
+    pd.testing.assert_frame_equal(cache.load("2020-01-01", "2020-01-04"), expected)
+    assert (cache.hits, cache.misses) == (0, 3)
+    assert fetch.calls == [
+        ("2020-01-01", "2020-01-02"),
+        ("2020-01-02", "2020-01-03"),
+        ("2020-01-03", "2020-01-04"),
+    ]
+
+    df = cache.load("2020-01-02", "2020-01-05", ["passenger_count"])
+    pd.testing.assert_frame_equal(
+        df, fetch.df.iloc[24:96][["passenger_count"]].reset_index(drop=True)
+    )
+    assert (cache.hits, cache.misses) == (2, 4)
+    assert len(fetch.calls) == 4
+
+
+def test_ranges_not_at_midnight_bypass_the_cache(tmp_path):
+    fetch = Loader(_trips())
+    cache = DayCache(str(tmp_path), fetch)
+    df = cache.load("2020-01-01 06:00", "2020-01-02")
+    assert len(df) == 18
+    assert (cache.hits, cache.misses) == (0, 0)
+    assert os.listdir(tmp_path) == []
+
+
+def test_least_recently_read_days_are_evicted(tmp_path):
+    fetch = Loader(_trips())
+    cache = DayCache(str(tmp_path), fetch)
+    cache.load("2020-01-01", "2020-01-03")
+    files = sorted(os.listdir(tmp_path))
+    size = max(os.path.getsize(tmp_path / name) for name in files)
+    for age, name in enumerate(files):
+        os.utime(tmp_path / name, (1_000 + age, 1_000 + age))
+
+    # Reading 01-01 makes 01-02 the least recently read day
+    cache.max_bytes = 2 * size
+    cache.load("2020-01-01", "2020-01-02")
+    cache.load("2020-01-03", "2020-01-04")
+    assert sorted(os.listdir(tmp_path)) == ["2020-01-01.arrow", "2020-01-03.arrow"]
+    cache.load("2020-01-02", "2020-01-03")
+    assert cache.misses == 4
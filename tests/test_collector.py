@@ -0,0 +1,66 @@
+import numpy as np
+import prometheus_client as prom
+import pytest
+
+from mext.collector import ArrayGauge, SeriesIndex
+
+
+def _gauges(*names, labelnames=("id",)):
+    registry = prom.CollectorRegistry()
+    index = SeriesIndex(labelnames)
+    return registry, index, [
+        ArrayGauge(name, "Doc", labelnames, registry=registry, index=index)
+        for name in names
+    ]
+
+
+def test_array_gauge_matches_prom_gauge():
+    registry, _, (gauge,) = _gauges("array", labelnames=("id", "model"))
+    expected = prom.CollectorRegistry()
+    reference = prom.Gauge("array", "Doc", ["id", "model"], registry=expected)
+    keys = [(str(i), "m" if i % 2 else 'a "b"') for i in range(3000)]
+    values = np.random.default_rng(0).random(3000)
+    gauge.set_many(values, keys)
+    gauge.labels(id="7", model="m").set(1.5)
+    for (id_, model), value in zip(keys, values):
+        reference.labels(id_, model).set(value)
+    reference.labels("7", "m").set(1.5)
+    assert sorted(prom.generate_latest(registry).splitlines()) == sorted(
+        prom.generate_latest(expected).splitlines()
+    )
+    assert len(gauge) == 3000
+
+
+def test_slots_are_shared_and_freed_with_the_last_series():
+    registry, index, (prediction, label) = _gauges("prediction", "label")
+    prediction.set_many([0.1, 0.2], [("a",), ("b",)])
+    label.set_many([1], [("a",)])
+    assert len(index) == 2
+
+    prediction.remove_many([("a",), ("b",), ("missing",)])
+    # "a" still has a label, so only "b"'s slot is freed and reused
+    assert len(index) == 1
+    assert registry.get_sample_value("prediction", {"id": "a"}) is None
+    assert registry.get_sample_value("label", {"id": "a"}) == 1
+    prediction.set_many([0.3], [("c",)])
+    assert index._labelvalues == ["a", "c"]
+    assert registry.get_sample_value("prediction", {"id": "c"}) == 0.3
+
+
+def test_gauges_grow_past_the_initial_capacity():
+    registry, index, (prediction, label) = _gauges("prediction", "label")
+    keys = [(str(i),) for i in range(3 * index.capacity)]
+    prediction.set_many(np.arange(len(keys)), keys)
+    label.set_many([1.0], keys[-1:])
+    assert index.capacity >= len(keys)
+    assert len(label._values) == index.capacity
+    assert registry.get_sample_value("prediction", {"id": keys[-1][0]}) == len(keys) - 1
+    assert registry.get_sample_value("label", {"id": keys[-1][0]}) == 1
+
+
+def test_label_errors():
+    _, index, (gauge,) = _gauges("gauge")
+    with pytest.raises(ValueError):
+        gauge.labels("a", "b")
+    with pytest.raises(ValueError):
+        ArrayGauge("other", "Doc", ["id", "model"], registry=None, index=index)
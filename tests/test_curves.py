@@ -0,0 +1,84 @@
+import numpy as np
+import prometheus_client as prom
+import pytest
+
+from mext import BinaryClassificationMetric
+from tests.conftest import sample
+
+
+def _joined(name, preds, trues, **kwargs):
+    metric = BinaryClassificationMetric(name, "", ["id"], aggregate=True, **kwargs)
+    keys = np.arange(len(preds)).astype(str)
+    metric.logOutputs(preds, keys)
+    metric.logFeedbacks(trues, keys)
+    return metric
+
+
+def test_score_histogram_matches_observe(name):
+    rng = np.random.default_rng(0)
+    preds = rng.random(1_000)
+    trues = (rng.random(1_000) < preds).astype(int)
+    _joined(name, preds, trues, score_bins=10)
+
+    registry = prom.CollectorRegistry()
+    observed = prom.Histogram(
+        "observed", "", ["label"], buckets=np.arange(1, 11) / 10, registry=registry
+    )
+    for pred, true in zip(preds, trues):
+        observed.labels(true).observe(pred)
+    for label in ("0", "1"):
+        for bound in ["0.1", "0.3", "0.7", "1.0", "+Inf"]:
+            labels = {"label": label, "le": bound}
+            assert sample(name + "_joined_score_bucket", labels) == (
+                registry.get_sample_value("observed_bucket", labels)
+            )
+        assert np.isclose(
+            sample(name + "_joined_score_sum", {"label": label}),
+            registry.get_sample_value("observed_sum", {"label": label}),
+        )
+
+
+def test_score_histogram_bounds_are_exact(name):
+    _joined(name, [0.5], [1], score_bins=10)
+    bounds = [
+        s.labels["le"]
+        for family in prom.REGISTRY.collect()
+        for s in family.samples
+        if s.name == name + "_joined_score_bucket" and s.labels["label"] == "0"
+    ]
+    assert bounds == [
+        "0.1", "0.2", "0.3", "0.4", "0.5", "0.6", "0.7", "0.8", "0.9", "1.0", "+Inf"
+    ]
+
+
+# With 100 bins, ROC-AUC is within 1e-3 of sklearn's exact value (only the
+# order within a bin is lost, and those pairs count as half right) and
+# PR-AUC within 1e-2 (it is biased low by about 0.003 on these scores).
+ROC_AUC_TOLERANCE = 1e-3
+PR_AUC_TOLERANCE = 1e-2
+
+
+def test_aucs_match_sklearn_within_tolerance(name):
+    metrics = pytest.importorskip("sklearn.metrics")
+    rng = np.random.default_rng(0)
+    preds = rng.beta(2, 5, 10_000)
+    trues = (rng.random(10_000) < preds).astype(int)
+    result = _joined(name, preds, trues, score_bins=100).get_ranking_metrics()
+    assert abs(result["roc_auc"] - metrics.roc_auc_score(trues, preds)) < (
+        ROC_AUC_TOLERANCE
+    )
+    assert abs(result["pr_auc"] - metrics.average_precision_score(trues, preds)) < (
+        PR_AUC_TOLERANCE
+    )
+
+
+def test_aucs_are_exact_for_scores_on_bin_centers(name):
+    metrics = pytest.importorskip("sklearn.metrics")
+    rng = np.random.default_rng(1)
+    preds = (rng.integers(0, 10, 2_000) + 0.5) / 10
+    trues = (rng.random(2_000) < preds).astype(int)
+    result = _joined(name, preds, trues, score_bins=10).get_ranking_metrics()
+    assert result["roc_auc"] == pytest.approx(metrics.roc_auc_score(trues, preds))
+    assert result["pr_auc"] == pytest.approx(
+        metrics.average_precision_score(trues, preds)
+    )
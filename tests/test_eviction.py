@@ -0,0 +1,60 @@
+import time
+
+import prometheus_client as prom
+
+from mext import BinaryClassificationMetric
+from mext.exposition import ExpositionCache
+from tests.conftest import sample
+
+
+def _log(metric, keys, feedback=True):
+    metric.logOutputs([0.9] * len(keys), keys)
+    if feedback:
+        metric.logFeedbacks([1] * len(keys), keys)
+
+
+def test_only_rendered_scrapes_count(name):
+    metric = BinaryClassificationMetric(name, "", ["id"], remove_after_scrapes=2)
+    _log(metric, ["a"])
+    _log(metric, ["b"], feedback=False)
+    # Collecting the registry outside of exposition is not a scrape
+    for _ in range(3):
+        list(prom.REGISTRY.collect())
+        assert sample(name + "_prediction", {"id": "a"}) == 0.9
+
+    cache = ExpositionCache(metrics_registry=prom.CollectorRegistry())
+    for _ in range(2):
+        payload, _ = cache.render()
+        assert f'{name}_label{{id="a"}} 1.0'.encode() in payload
+    assert sample(name + "_prediction", {"id": "a"}) is None
+    assert sample(name + "_label", {"id": "a"}) is None
+    assert sample(name + "_prediction", {"id": "b"}) == 0.9
+    assert sample(name + "_evicted_total", {"reason": "consumed"}) == 1
+
+
+def test_max_series_keeps_the_most_recently_updated(name):
+    metric = BinaryClassificationMetric(name, "", ["id"], max_series=2)
+    _log(metric, ["a", "b"])
+    _log(metric, ["a"], feedback=False)
+    _log(metric, ["c"], feedback=False)
+    assert sample(name + "_prediction", {"id": "b"}) is None
+    assert sample(name + "_label", {"id": "b"}) is None
+    assert sample(name + "_label", {"id": "a"}) == 1
+    assert sample(name + "_series") == 2
+    assert sample(name + "_evicted_total", {"reason": "max_series"}) == 1
+
+
+def test_max_age_removes_key_sets_not_updated(name, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: clock[0])
+    metric = BinaryClassificationMetric(name, "", ["id"], max_age=60, backend="array")
+    _log(metric, ["a", "b"])
+    clock[0] = 1040.0
+    _log(metric, ["b"], feedback=False)
+    assert metric.evict() == 0
+    clock[0] = 1061.0
+    assert metric.evict() == 1
+    assert sample(name + "_prediction", {"id": "a"}) is None
+    assert sample(name + "_label", {"id": "a"}) is None
+    assert sample(name + "_prediction", {"id": "b"}) == 0.9
+    assert sample(name + "_evicted_total", {"reason": "max_age"}) == 1
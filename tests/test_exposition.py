@@ -0,0 +1,86 @@
+import gzip
+
+import numpy as np
+import prometheus_client as prom
+import pytest
+
+from mext import BinaryClassificationMetric
+from mext.collector import BLOCK_ROWS
+from mext.exposition import ExpositionCache
+
+
+def lines(payload, prefix):
+    return sorted(
+        line
+        for line in payload.decode().splitlines()
+        if line.split(" ")[0].split("{")[0].startswith(prefix)
+        or line.startswith(f"# HELP {prefix}")
+        or line.startswith(f"# TYPE {prefix}")
+    )
+
+
+def cache():
+    return ExpositionCache(prom.REGISTRY, metrics_registry=prom.CollectorRegistry())
+
+
+@pytest.mark.parametrize("backend", ["gauge", "array"])
+def test_payload_matches_generate_latest(name, backend):
+    metric = BinaryClassificationMetric(name, "Doc", ["id", "model"], backend=backend)
+    exposition = cache()
+    keys = [[str(i), 'm"1\\'] for i in range(3000)]
+    metric.logOutputs(np.linspace(0, 1, 3000), keys)
+    metric.logFeedbacks(np.arange(3000) % 2, keys)
+    for step in range(3):
+        payload, gzipped = exposition.render()
+        assert lines(payload, name) == lines(prom.generate_latest(), name)
+        assert gzip.decompress(gzipped) == payload
+        metric.logOutputs([0.25 * step], [keys[step * 7]])
+    metric.pred_metric.labels("new", "m").set(0.5)
+    payload, _ = exposition.render()
+    assert lines(payload, name) == lines(prom.generate_latest(), name)
+
+
+@pytest.mark.parametrize("backend", ["gauge", "array"])
+def test_removed_series_leave_the_payload(name, backend):
+    metric = BinaryClassificationMetric(
+        name, "Doc", ["id"], backend=backend, max_series=100
+    )
+    exposition = cache()
+    metric.logOutputs(np.full(150, 0.5), [str(i) for i in range(150)])
+    exposition.render()
+    metric.logOutputs(np.full(50, 0.7), [str(i) for i in range(150, 200)])
+    payload, _ = exposition.render()
+    assert lines(payload, name) == lines(prom.generate_latest(), name)
+    assert f'{name}_prediction{{id="0"}}' not in payload.decode()
+    assert f'{name}_prediction{{id="199"}} 0.7' in payload.decode()
+
+
+@pytest.mark.parametrize("backend", ["gauge", "array"])
+def test_unchanged_blocks_are_reused(name, backend):
+    metric = BinaryClassificationMetric(name, "Doc", ["id"], backend=backend)
+    exposition = cache()
+    rows = 10 * BLOCK_ROWS
+    keys = [str(i) for i in range(rows)]
+    metric.logOutputs(np.full(rows, 0.5), keys)
+    metric.logFeedbacks(np.ones(rows, dtype=int), keys)
+    exposition.render()
+    parts = dict(exposition._parts)
+
+    metric.logOutputs([0.9], [keys[-1]])
+    payload, _ = exposition.render()
+    changed = [
+        key
+        for key, part in exposition._parts.items()
+        if key[0].startswith(name) and part is not parts.get(key)
+    ]
+    assert [key[0] for key in changed] == [f"{name}_prediction"]
+    assert f'{name}_prediction{{id="{keys[-1]}"}} 0.9' in payload.decode()
+
+
+def test_caches_share_their_metrics_in_one_registry():
+    registry = prom.CollectorRegistry()
+    first, second = ExpositionCache(registry), ExpositionCache(registry)
+    first.render()
+    second.render()
+    assert first.render_time is second.render_time
+    assert registry.get_sample_value("mext_exposition_render_seconds_count") == 2
@@ -0,0 +1,20 @@
+import numpy as np
+import pandas as pd
+
+from mext.features import FeatureReference
+
+
+def test_categories_survive_an_int_to_float_flip():
+    rng = np.random.default_rng(0)
+    codes = rng.integers(1, 6, 1_000)
+    reference = FeatureReference.from_frame(
+        pd.DataFrame({"RatecodeID": codes}), ["RatecodeID"], categorical=["RatecodeID"]
+    )
+    assert reference.columns["RatecodeID"]["categories"] == ["1", "2", "3", "4", "5"]
+
+    # The same values read as floats, as a column with missing values is
+    live = pd.DataFrame({"RatecodeID": codes.astype(np.float64)})
+    live.loc[0, "RatecodeID"] = np.nan
+    counts = reference.bin_counts(live)["RatecodeID"]
+    expected = np.bincount(codes[1:] - 1, minlength=5).tolist() + [1]
+    assert counts.tolist() == expected
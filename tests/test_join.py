@@ -0,0 +1,59 @@
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+
+from mext import BinaryClassificationMetric
+from tests.conftest import sample
+
+
+def test_concurrent_outputs_and_feedbacks_all_join(name):
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        metric = BinaryClassificationMetric(name, "", ["id"], aggregate=True)
+        rows = 20_000
+        keys = np.arange(rows).astype(str)
+        preds = np.random.default_rng(0).random(rows)
+        trues = (preds > 0.3).astype(int)
+        batches = np.array_split(np.arange(rows), rows // 4)
+        outputs = threading.Thread(
+            target=lambda: [metric.logOutputs(preds[b], keys[b]) for b in batches]
+        )
+        feedbacks = threading.Thread(
+            target=lambda: [metric.logFeedbacks(trues[b], keys[b]) for b in batches]
+        )
+        outputs.start()
+        feedbacks.start()
+        outputs.join()
+        feedbacks.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert {side: len(buffer) for side, buffer in metric._pending.items()} == {
+        "output": 0,
+        "feedback": 0,
+    }
+    counts = {
+        outcome: sample(name + "_outcomes_total", {"outcome": outcome})
+        for outcome in ("tp", "fp", "tn", "fn")
+    }
+    assert sum(counts.values()) == rows
+    assert counts["tp"] == np.sum((preds > 0.5) & (trues == 1))
+
+
+def test_dataframe_keys_join_with_tuple_keys(name):
+    metric = BinaryClassificationMetric(name, "", ["trip", "vendor"], aggregate=True)
+    keys = pd.DataFrame({"trip": [1, 2, 3], "vendor": ["a", "b", "a"]})
+    metric.logOutputs(np.array([0.9, 0.2, 0.8]), keys)
+    metric.logFeedbacks([1, 0], [("1", "a"), ("2", "b")])
+    metric.logFeedbacks(np.array([0]), np.array([[3, "a"]], dtype=object))
+
+    assert {side: len(buffer) for side, buffer in metric._pending.items()} == {
+        "output": 0,
+        "feedback": 0,
+    }
+    assert sample(name + "_outcomes_total", {"outcome": "tp"}) == 1
+    assert sample(name + "_outcomes_total", {"outcome": "tn"}) == 1
+    assert sample(name + "_outcomes_total", {"outcome": "fp"}) == 1
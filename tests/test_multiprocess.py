@@ -0,0 +1,77 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from mext import multiprocess
+
+# Multi-process mode must be set up before prometheus_client is imported,
+# so the workers and the merging registry run in a fresh interpreter.
+SCRIPT = textwrap.dedent(
+    """
+    import json
+    import multiprocessing
+
+    from mext import BinaryClassificationMetric, multiprocess
+
+    keyed = BinaryClassificationMetric("keyed", "", ["id"])
+    joined = BinaryClassificationMetric("joined", "", ["id"], aggregate=True)
+
+
+    def worker(i):
+        keyed.logOutputs([i / 10], ["shared"])
+        keyed.logOutputs([i / 10], [f"own{i}"])
+        joined.logOutputs([0.9, 0.1], [f"a{i}", f"b{i}"])
+        joined.logFeedbacks([1, 1], [f"a{i}", f"b{i}"])
+        multiprocess.mark_process_dead()
+
+
+    if __name__ == "__main__":
+        context = multiprocessing.get_context("fork")
+        for i in range(1, 4):
+            process = context.Process(target=worker, args=(i,))
+            process.start()
+            process.join()
+        registry = multiprocess.multiprocess_registry()
+        value = registry.get_sample_value
+        print(json.dumps({
+            "shared": value("keyed_prediction", {"id": "shared"}),
+            "own": [value("keyed_prediction", {"id": f"own{i}"}) for i in range(1, 4)],
+            "tp": value("joined_outcomes_total", {"outcome": "tp"}),
+            "fn": value("joined_outcomes_total", {"outcome": "fn"}),
+        }))
+    """
+)
+
+
+def test_workers_are_merged_in_one_registry(tmp_path):
+    directory = tmp_path / "metrics"
+    directory.mkdir()
+    script = tmp_path / "workers.py"
+    script.write_text(SCRIPT)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(
+        os.environ,
+        PROMETHEUS_MULTIPROC_DIR=str(directory),
+        PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])),
+    )
+    result = subprocess.run(
+        [sys.executable, str(script)], env=env, capture_output=True, text=True,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    values = json.loads(result.stdout)
+    # Gauges keep the value written last, counters are summed
+    assert values["shared"] == 0.3
+    assert values["own"] == [0.1, 0.2, 0.3]
+    assert values["tp"] == 3
+    assert values["fn"] == 3
+
+
+def test_exporter_requires_multiprocess_mode():
+    assert not multiprocess.is_multiprocess()
+    with pytest.raises(ValueError):
+        multiprocess.start_http_server(0)
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("ttb")
+
+from components import main  # noqa: E402
+
+
+@pytest.fixture
+def raw():
+    """
+    Three days of trips, with missing values and dropoffs past midnight.
+    """
+    rng = np.random.default_rng(0)
+    n = 600
+    pickup = pd.Timestamp("2020-01-01") + pd.to_timedelta(
+        np.sort(rng.integers(0, 3 * 86400, n)), unit="s"
+    )
+    return pd.DataFrame(
+        {
+            "tpep_pickup_datetime": pickup,
+            "tpep_dropoff_datetime": pickup
+            + pd.to_timedelta(rng.integers(60, 4 * 3600, n), unit="s"),
+            "fare_amount": rng.random(n) * 30,
+            "tip_amount": rng.random(n) * 5,
+            "trip_distance": rng.random(n) * 10,
+            "passenger_count": np.where(rng.random(n) < 0.1, np.nan, 1.0),
+            "congestion_surcharge": np.where(rng.random(n) < 0.1, np.nan, 2.5),
+            "pulocationid": rng.integers(1, 265, n),
+            "dolocationid": rng.integers(1, 265, n),
+            "ratecodeid": rng.integers(1, 6, n).astype(float),
+            "vendorid": rng.integers(1, 3, n),
+        }
+    )
+
+
+@pytest.fixture
+def load(raw, monkeypatch):
+    def load_data(start_date, end_date, columns=None):
+        pickup = raw.tpep_pickup_datetime
+        df = raw[
+            (pickup >= pd.Timestamp(start_date)) & (pickup < pd.Timestamp(end_date))
+        ].reset_index(drop=True)
+        return df if columns is None else df[columns]
+
+    monkeypatch.setattr(main, "load_data", load_data)
+    return load_data
+
+
+@pytest.mark.parametrize("chunk_days, chunk_rows", [(1, None), (2, 37), (1, 1)])
+def test_chunked_features_match_the_unchunked_path(load, chunk_days, chunk_rows):
+    expected = main.featurize_data(
+        main.clean_data(load("2020-01-01", "2020-01-03"), "2020-01-01", "2020-01-03")
+    )
+    features = main.stream_features(
+        "2020-01-01", "2020-01-03", chunk_days=chunk_days, chunk_rows=chunk_rows
+    )
+    pd.testing.assert_frame_equal(features, expected)
+
+
+def test_compact_features_match_the_default_features(load):
+    df = main.clean_data(load("2020-01-01", "2020-01-04"))
+    expected = main.featurize_data(df)
+    compact = main.featurize_data(df, compact=True)
+    assert list(compact.columns) == list(expected.columns)
+    for name in expected.columns:
+        if name in main.FEATURE_DTYPES:
+            assert compact[name].dtype == main.FEATURE_DTYPES[name]
+            # float32 keeps about 7 significant digits
+            np.testing.assert_allclose(
+                compact[name].to_numpy(np.float64), expected[name], rtol=1e-6
+            )
+        else:
+            pd.testing.assert_series_equal(compact[name], expected[name])
+
+    chunked = main.stream_features(
+        "2020-01-01", "2020-01-04", chunk_rows=50, compact=True
+    )
+    clean = main.clean_data(df, "2020-01-01", "2020-01-04")
+    pd.testing.assert_frame_equal(chunked, main.featurize_data(clean, compact=True))
@@ -0,0 +1,51 @@
+import time
+
+import prometheus_client as prom
+import pytest
+
+from benchmarks.stub import PrometheusStub
+from mext import BinaryClassificationMetric
+from mext.query import QUERY_LABEL, QueryClient
+
+
+@pytest.fixture
+def stub(name):
+    metric = BinaryClassificationMetric(name, "", ["id"], aggregate=True)
+    stub = PrometheusStub(metric, prom.REGISTRY)
+    yield metric, stub
+    stub.close()
+
+
+def test_query_label_is_not_reserved():
+    assert not QUERY_LABEL.startswith("__")
+
+
+def test_uncached_reads_see_new_data(stub):
+    metric, stub = stub
+    client = QueryClient(stub.url, cache_ttl=0)
+    metric.logOutputs([0.9, 0.9], ["a", "b"])
+    metric.logFeedbacks([1, 1], ["a", "b"])
+    stub.scrape()
+    assert client.latest(metric, end=time.time())["accuracy"] == 1.0
+
+    metric.logOutputs([0.9, 0.9], ["c", "d"])
+    metric.logFeedbacks([0, 0], ["c", "d"])
+    stub.scrape()
+    assert client.latest(metric, end=time.time())["accuracy"] == 0.5
+    assert not client._cache
+    client.close()
+
+
+def test_recorded_reads_use_the_recorded_series(stub):
+    metric, stub = stub
+    client = QueryClient(stub.url, cache_ttl=0)
+    metric.logOutputs([0.9], ["a"])
+    metric.logFeedbacks([1], ["a"])
+    stub.scrape()
+    sent = []
+    query_range = client.query_range
+    client.query_range = lambda query, *args: sent.append(query) or query_range(query, *args)
+    assert client.latest(metric, end=time.time(), recorded=True)["accuracy"] == 1.0
+    assert f"({metric.name}:accuracy:rate{metric.window})" in sent[0]
+    assert "_outcomes_total" not in sent[0]
+    client.close()
@@ -0,0 +1,61 @@
+import numpy as np
+
+from mext import BinaryClassificationMetric
+from tests.conftest import sample
+
+RATES = {0: 0.1, 1: 0.5}
+
+
+def _log(metric, n, seed=0):
+    rng = np.random.default_rng(seed)
+    preds = rng.random(n)
+    trues = (rng.random(n) < preds).astype(int)
+    keys = np.arange(n).astype(str)
+    metric.logOutputs(preds, keys)
+    metric.logFeedbacks(trues, keys)
+    positive = preds > metric.threshold
+    return {
+        "tp": np.sum(positive & (trues == 1)),
+        "fp": np.sum(positive & (trues == 0)),
+        "tn": np.sum(~positive & (trues == 0)),
+        "fn": np.sum(~positive & (trues == 1)),
+    }
+
+
+def test_weighted_outcomes_estimate_unsampled_counts(name):
+    metric = BinaryClassificationMetric(
+        name, "", ["id"], aggregate=True, label_sample_rates=RATES
+    )
+    exact = _log(metric, 40_000)
+    for outcome, count in exact.items():
+        rate = RATES[int(outcome in ("tp", "fn"))]
+        estimate = sample(name + "_outcomes_total", {"outcome": outcome})
+        # Each estimate is a count of kept pairs times 1 / rate
+        assert (estimate * rate) == round(estimate * rate)
+        # Within four standard deviations of the binomial estimate
+        assert abs(estimate - count) < 4 * np.sqrt(count * (1 - rate) / rate)
+
+
+def test_weighted_histograms_match_weighted_outcomes(name):
+    metric = BinaryClassificationMetric(
+        name, "", ["id"], aggregate=True, label_sample_rates=RATES, score_bins=10
+    )
+    _log(metric, 10_000)
+    _, counts, _ = metric.get_score_histograms()
+    outcomes = {
+        outcome: sample(name + "_outcomes_total", {"outcome": outcome})
+        for outcome in ("tp", "fp", "tn", "fn")
+    }
+    assert np.isclose(counts[0].sum(), outcomes["fp"] + outcomes["tn"])
+    assert np.isclose(counts[1].sum(), outcomes["tp"] + outcomes["fn"])
+    # Threshold 0.5 is the edge between bins 4 and 5
+    assert np.isclose(counts[1, 5:].sum(), outcomes["tp"])
+
+
+def test_unit_rates_count_every_pair(name):
+    metric = BinaryClassificationMetric(
+        name, "", ["id"], aggregate=True, label_sample_rates={0: 1, 1: 1}
+    )
+    exact = _log(metric, 1_000)
+    for outcome, count in exact.items():
+        assert sample(name + "_outcomes_total", {"outcome": outcome}) == count
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("ttb")
+
+from sklearn.ensemble import RandomForestClassifier  # noqa: E402
+
+from components.main import predict_sharded, save_model, shutdown_scoring_pools  # noqa: E402
+
+
+def test_sharded_predictions_match_the_model_in_order(tmp_path):
+    rng = np.random.default_rng(0)
+    matrix = rng.random((1_000, 9))
+    labels = (matrix[:, 0] + matrix[:, 5] > 1).astype(int)
+    model = RandomForestClassifier(n_estimators=5, max_depth=4, random_state=0)
+    model.fit(matrix, labels)
+    path = str(tmp_path / "model.joblib")
+    save_model(model, path)
+    try:
+        probabilities = predict_sharded(matrix, path, n_jobs=2, shard_rows=37)
+    finally:
+        shutdown_scoring_pools()
+
+    np.testing.assert_array_equal(probabilities, model.predict_proba(matrix)[:, 1])
+    np.testing.assert_array_equal(
+        model.classes_[(probabilities > 0.5).astype(int)], model.predict(matrix)
+    )
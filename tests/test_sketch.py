@@ -0,0 +1,68 @@
+import json
+
+import numpy as np
+import pytest
+
+from mext.sketch import DDSketch, WindowedSketch
+
+QUANTILES = [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]
+
+
+def _values(seed=0):
+    rng = np.random.default_rng(seed)
+    return np.concatenate([rng.lognormal(0, 2, 5_000), -rng.exponential(3, 1_000)])
+
+
+@pytest.mark.parametrize("accuracy", [0.01, 0.05])
+def test_quantiles_are_within_the_relative_accuracy(accuracy):
+    values = _values()
+    sketch = DDSketch(relative_accuracy=accuracy)
+    sketch.add(values)
+    expected = np.quantile(values, QUANTILES, method="lower")
+    relative_error = np.abs(sketch.quantile(QUANTILES) - expected) / np.abs(expected)
+    assert np.all(relative_error <= accuracy + 1e-12)
+    assert sketch.count == len(values)
+    assert sketch.sum == pytest.approx(values.sum())
+
+
+def test_merge_matches_one_sketch_of_all_values():
+    values = _values()
+    merged, left, right = DDSketch(), DDSketch(), DDSketch()
+    merged.add(values)
+    left.add(values[::2])
+    right.add(values[1::2])
+    left.merge(right)
+    np.testing.assert_array_equal(left.quantile(QUANTILES), merged.quantile(QUANTILES))
+    assert left.count == merged.count
+
+
+def test_merge_rejects_different_parameters():
+    with pytest.raises(ValueError):
+        DDSketch(0.01).merge(DDSketch(0.02))
+
+
+def test_dict_round_trip():
+    sketch = DDSketch()
+    sketch.add(_values(), weights=2.0)
+    sketch.add([0.0, np.nan])
+    copy = DDSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    np.testing.assert_array_equal(copy.quantile(QUANTILES), sketch.quantile(QUANTILES))
+    assert (copy.count, copy.sum, copy.zero_count) == (
+        sketch.count,
+        sketch.sum,
+        sketch.zero_count,
+    )
+
+
+def test_empty_sketch_returns_nan():
+    assert np.isnan(DDSketch().quantile(0.5))
+
+
+def test_windowed_sketch_forgets_old_buckets():
+    sketch = WindowedSketch("1m", "10s")
+    sketch.add([1.0] * 10, now=0)
+    sketch.add([100.0] * 10, now=55)
+    assert sketch.sketch("1m", now=59).count == 20
+    assert sketch.sketch("1m", now=75).quantile(0.5) == pytest.approx(100, rel=0.01)
+    with pytest.raises(ValueError):
+        sketch.sketch("2m")
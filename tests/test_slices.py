@@ -0,0 +1,89 @@
+from collections import Counter
+
+import numpy as np
+import prometheus_client as prom
+import pytest
+
+from mext import BinaryClassificationMetric
+from mext.slices import OTHER, SliceCounter, SpaceSaving
+
+
+def test_space_saving_keeps_heavy_hitters_with_bounded_error():
+    rng = np.random.default_rng(0)
+    values = rng.zipf(1.5, 20_000) % 1_000
+    tracker = SpaceSaving(20)
+    for batch in np.array_split(values, 50):
+        tracker.update(batch)
+    true = Counter(values.astype(str).tolist())
+    tracked = {v: slot for slot, v in enumerate(tracker.values)}
+    for value, count in true.items():
+        if count > len(values) / tracker.k:
+            assert value in tracked
+    for value, slot in tracked.items():
+        assert true[value] <= tracker.counts[slot]
+        assert tracker.counts[slot] - tracker.errors[slot] <= true[value]
+    assert tracker.counts.sum() == len(values)
+
+
+def test_space_saving_replaces_the_smallest_counter():
+    tracker = SpaceSaving(2)
+    tickets, replaced = tracker.update(["a", "a", "a", "b"])
+    assert replaced == []
+    assert len(tracker) == 2
+    old_b = tickets[-1]
+
+    tickets, replaced = tracker.update(["c", "c"])
+    assert replaced == [tracker.values.index("c")]
+    assert "b" not in tracker.values
+    # c takes over b's count of 1 as its error
+    slot = tracker.values.index("c")
+    assert (tracker.counts[slot], tracker.errors[slot]) == (3, 1)
+    assert tracker.slots([old_b, tickets[0], -1]).tolist() == [2, slot, 2]
+
+
+def test_space_saving_rejects_empty_tracker():
+    with pytest.raises(ValueError):
+        SpaceSaving(0)
+
+
+def test_slice_counter_moves_replaced_counts_to_other():
+    counter = SliceCounter("zone", 2, 4)
+    tickets = counter.assign(["a", "a", "b"])
+    counter.add(tickets, np.array([0, 1, 2]))
+    assert dict((v, c.tolist()) for v, c in counter.items()) == {
+        "a": [1, 1, 0, 0],
+        "b": [0, 0, 1, 0],
+        OTHER: [0, 0, 0, 0],
+    }
+
+    # c replaces b; outcomes still pending for b's ticket go to other
+    late = tickets[2:]
+    tickets = counter.assign(["c", "c"])
+    counter.add(tickets, np.array([3, 3]), weights=np.array([2.0, 2.0]))
+    counter.add(late, np.array([0]))
+    assert dict((v, c.tolist()) for v, c in counter.items()) == {
+        "a": [1, 1, 0, 0],
+        "c": [0, 0, 0, 4],
+        OTHER: [1, 0, 1, 0],
+    }
+
+
+def test_a_slice_value_named_other_is_not_the_tail(name):
+    metric = BinaryClassificationMetric(
+        name, "", ["id"], aggregate=True, slices=["zone"], slice_top_k=2
+    )
+    keys = ["a", "b", "c"]
+    metric.logOutputs([0.9, 0.9, 0.1], keys, slices={"zone": ["other", "other", "y"]})
+    metric.logFeedbacks([1, 0, 0], keys)
+    # z replaces y, whose counts move to the tail
+    metric.logOutputs([0.9], ["d"], slices={"zone": ["z"]})
+    outcomes = {
+        (s.labels["value"], s.labels["outcome"]): s.value
+        for family in prom.REGISTRY.collect()
+        for s in family.samples
+        if s.name == name + "_slice_outcomes_total"
+    }
+    assert OTHER != "other"
+    assert outcomes["other", "tp"] == outcomes["other", "fp"] == 1
+    assert outcomes[OTHER, "tn"] == 1
+    assert outcomes[OTHER, "tp"] == 0
@@ -0,0 +1,38 @@
+from prometheus_client import generate_latest
+
+from mext import BinaryClassificationMetric
+from tests.conftest import sample
+
+
+def log_count(metric, call):
+    return sample(
+        "mext_log_seconds_count", {"metric": metric.name, "call": call}
+    )
+
+
+def test_instrument_can_be_switched_on_after_construction(name):
+    metric = BinaryClassificationMetric(name, "", ["id"], aggregate=True)
+    metric.logOutputs([0.9], ["a"])
+    assert log_count(metric, "logOutputs") is None
+
+    metric.instrument = True
+    metric.logOutputs([0.8, 0.1], ["b", "c"])
+    metric.logFeedbacks([1, 0], ["b", "c"])
+    assert log_count(metric, "logOutputs") == 1
+    assert log_count(metric, "logFeedbacks") == 1
+
+    metric.instrument = False
+    metric.logOutputs([0.5], ["d"])
+    assert log_count(metric, "logOutputs") == 1
+
+
+def test_instrumented_metric_times_its_collectors(name):
+    metric = BinaryClassificationMetric(
+        name, "", ["id"], aggregate=True, slices=["zone"], instrument=True
+    )
+    metric.logOutputs([0.9], ["a"], slices={"zone": ["1"]})
+    generate_latest()
+    assert sample(
+        "mext_collect_seconds_count",
+        {"metric": metric.name, "collector": "SliceCollector"},
+    ) >= 1
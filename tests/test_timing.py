@@ -0,0 +1,81 @@
+import threading
+import time
+
+import numpy as np
+
+from mext.timing import StageTimer
+
+
+def _spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_cpu_time_is_per_thread():
+    timer = StageTimer(registry=None)
+    busy = threading.Thread(target=_spin, args=(0.3,))
+    busy.start()
+    with timer.stage("sleep"):
+        time.sleep(0.2)
+    busy.join()
+    assert timer.runs_frame()["cpu_seconds"][0] < 0.05
+
+
+def test_overlapping_runs_record_no_peak():
+    timer = StageTimer(registry=None, trace_memory=True)
+    with timer.stage("alone"):
+        np.ones(1_000_000)
+    started = threading.Event()
+    done = threading.Event()
+
+    def other():
+        with timer.stage("other"):
+            started.set()
+            done.wait()
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    started.wait()
+    with timer.stage("concurrent"):
+        np.ones(1_000_000)
+    done.set()
+    thread.join()
+    peaks = timer.runs_frame().set_index("stage")["peak_bytes"]
+    assert peaks["alone"] >= 8_000_000
+    assert np.isnan(peaks["concurrent"]) and np.isnan(peaks["other"])
+
+
+def test_totals_cover_runs_beyond_max_runs():
+    timer = StageTimer(registry=None, max_runs=3)
+    for day in range(2):
+        window = timer.start_window(f"2020-01-0{day + 1}", f"2020-01-0{day + 2}")
+        for _ in range(5):
+            with timer.stage("clean_data", rows=10):
+                pass
+        timer.end_window(50, window)
+    assert len(timer.runs_frame()) == 3
+    summary = timer.summary()
+    assert summary.loc["clean_data", "runs"] == 10
+    assert summary.loc["clean_data", "rows"] == 100
+    timing = timer.timing_frame(["clean_data"])
+    assert list(timing.columns) == ["start_date", "end_date", "clean_data_times", "num_points"]
+    assert list(timing["num_points"]) == [50, 50]
+    assert timing["clean_data_times"].notna().all()
+
+
+def test_threads_profile_separately():
+    timer = StageTimer(registry=None, profile="work")
+
+    def work():
+        with timer.stage("work"):
+            _spin(0.05)
+
+    threads = [threading.Thread(target=work) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    work()
+    assert len(timer._profiles["work"]) == 3
+    assert timer.profile_stats().total_calls > 0
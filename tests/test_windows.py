@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from mext.windows import RollingCounts, parse_duration
+
+
+@pytest.mark.parametrize(
+    "duration, seconds",
+    [("30s", 30), ("5m", 300), ("1h30m", 5400), ("1.5h", 5400), ("1d", 86400),
+     ("2w", 1209600), (90, 90.0), (0.5, 0.5)],
+)
+def test_parse_duration(duration, seconds):
+    assert parse_duration(duration) == seconds
+
+
+@pytest.mark.parametrize("duration", ["", "5", "5x", "m5", "5m ", "1h-30m"])
+def test_parse_duration_rejects_invalid_strings(duration):
+    with pytest.raises(ValueError):
+        parse_duration(duration)
+
+
+def test_counts_expire_once_their_bucket_leaves_the_window():
+    counts = RollingCounts("1m", "10s", 2)
+    counts.add([1, 0], now=0)
+    counts.add([0, 1], now=35)
+    counts.add([1, 1], now=39)
+    np.testing.assert_array_equal(counts.total("1m", now=59), [2, 2])
+    # The window covers whole buckets, so [0, 10) is kept until t=60
+    np.testing.assert_array_equal(counts.total("1m", now=60), [1, 2])
+    np.testing.assert_array_equal(counts.total("30s", now=59), [1, 2])
+    np.testing.assert_array_equal(counts.total("1m", now=100), [0, 0])
+
+
+def test_reused_slot_is_reset():
+    counts = RollingCounts("1m", "10s", 1)
+    counts.add([5], now=0)
+    # Lands in the same ring slot as t=0, one full ring later
+    counts.add([1], now=counts.num_buckets * 10)
+    np.testing.assert_array_equal(counts.total("1m", now=counts.num_buckets * 10), [1])
+
+
+def test_window_longer_than_span_raises():
+    with pytest.raises(ValueError):
+        RollingCounts("1m", "10s", 1).total("5m")
@@ -4,7 +4,10 @@ from components import (
     featurize_data,
     train_test_split,
     train_model,
+    stream_features,
+    timer,
 )
+from mext.features import FeatureReference
 
 import argparse
 import logging
@@ -14,6 +17,33 @@ import logging
 parser = argparse.ArgumentParser(description="Run training.")
 parser.add_argument("--start", type=str, help="Start date", nargs="?")
 parser.add_argument("--end", type=str, help="End date", nargs="?")
+parser.add_argument(
+    "--profile",
+    type=str,
+    help="Stage to profile with cProfile, or auto for the slowest",
+    nargs="?",
+)
+parser.add_argument(
+    "--chunk-days",
+    type=int,
+    help="Load, clean and featurize this many days at a time",
+    nargs="?",
+)
+parser.add_argument(
+    "--chunk-rows",
+    type=int,
+    help="Maximum rows per chunk with --chunk-days",
+    nargs="?",
+)
+parser.add_argument(
+    "--n-jobs",
+    type=int,
+    help="Cores to train the model on, or -1 for all",
+    nargs="?",
+)
+parser.add_argument(
+    "--timings", type=str, help="Path of a CSV of stage timings", nargs="?"
+)
 args = parser.parse_args()
 
 ### SETTING UP LOGGING ###
@@ -26,16 +56,23 @@ logging.basicConfig(
 ##################### PIPELINE CODE #############################
 
 if __name__ == "__main__":
+    timer.profile = args.profile
     start_date = args.start if args.start else "2020-01-01"
     end_date = args.end if args.end else "2020-01-15"
     logging.info(
         f"Running the train pipeline from {start_date} to {end_date}..."
     )
 
-    # Clean and featurize data
-    df = load_data(start_date, end_date)
-    clean_df = clean_data(df, start_date, end_date)
-    features_df = featurize_data(clean_df)
+    # Clean and featurize data, in chunks with --chunk-days so that memory
+    # does not grow with the date range
+    if args.chunk_days:
+        features_df = stream_features(
+            start_date, end_date, args.chunk_days, args.chunk_rows, compact=True
+        )
+    else:
+        df = load_data(start_date, end_date)
+        clean_df = clean_data(df, start_date, end_date)
+        features_df = featurize_data(clean_df, compact=True)
 
     feature_columns = [
         "pickup_weekday",
@@ -52,4 +89,19 @@ if __name__ == "__main__":
 
     # If training, train a model and save it
     train_df, test_df = train_test_split(features_df)
-    train_model(train_df, test_df, feature_columns, label_column)
+    with timer.stage("train_model", rows=len(train_df)):
+        train_model(
+            train_df, test_df, feature_columns, label_column, n_jobs=args.n_jobs
+        )
+
+    # Save the training feature distribution as the reference for drift
+    FeatureReference.from_frame(
+        train_df, feature_columns, categorical=["RatecodeID"]
+    ).save("feature_reference.json")
+
+    logging.info(f"Stage timings:\n{timer.summary()}")
+    if args.timings:
+        timer.runs_frame().to_csv(args.timings, index=False)
+    stats = timer.profile_stats()
+    if stats:
+        stats.sort_stats("cumulative").print_stats(20)